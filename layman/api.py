@@ -16,6 +16,7 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+import functools
 import os
 import sys
 
@@ -26,8 +27,10 @@ from layman.remotedb        import RemoteDB
 from layman.overlays.source import require_supported
 #from layman.utils import path, delete_empty_directory
 from layman.compatibility   import encode
-from layman.utils           import get_ans, verify_overlay_src
+from layman.utils           import CommandTimeout, get_ans, get_host, \
+                                   get_int_option, verify_overlay_src
 from layman.mounter         import Mounter
+from layman.scheduler       import Scheduler
 
 if sys.hexversion >= 0x30200f0:
     STR = str
@@ -68,6 +71,7 @@ class LaymanAPI(object):
         self._available_ids = None
         self._error_messages = []
         self.sync_results = []
+        self.sync_stats = []
 
         self.config.set_option('mounts', Mounter(self._get_installed_db,
                                                  self.get_installed,
@@ -116,20 +120,24 @@ class LaymanAPI(object):
         """
         repos = self._check_repo_type(repos, "delete_repo")
         results = []
-        for ovl in repos:
-            if not self.is_installed(ovl):
-                self.output.error("Repository '"+ovl+"' was not installed")
-                results.append(False)
-                continue
-            success = False
-            try:
-                success = self._get_installed_db().delete(
-                    self._get_installed_db().select(ovl))
-            except Exception as e:
-                self._error('Exception caught removing repository "%(repo)s":\n'
-                            '%(err)s' % {'repo': ovl, 'err': e})
-            results.append(success)
-            self.get_installed(dbreload=True)
+        db = self._get_installed_db()
+        db.start_batch()
+        try:
+            for ovl in repos:
+                if not self.is_installed(ovl):
+                    self.output.error("Repository '"+ovl+"' was not installed")
+                    results.append(False)
+                    continue
+                success = False
+                try:
+                    success = db.delete(db.select(ovl))
+                except Exception as e:
+                    self._error('Exception caught removing repository '
+                                '"%(repo)s":\n%(err)s' % {'repo': ovl, 'err': e})
+                results.append(success)
+                self._installed_ids = None
+        finally:
+            results.append(self._commit_batch(db))
         if False in results:
             return False
         return True
@@ -145,24 +153,28 @@ class LaymanAPI(object):
         """
         repos = self._check_repo_type(repos, "add_repo")
         results = []
-        for ovl in repos:
-            if self.is_installed(ovl):
-                self.output.error("Repository '"+ovl+"' was already installed")
-                results.append(False)
-                continue
-            if not self.is_repo(ovl):
-                self.output.error(UnknownOverlayMessage(ovl))
-                results.append(False)
-                continue
-            success = False
-            try:
-                success = self._get_installed_db().add(
-                    self._get_remote_db().select(ovl))
-            except Exception as e:
-                self._error('Exception caught installing repository "%(repo)s":'
-                            '\n%(err)s' % {'repo': ovl, 'err': e})
-            results.append(success)
-            self.get_installed(dbreload=True)
+        db = self._get_installed_db()
+        db.start_batch()
+        try:
+            for ovl in repos:
+                if self.is_installed(ovl):
+                    self.output.error("Repository '"+ovl+"' was already installed")
+                    results.append(False)
+                    continue
+                if not self.is_repo(ovl):
+                    self.output.error(UnknownOverlayMessage(ovl))
+                    results.append(False)
+                    continue
+                success = False
+                try:
+                    success = db.add(self._get_remote_db().select(ovl))
+                except Exception as e:
+                    self._error('Exception caught installing repository '
+                                '"%(repo)s":\n%(err)s' % {'repo': ovl, 'err': e})
+                results.append(success)
+                self._installed_ids = None
+        finally:
+            results.append(self._commit_batch(db))
         if (True in results) and update_news:
             self.update_news(repos)
 
@@ -171,6 +183,23 @@ class LaymanAPI(object):
         return True
 
 
+    def _commit_batch(self, db):
+        """writes out the changes of an installed db batch
+
+        @rtype bool: reflects success or failure
+        """
+        try:
+            success = db.commit_batch()
+        except Exception as e:
+            self._error('Exception caught writing the installed repositories'
+                        ':\n%(err)s' % {'err': e})
+            success = False
+        if not success:
+            self.output.error('Failed to write the installed repositories '
+                              'or their repo configs')
+        return success
+
+
     def readd_repos(self, repos, update_news=False):
         """reinstalls any given amount of repos
         by deleting them and readding them
@@ -190,20 +219,23 @@ class LaymanAPI(object):
     def disable_repos(self, repos, update_news=False):
         repos = self._check_repo_type(repos, "disable_repo")
         results = []
-        for ovl in repos:
-            if not self.is_repo(ovl):
-                self.output.error(UnknownOverlayMessage(ovl))
-                results.append(False)
-                continue
-            success = False
-            try:
-                success = self._get_installed_db().disable(
-                    self._get_installed_db().select(ovl))
-            except Exception as e:
-                self._error('Exception caught disabling repository "%(repo)s"'\
-                            ':\n%(err)s' % {'repo': ovl, 'err': e})
-            results.append(success)
-            self.get_installed(dbreload=True)
+        db = self._get_installed_db()
+        db.start_batch()
+        try:
+            for ovl in repos:
+                if not self.is_repo(ovl):
+                    self.output.error(UnknownOverlayMessage(ovl))
+                    results.append(False)
+                    continue
+                success = False
+                try:
+                    success = db.disable(db.select(ovl))
+                except Exception as e:
+                    self._error('Exception caught disabling repository "%(repo)s"'\
+                                ':\n%(err)s' % {'repo': ovl, 'err': e})
+                results.append(success)
+        finally:
+            results.append(self._commit_batch(db))
         if (True in results) and update_news:
             self.update_news(repos)
 
@@ -215,20 +247,23 @@ class LaymanAPI(object):
     def enable_repos(self, repos, update_news=False):
         repos = self._check_repo_type(repos, "enable_repo")
         results = []
-        for ovl in repos:
-            if not self.is_repo(ovl):
-                self.output.error(UnknownOverlayMessage(ovl))
-                results.append(False)
-                continue
-            success = False
-            try:
-                success = self._get_installed_db().enable(
-                    self._get_installed_db().select(ovl))
-            except Exception as e:
-                self._error('Exception caught enabling repository "%(repo)s"'\
-                            ':\n%(err)s' % {'repo': ovl, 'err': e})
-            results.append(success)
-            self.get_installed(dbreload=True)
+        db = self._get_installed_db()
+        db.start_batch()
+        try:
+            for ovl in repos:
+                if not self.is_repo(ovl):
+                    self.output.error(UnknownOverlayMessage(ovl))
+                    results.append(False)
+                    continue
+                success = False
+                try:
+                    success = db.enable(db.select(ovl))
+                except Exception as e:
+                    self._error('Exception caught enabling repository "%(repo)s"'\
+                                ':\n%(err)s' % {'repo': ovl, 'err': e})
+                results.append(success)
+        finally:
+            results.append(self._commit_batch(db))
         if (True in results) and update_news:
             self.update_news(repos)
 
@@ -378,22 +413,26 @@ class LaymanAPI(object):
         @param update_news: bool, defaults to False
         @rtype bool or {'repo-id': bool,...}
         """
-        self.output.debug("API.sync(); repos to sync = %s" % ', '.join((x.decode() if isinstance(x, bytes) else x) for x in repos), 5)
+        self.output.debug(lambda: "API.sync(); repos to sync = %s"
+            % ', '.join((x.decode() if isinstance(x, bytes) else x)
+                        for x in repos), 5)
         fatals = []
         warnings = []
         success  = []
+        first_record = len(self.config['stats'].records)
         repos = self._check_repo_type(repos, "sync")
         db = self._get_installed_db()
         rdb = self._get_remote_db()
+        to_sync = []
 
         self.output.debug("API.sync(); starting ovl loop", 5)
         for ovl in repos:
             update_url = False
-            self.output.debug("API.sync(); starting ovl = %s" %ovl, 5)
+            self.output.debug("API.sync(); starting ovl = %s", 5, ovl)
             try:
                 #self.output.debug("API.sync(); selecting %s, db = %s" % (ovl, str(db)), 5)
                 odb = db.select(ovl)
-                self.output.debug("API.sync(); %s now selected" %ovl, 5)
+                self.output.debug("API.sync(); %s now selected", 5, ovl)
             except UnknownOverlayException as error:
                 #self.output.debug("API.sync(); UnknownOverlayException selecting %s" %ovl, 5)
                 #self._error(str(error))
@@ -401,8 +440,7 @@ class LaymanAPI(object):
                     'Failed to select overlay "%(repo)s".\nError was: %(error)s'
                      % {'repo': ovl, 'err': error}))
                 self.output.debug("API.sync(); UnknownOverlayException "
-                    "selecting %(repo)s.   continuing to next ovl..."
-                    % {'repo': ovl}, 5)
+                    "selecting %s.   continuing to next ovl...", 5, ovl)
                 continue
 
             try:
@@ -443,11 +481,35 @@ class LaymanAPI(object):
                     self.output.warn('    Error was: %s' % str(error))
                     continue
 
-            try:
-                    self.output.debug("API.sync(); starting db.sync(ovl)", 5)
-                    db.sync(ovl)
-                    success.append((ovl,'Successfully synchronized overlay "' + ovl + '".'))
-            except Exception as error:
+            if not ovl in to_sync:
+                to_sync.append(ovl)
+
+        # The checks above may have re-added overlays, so pick up the
+        # current installed db before syncing.
+        db = self._get_installed_db()
+        jobs = get_int_option(self.config, 'sync_jobs', 1)
+        max_per_host = get_int_option(self.config, 'max_per_host', 0)
+        self.output.debug("API.sync(); syncing %d overlay(s) with %d job(s)",
+                          5, len(to_sync), jobs)
+        scheduler = Scheduler(self.output, jobs, max_per_host)
+        results = scheduler.run([(ovl, functools.partial(db.sync, ovl),
+                                  self._sync_host(db, ovl))
+                                 for ovl in to_sync])
+
+        skipped = 0
+        for ovl in to_sync:
+            synced, error = results[ovl]
+            if error is None and synced is False:
+                skipped += 1
+                success.append((ovl, 'Overlay "' + ovl + '" is unchanged '
+                                'upstream, skipped.'))
+            elif error is None:
+                success.append((ovl,'Successfully synchronized overlay "' + ovl + '".'))
+            elif isinstance(error, CommandTimeout):
+                fatals.append((ovl,
+                    'Syncing overlay "%(repo)s" timed out.\nError was: %(err)s'
+                    % {'repo': ovl, 'err': error}))
+            else:
                 fatals.append((ovl,
                     'Failed to sync overlay "%(repo)s".\nError was: %(err)s'
                     % {'repo': ovl, 'err': error}))
@@ -457,6 +519,9 @@ class LaymanAPI(object):
                 message = '\nSucceeded:\n------\n'
                 for ovl, result in success:
                     message += result + '\n'
+                if skipped:
+                    message += '%d of %d overlay(s) unchanged upstream, '\
+                               'skipped.\n' % (skipped, len(to_sync))
                 self.output.info(message, 3)
 
             if warnings:
@@ -472,6 +537,7 @@ class LaymanAPI(object):
                 self.output.error(message)
 
         self.sync_results = (success, warnings, fatals)
+        self.sync_stats = self.config['stats'].records[first_record:]
 
         if update_news:
             self.update_news(repos)
@@ -479,6 +545,14 @@ class LaymanAPI(object):
         return fatals == []
 
 
+    def _sync_host(self, db, ovl):
+        """returns the host the overlay is synced from"""
+        try:
+            return get_host(db.select(ovl).sources[0].src)
+        except (UnknownOverlayException, IndexError):
+            return ''
+
+
     def fetch_remote_list(self):
         """
         Fetches the latest remote overlay list.
@@ -489,8 +563,8 @@ class LaymanAPI(object):
         try:
             dbreload, succeeded = self._get_remote_db().cache()
             self.output.debug(
-                'LaymanAPI.fetch_remote_list(); cache updated = %s'
-                % str(dbreload),8)
+                'LaymanAPI.fetch_remote_list(); cache updated = %s', 8,
+                dbreload)
         except Exception as error:
             self.output.error('Failed to fetch overlay list!\n Original Error'
                               ' was:\n%(err)s' % {'err': error})
@@ -501,8 +575,8 @@ class LaymanAPI(object):
 
     def get_available(self, dbreload=False):
         """returns the list of available overlays"""
-        self.output.debug('LaymanAPI.get_available() dbreload = %s'
-            % str(dbreload), 8)
+        self.output.debug('LaymanAPI.get_available() dbreload = %s', 8,
+            dbreload)
         if self._available_ids is None or dbreload:
             self._available_ids = self._get_remote_db(dbreload).list_ids()
         return self._available_ids[:] or ['None']
@@ -519,8 +593,10 @@ class LaymanAPI(object):
         """returns the list of installed overlays"""
         if not self._installed_db or dbreload:
             self._installed_db = DB(self.config)
-        self.output.debug("API._get_installed_db; len(installed) = %s, %s"
-            %(len(self._installed_db.list_ids()), self._installed_db.list_ids()), 5)
+        if self.output.is_enabled(5):
+            ids = self._installed_db.list_ids()
+            self.output.debug("API._get_installed_db; len(installed) = %s, %s",
+                5, len(ids), ids)
         return self._installed_db
 
 
@@ -543,7 +619,7 @@ class LaymanAPI(object):
         due to code taken from the packagekit backend.
         """
         self._error_messages.append(message)
-        self.output.debug("API._error(); _error_messages = %s" % str(self._error_messages), 4)
+        self.output.debug("API._error(); _error_messages = %s", 4, self._error_messages)
         if self.report_errors:
             print(message, file=self.config['stderr'])
 
@@ -555,7 +631,7 @@ class LaymanAPI(object):
         @rtype: list
         @return: list of error strings
         """
-        self.output.debug("API.get_errors(); _error_messages = %s" % str(self._error_messages), 4)
+        self.output.debug("API.get_errors(); _error_messages = %s", 4, self._error_messages)
         if len(self._error_messages):
             messages =  self._error_messages[:]
             self._error_messages = []
@@ -563,6 +639,17 @@ class LaymanAPI(object):
         return []
 
 
+    def get_stats(self):
+        """returns the timing records of all adds, syncs, source url
+        updates and remote list downloads done so far, see
+        layman.stats.StatsRecorder. sync_stats holds those of the
+        last sync() only.
+
+        @rtype list of dicts
+        """
+        return list(self.config['stats'].records)
+
+
     def supported_types(self):
         """returns a dictionary of all repository types,
         with boolean values"""
@@ -608,8 +695,8 @@ class LaymanAPI(object):
                         name = portdb.getRepositoryName(ovl_path)
                         if name:
                             repo_names.append(name)
-                    self.output.debug("LaymanAPI: update_news(); repo_names = "
-                        + str(repo_names), 4)
+                    self.output.debug("LaymanAPI: update_news(); "
+                        "repo_names = %s", 4, repo_names)
                     news_counts = count_unread_news(portdb, vardb, repo_names)
                     display_news_notifications(news_counts)
                 except ImportError:
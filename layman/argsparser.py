@@ -34,7 +34,7 @@ import sys
 
 from argparse import ArgumentParser
 
-from layman.config import BareConfig
+from layman.config import BareConfig, split_list
 from layman.constants import OFF
 from layman.version import VERSION
 
@@ -271,6 +271,22 @@ class ArgsParser(BareConfig):
                               'which protocols will be used when adding '
                               'overlays or updating their source URLs.')
 
+        etc_opts.add_argument('-j',
+                              '--jobs',
+                              dest = 'sync_jobs',
+                              type = int,
+                              help = 'Number of overlays to sync in parallel. '
+                              'Defaults to the sync_jobs setting of the '
+                              'config file.')
+
+        etc_opts.add_argument('--stats-file',
+                              dest = 'stats_file',
+                              help = 'Append one line of JSON with the wall '
+                              'time, result and transferred bytes of every '
+                              'add, sync and remote list download to this '
+                              'file. Defaults to the stats_file setting of '
+                              'the config file.')
+
         #-----------------------------------------------------------------
         # Debug Options
 
@@ -306,17 +322,17 @@ class ArgsParser(BareConfig):
         # Set only alternate config settings from the options
         if self.options['config'] is not None:
             self.defaults['config'] = self.options['config']
-            self.output.debug('ARGSPARSER: Got config file at ' + \
-                self.defaults['config'], 8)
+            self.output.debug('ARGSPARSER: Got config file at %s', 8,
+                self.defaults['config'])
         else: # fix the config path
             self.defaults['config'] = self.defaults['config'] \
                 % {'configdir': self.defaults['configdir']}
 
-        self._options['setup_help'] = self.options['setup_help']
+        self.set_option('setup_help', self.options['setup_help'])
 
         # Now parse the config file
-        self.output.debug('ARGSPARSER: Reading config file at ' + \
-            self.defaults['config'], 8)
+        self.output.debug('ARGSPARSER: Reading config file at %s', 8,
+            self.defaults['config'])
         self.read_config(self.defaults)
 
 
@@ -340,8 +356,21 @@ class ArgsParser(BareConfig):
         elif self.options['quietness']:
             self.set_option('quietness', self.options['quietness'])
 
+        # The options were changed in place above
+        self._invalidate()
+
 
     def __getitem__(self, key):
+        return self._lookup('__getitem__', self._resolve_item, key)
+
+
+    def _snapshot_keys(self):
+        keys = BareConfig._snapshot_keys(self)
+        keys.update(getattr(self, 'options', ()))
+        return keys
+
+
+    def _resolve_item(self, key):
 
         if key == 'storage':
             storage = ''
@@ -364,11 +393,19 @@ class ArgsParser(BareConfig):
                 protocol_filter = self.options[key]
             if self.config.has_option('MAIN', 'protocol_filter'):
                 protocol_filter = self.config.get('MAIN', 'protocol_filter')
+            # a config file without the key gives the default, str([])
+            protocol_filter = split_list(protocol_filter)
             if protocol_filter:
-                if not isinstance(protocol_filter, list):
-                    protocol_filter = [e.strip() for e in protocol_filter.split(',')]
                 return protocol_filter
 
+        if key in ('sync_jobs', 'stats_file'):
+            if (key in self.options.keys()
+                and not self.options[key] is None):
+                return self.options[key]
+            if self.config.has_option('MAIN', key):
+                return self.config.get('MAIN', key)
+            return self.defaults[key]
+
         if key == 'overlays':
             overlays = ''
             if (key in self.options.keys()
@@ -379,20 +416,20 @@ class ArgsParser(BareConfig):
             if len(overlays):
                 return  overlays
 
-        self.output.debug('ARGSPARSER: Retrieving options option: %s' % key, 9)
+        self.output.debug('ARGSPARSER: Retrieving options option: %s', 9, key)
 
         if (key in self.options.keys()
             and not self.options[key] is False):
             return self.options[key]
 
-        self.output.debug('ARGSPARSER: Retrieving config option: %s' % key, 9)
+        self.output.debug('ARGSPARSER: Retrieving config option: %s', 9, key)
 
         if self.config.has_option('MAIN', key):
             if key in self._defaults['t/f_options']:
                 return self.t_f_check(self.config.get('MAIN', key))
             return self.config.get('MAIN', key)
 
-        self.output.debug('ARGSPARSER: Retrieving option: %s' % key, 9)
+        self.output.debug('ARGSPARSER: Retrieving option: %s', 9, key)
 
         if key in self._options.keys():
             return self._options[key]
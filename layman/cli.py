@@ -26,7 +26,6 @@ __version__ = "$Id: cli.py 2011-01-15 23:52 PST Brian Dolbec$"
 
 import os, sys
 
-from layman.api import LaymanAPI
 from layman.utils import (decode_selection, encoder, get_encoding,
     pad, terminal_width)
 from layman.constants import (NOT_OFFICIAL_MSG, NOT_SUPPORTED_MSG,
@@ -132,11 +131,17 @@ class Main(object):
     '''
 
     def __init__(self, config):
+        # Imported here so that e.g. "layman -V" does not load the
+        # databases, the download and the gpg modules
+        from layman.api import LaymanAPI
+        from layman.daemon import connect
+
         self.config = config
         self.output = config['output']
-        self.api = LaymanAPI(config,
-                             report_errors=False,
-                             output=config.output)
+        # Use a running layman-daemon and its warm databases if there is one
+        self.api = connect(config) or LaymanAPI(config,
+                                                report_errors=False,
+                                                output=config.output)
         # Given in order of precedence
         self.actions = [('fetch',      'Fetch'),
                         ('add',        'Add'),
@@ -151,7 +156,7 @@ class Main(object):
                         ('list_local', 'ListLocal'),]
 
     def __call__(self):
-        self.output.debug("CLI.__call__(): self.config.keys()"
+        self.output.debug(lambda: "CLI.__call__(): self.config.keys()"
             " %s" % str(self.config.keys()), 6)
         # blank newline  -- no " *"
         self.output.notice('')
@@ -188,21 +193,21 @@ class Main(object):
         act=set([x[0] for x in self.actions])
         k=set([x for x in self.config.keys()])
         a=act.intersection(k)
-        self.output.debug('Actions = %s' % str(a), 4)
+        self.output.debug('Actions = %s', 4, a)
         for action in self.actions:
-            self.output.debug('Checking for action %s' % action[0], 4)
+            self.output.debug('Checking for action %s', 4, action[0])
 
             if action[0] in self.config.keys():
                 result += getattr(self, action[1])()
                 _errors = self.api.get_errors()
                 if _errors:
                     self.output.debug("CLI: found errors performing "
-                        "action %s" % action[0], 2)
+                        "action %s", 2, action[0])
                     action_errors.append((action[0], _errors))
                     result = -1  # So it cannot remain 0, i.e. success
             results.append(result)
-            self.output.debug('Completed action %s, result %s'
-                % (action[0], result==0), 4)
+            self.output.debug('Completed action %s, result %s', 4,
+                action[0], result==0)
 
         self.output.debug('Checking for action errors', 4)
         if action_errors:
@@ -37,7 +37,13 @@ else:
     # Import for Python2
     import ConfigParser
 
+if sys.hexversion >= 0x30300f0:
+    from types import MappingProxyType as _frozen
+else:
+    _frozen = dict
+
 from layman.output import Message
+from layman.stats import StatsRecorder
 from layman.utils import path
 
 # establish the eprefix, initially set so eprefixify can
@@ -47,6 +53,26 @@ EPREFIX = "@GENTOO_PORTAGE_EPREFIX@"
 if "GENTOO_PORTAGE_EPREFIX" in EPREFIX:
     EPREFIX = ''
 
+# Options holding a list, given as a comma or space separated string in
+# the config file
+LIST_OPTIONS = ('protocol_filter', 'support_url_updates')
+
+
+def split_list(value):
+    """returns a list option as a list
+
+    Also undoes the str() ConfigParser applies to the list defaults
+    it was created with, e.g. "['git', 'https']".
+    """
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    for char in '[]\'",':
+        value = value.replace(char, ' ')
+    return value.split()
+
+
 def read_layman_config(config=None, defaults=None, output=None):
     """reads the config file defined in defaults['config']
     and updates the config
@@ -89,6 +115,9 @@ class BareConfig(object):
         else:
             self.root = root
 
+        # The resolved options, see _lookup()
+        self._snapshots = {}
+
         self._defaults = {
             'configdir': path([self.root, EPREFIX,'/etc/layman']),
             'config'    : '%(configdir)s/layman.cfg',
@@ -99,6 +128,7 @@ class BareConfig(object):
             'protocol_filter': [],
             'auto_sync': 'No',
             'check_official': 'Yes',
+            'check_upstream': 'Yes',
             'conf_type': 'repos.conf',
             'db_type': 'xml',
             'require_repoconfig': 'Yes',
@@ -130,7 +160,9 @@ class BareConfig(object):
             'rsync_command': path([self.root, EPREFIX,'/usr/bin/rsync']),
             'svn_command': path([self.root, EPREFIX,'/usr/bin/svn']),
             'tar_command': path([self.root, EPREFIX,'/bin/tar']),
-            't/f_options': ['check_official', 'clean_archive', 'nocheck', 'require_repoconfig'],
+            't/f_options': ['check_official', 'check_upstream',
+                            'clean_archive', 'nocheck', 'require_repoconfig',
+                            'use_daemon'],
             'bzr_addopts' : '',
             'bzr_syncopts' : '',
             'cvs_addopts' : '',
@@ -138,6 +170,7 @@ class BareConfig(object):
             'darcs_addopts' : '',
             'darcs_syncopts' : '',
             'git_addopts' : '',
+            'git_fetchopts' : '',
             'git_syncopts' : '',
             'mercurial_addopts' : '',
             'mercurial_syncopts' : '',
@@ -161,9 +194,34 @@ class BareConfig(object):
             'tar_postsync' : '',
             'g-common_postsync' : '',
             'g-sorcery_postsync' : '',
+            'bzr_timeout' : '0',
+            'cvs_timeout' : '0',
+            'darcs_timeout' : '0',
+            'git_timeout' : '0',
+            'mercurial_timeout' : '0',
+            'rsync_timeout' : '0',
+            'squashfs_timeout': '0',
+            'svn_timeout' : '0',
+            'tar_timeout' : '0',
+            'g-common_timeout' : '0',
+            'g-sorcery_timeout' : '0',
+            'git_clone_mode': 'full',
+            'git_depth': '1',
+            'git_object_cache': '',
             'git_user': 'layman',
             'git_email': 'layman@localhost',
             'support_url_updates': ['Bzr', 'cvs', 'Git', 'Mercurial', 'Subversion'],
+            'sync_jobs': '1',
+            'max_per_host': '4',
+            'fetch_jobs': '4',
+            'retries': '2',
+            'retry_delay': '2',
+            'stats_file': '',
+            'daemon_socket': '%(storage)s/layman.sock',
+            'use_daemon': 'Yes',
+            'cache_compression': 'none',
+            'sqlite_journal_mode': '',
+            'sqlite_synchronous': '',
             }
         self._options = {
             'config': config if config else self._defaults['config'],
@@ -177,6 +235,7 @@ class BareConfig(object):
             'verbose': verbose,
             'quiet': quiet,
             'custom_news_func': None,
+            'stats': StatsRecorder(),
             }
         self._set_quietness(quietness)
         self.config = None
@@ -193,20 +252,21 @@ class BareConfig(object):
         self.config = ConfigParser.ConfigParser(defaults)
         self.config.add_section('MAIN')
         read_layman_config(self.config, defaults, self._options['output'])
+        self._invalidate()
 
 
     def keys(self):
         '''Special handler for the configuration keys.
         '''
         self._options['output'].debug(
-            'Retrieving %s options' % self.__class__.__name__, 9)
+            'Retrieving %s options', 9, self.__class__.__name__)
         keys = [i for i in self._options]
         self._options['output'].debug(
-            'Retrieving %s defaults' % self.__class__.__name__, 9)
+            'Retrieving %s defaults', 9, self.__class__.__name__)
         keys += [i for i in self._defaults
                  if not i in keys]
         self._options['output'].debug(
-            'Retrieving %s done...' % self.__class__.__name__, 9)
+            'Retrieving %s done...', 9, self.__class__.__name__)
         return keys
 
 
@@ -225,6 +285,7 @@ class BareConfig(object):
     def set_option(self, option, value):
         """Sets an option to the value"""
         self._options[option] = value
+        self._invalidate()
         # handle quietness
         if option == 'quiet':
             if self._options['quiet']:
@@ -235,6 +296,17 @@ class BareConfig(object):
         if option == 'quietness':
             self._set_quietness(value)
 
+    def save_options(self):
+        """returns the options set so far, see restore_options()"""
+        return dict(self._options)
+
+    def restore_options(self, saved):
+        """undoes the set_option() calls made since save_options()
+        returned saved"""
+        self._options.clear()
+        self._options.update(saved)
+        self._invalidate()
+
     def _set_quietness(self, value):
             self._options['output'].set_info_level(value)
             self._options['output'].set_warn_level(value)
@@ -244,8 +316,56 @@ class BareConfig(object):
         return self._get_(key)
 
     def _get_(self, key):
+        return self._lookup('_get_', self._resolve_option, key)
+
+    def _lookup(self, name, resolve, key):
+        """returns an option from the snapshot of all options resolved
+        by resolve(), built on the first lookup after the config was
+        read or changed. Lookups are plain dict hits from then on.
+
+        @param name: the name of the snapshot.
+        @param resolve: function returning the value of an option.
+        """
+        snapshot = self._snapshots.get(name)
+        if snapshot is None:
+            snapshot = self._build_snapshot(resolve)
+            self._snapshots[name] = snapshot
+        if key in snapshot:
+            return snapshot[key]
+        return resolve(key)
+
+    def _build_snapshot(self, resolve):
+        """resolves every known option: interpolated strings,
+        booleans and parsed lists
+
+        @rtype read-only dict
+        """
+        snapshot = {}
+        for key in self._snapshot_keys():
+            try:
+                value = resolve(key)
+            except Exception:
+                # Left to fail when it is actually read
+                continue
+            if key in LIST_OPTIONS:
+                value = split_list(value)
+            snapshot[key] = value
+        return _frozen(snapshot)
+
+    def _snapshot_keys(self):
+        keys = set(self._defaults)
+        keys.update(self._options)
+        if self.config:
+            keys.update(self.config.options('MAIN'))
+        return keys
+
+    def _invalidate(self):
+        """drops the resolved options after a change"""
+        self._snapshots = {}
+
+    def _resolve_option(self, key):
         self._options['output'].debug(
-            'Retrieving %s option: %s' % (self.__class__.__name__, key), 9)
+            'Retrieving %s option: %s', 9, self.__class__.__name__, key)
         if key == 'overlays':
             overlays = ''
             if (key in self._options
@@ -340,6 +460,7 @@ class OptionConfig(BareConfig):
                 self._set_quietness(options['quietness'])
                 options.pop('quietness')
             self._options.update(options)
+            self._invalidate()
         return
 
     def update_defaults(self, new_defaults):
@@ -349,4 +470,5 @@ class OptionConfig(BareConfig):
         """
         if new_defaults is not None:
             self._defaults.update(new_defaults)
+            self._invalidate()
         return
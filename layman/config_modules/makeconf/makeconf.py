@@ -91,9 +91,10 @@ class ConfigHandler:
         self.read(True)
 
 
-    def add(self, overlay):
+    def add(self, overlay, no_write=False):
         '''
-        Add an overlay to make.conf.
+        Add an overlay to make.conf. With no_write the file is only
+        written by a later write() call.
 
         >>> import tempfile
         >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
@@ -121,12 +122,15 @@ class ConfigHandler:
         >>> shutil.rmtree(tmpdir)
         '''
         self.overlays.append(overlay)
+        if no_write:
+            return True
         return self.write()
 
 
-    def delete(self, overlay):
+    def delete(self, overlay, no_write=False):
         '''
-        Delete an overlay from make.conf.
+        Delete an overlay from make.conf. With no_write the file is only
+        written by a later write() call.
 
         >>> import tempfile
         >>> tmpdir = tempfile.mkdtemp(prefix="laymantmp_")
@@ -156,30 +160,55 @@ class ConfigHandler:
         self.overlays = [i
                          for i in self.overlays
                          if i.name != overlay.name]
+        if no_write:
+            return True
         return self.write()
 
 
-    def disable(self, overlay):
+    def disable(self, overlay, no_write=False):
         '''
         Move overlay to the $DISABLED var of make.conf.
 
         @params overlay: layman.overlay.Overlay object.
+        @params no_write: leave writing make.conf to a later write() call.
         @rtype bool: represents success or failure to write to make.conf.
         '''
-        return self.write(disable=overlay.name)
+        ovl = path([self.storage, overlay.name])
+        if overlay.name in [i.name for i in self.overlays]:
+            if ovl not in self.disabled:
+                self.disabled.append(ovl)
+            else:
+                msg = 'Overlay "%(repo)s" is already disabled!'\
+                        % ({'repo': overlay.name})
+                self.output.error(msg)
+        if no_write:
+            return True
+        return self.write()
 
 
-    def enable(self, overlay):
+    def enable(self, overlay, no_write=False):
         '''
         Move overlay to the $ENABLED var of make.conf.
 
         @params overlay: layman.overlay.Overlay object.
+        @params no_write: leave writing make.conf to a later write() call.
         @rtype bool: represents success or failure to write to make.conf.
         '''
-        return self.write(enable=overlay.name)
+        ovl = path([self.storage, overlay.name])
+        if overlay.name in [i.name for i in self.overlays]:
+            if ovl in self.disabled:
+                self.disabled.remove(ovl)
+            else:
+                msg = 'Overlay "%(repo)s" is already enabled!'\
+                        % ({'repo': overlay.name})
+                self.output.error(msg)
+                return False
+        if no_write:
+            return True
+        return self.write()
 
 
-    def update(self, overlay):
+    def update(self, overlay, no_write=False):
         '''
         Stub function necessary for RepoConfManager class.
         '''
@@ -268,7 +297,7 @@ class ConfigHandler:
         return True
 
 
-    def write(self, disable=None, enable=None):
+    def write(self):
         '''
         Write the list of registered overlays to /var/layman/make.conf.
 
@@ -311,28 +340,8 @@ class ConfigHandler:
 
         for i in self.overlays:
             ovl = path([self.storage, i.name])
-            # We want to enable this overlay:
-            if i.name == enable:
-                if ovl in self.disabled:
-                    self.disabled.remove(ovl)
-                    enabled.append(ovl)
-                else:
-                    msg = 'Overlay "%(repo)s" is already enabled!'\
-                            % ({'repo': i.name})
-                    self.output.error(msg)
-                    return False
-            # We want to disable this overlay:
-            elif i.name == disable:
-                if ovl not in self.disabled:
-                    self.disabled.append(ovl)
-                else:
-                    msg = 'Overlay "%(repo)s" is already disabled!'\
-                            % ({'repo': i.name})
-                    self.output.error(msg)
-            # We want to keep it as-is:
-            else:
-                if ovl not in self.disabled:
-                    enabled.append(ovl)
+            if ovl not in self.disabled:
+                enabled.append(ovl)
 
         self.disabled.sort()
 
@@ -62,6 +62,8 @@ class ConfigHandler:
         self.storage = config['storage']
         self.repo_config = None
         self.rebuild = rebuild
+        # overlays deleted through this handler
+        self.removed = set()
 
         self.read()
 
@@ -111,11 +113,13 @@ class ConfigHandler:
 
         @param overlay: layman.overlay.Overlay instance.
         @param no_write: boolean default=False usedto prevent circular recursion
-            when add() is called from write()
+            when add() is called from write(), also used to leave writing
+            the config file to a later write() call.
         @return boolean: reflects a successful/failed write to the config file.
         '''
         if self.repo_conf and self.repo_conf.has_section(overlay.name):
             return
+        self.removed.discard(overlay.name)
         self.repo_conf.add_section(overlay.name)
         self.repo_conf.set(overlay.name, 'priority', str(overlay.priority))
         self.repo_conf.set(overlay.name, 'location', path((self.storage, overlay.name)))
@@ -135,39 +139,44 @@ class ConfigHandler:
         return
 
 
-    def delete(self, overlay):
+    def delete(self, overlay, no_write=False):
         '''
         Deletes overlay information from the specified config file.
 
         @param overlay: layman.overlay.Overlay instance.
+        @param no_write: boolean default=False, leaves writing the config
+            file to a later write() call.
         @return boolean: reflects a successful/failed write to the config file.
         '''
         self.repo_conf.remove_section(overlay.name)
+        self.removed.add(overlay.name)
 
-        return self.write(delete=overlay.name)
+        if not no_write:
+            return self.write(delete=overlay.name)
+        return True
 
 
-    def disable(self, overlay):
+    def disable(self, overlay, no_write=False):
         '''
         A wrapper for the delete() function to comply with RepoConfManager class.
 
         @param overlay: layman.overlay.Overlay instance.
         @rtype boolean: reflects a successful/failed write to the config file.
         '''
-        return self.delete(overlay)
+        return self.delete(overlay, no_write=no_write)
 
 
-    def enable(self, overlay):
+    def enable(self, overlay, no_write=False):
         '''
         A wrapper for the add() function to comply with RepoConfManager class.
 
         @param overlay: layman.overlay.Overlay instance.
         @rtype boolean: reflects a successful/failed write to the config file.
         '''
-        return self.add(overlay)
+        return self.add(overlay, no_write=no_write)
 
 
-    def update(self, overlay):
+    def update(self, overlay, no_write=False):
         '''
         Updates the source URL for the specified config file.
 
@@ -176,7 +185,9 @@ class ConfigHandler:
         '''
         self.repo_conf.set(overlay.name, 'sync-uri', overlay.sources[0].src)
 
-        return self.write()
+        if not no_write:
+            return self.write()
+        return True
 
 
     def write(self, delete=None):
@@ -199,7 +210,7 @@ class ConfigHandler:
                     if ('disable' in self.config.keys() and not
                         self.config['disable'][0].lower() == 'all'):
                         for i in sorted(self.overlays):
-                            if not i == delete:
+                            if not i == delete and not i in self.removed:
                                 self.add(self.overlays[i], no_write=True)
                 self.repo_conf.write(laymanconf)
             return True
@@ -0,0 +1,478 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN DAEMON
+#################################################################################
+# File:       daemon.py
+#
+#             Keeps one LaymanAPI instance in memory and serves it over
+#             a unix domain socket.
+#
+# Copyright:
+#             Distributed under the terms of the GNU General Public License v2
+#
+
+'''Long running layman process and the client talking to it.
+
+The protocol is one JSON object per line. A request names the API
+method, its arguments, the caller's options and output levels, e.g.
+
+  {"method": "sync", "args": [["foo"]], "kwargs": {}, "options": {...},
+   "levels": [4, 4, 4, 0]}
+
+While the method runs, what it prints is sent as it comes as
+
+  {"output": "..."}
+
+and the request is answered with
+
+  {"result": true, "error": null, "output": ""}
+
+Bytes are sent as {"__bytes__": base64}.
+'''
+
+from __future__ import unicode_literals
+
+import base64
+import functools
+import glob
+import json
+import os
+import socket
+import sys
+import threading
+
+from layman.api import LaymanAPI
+from layman.config import OptionConfig
+from layman.stats import StatsRecorder
+from layman.version import VERSION
+
+# The LaymanAPI methods served by the daemon
+METHODS = frozenset([
+    'add_repos', 'delete_repos', 'disable_repos', 'enable_repos',
+    'fetch_remote_list', 'get_available', 'get_errors', 'get_info_list',
+    'get_info_str', 'get_installed', 'get_stats', 'is_installed', 'is_repo',
+    'readd_repos', 'reload', 'supported_types', 'sync',
+    ])
+
+# Config options the loaded databases depend on. Callers using other
+# values than the daemon are refused and work on their own, the values
+# of all other options are taken over for the caller's request.
+DB_OPTIONS = ('cache', 'config', 'configdir', 'db_type',
+              'gpg_detached_lists', 'gpg_signed_lists', 'installed',
+              'local_list', 'overlay_defs', 'overlays', 'storage')
+
+# Options holding a path, compared after resolving links
+PATH_OPTIONS = ('cache', 'config', 'configdir', 'installed', 'local_list',
+                'overlay_defs', 'storage')
+
+
+class DaemonError(Exception):
+    '''The daemon refused or failed a request.'''
+
+
+def _encode(value):
+    '''json.dumps() default for what JSON can not represent.'''
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    return str(value)
+
+
+def _decode(obj):
+    '''json.loads() object_hook undoing _encode().'''
+    if len(obj) == 1 and '__bytes__' in obj:
+        return base64.b64decode(obj['__bytes__'])
+    return obj
+
+
+def _dumps(obj):
+    return (json.dumps(obj, default=_encode) + '\n').encode('utf-8')
+
+
+def _loads(line):
+    return json.loads(line.decode('utf-8'), object_hook=_decode)
+
+
+def _same_path(first, second):
+    return os.path.realpath(first or '') == os.path.realpath(second or '')
+
+
+def _plain(value):
+    '''The value as it comes out of JSON, to compare it with the
+    caller's.'''
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+def _caller_options(config):
+    '''The resolved values of all options of config JSON can carry.'''
+    options = {}
+    for key in config.keys():
+        value = config[key]
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        options[key] = value
+    return options
+
+
+def _output_levels(output):
+    return (output.info_lev, output.warn_lev, output.note_lev,
+            output.debug_lev)
+
+
+def _set_output_levels(output, levels):
+    output.set_info_level(levels[0])
+    output.set_warn_level(levels[1])
+    output.set_note_level(levels[2])
+    output.set_debug_level(levels[3])
+
+
+class _OutputStream(object):
+    '''Sends what a request prints to the client as it is written, one
+    {"output": ...} line per complete line of text.'''
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._lock = threading.Lock()
+        self._pending = ''
+
+
+    def write(self, text):
+        with self._lock:
+            self._pending += text
+            if '\n' in self._pending:
+                lines, sep, self._pending = self._pending.rpartition('\n')
+                self._send(lines + sep)
+
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._send(self._pending)
+                self._pending = ''
+
+
+    def _send(self, text):
+        try:
+            self._wfile.write(_dumps({'output': text}))
+            self._wfile.flush()
+        except (IOError, OSError):
+            # The caller went away, the request is finished all the same
+            pass
+
+
+class LaymanDaemon(object):
+    '''Serves one warm LaymanAPI instance to DaemonClient connections.
+
+    Requests are run one at a time. The installed and the remote
+    databases are reloaded before a request only if another process
+    changed their files since the last one.
+    '''
+
+    def __init__(self, config, path=None):
+        self.config = config
+        self.output = config['output']
+        self.path = path or config['daemon_socket']
+        self.api = LaymanAPI(config, report_errors=False,
+                             output=self.output)
+        self._lock = threading.Lock()
+        self._state = None
+        self.server = None
+
+
+    def serve_forever(self):
+        '''Listens on the socket until shutdown() is called.'''
+        if sys.hexversion >= 0x30000f0:
+            import socketserver
+        else:
+            import SocketServer as socketserver
+
+        self._remove_stale_socket()
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    stream = _OutputStream(self.wfile)
+                    response = daemon.handle(line, stream)
+                    stream.flush()
+                    self.wfile.write(_dumps(response))
+                    self.wfile.flush()
+
+        class Server(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        # Only the user running the daemon may talk to it
+        old_umask = os.umask(0o177)
+        try:
+            self.server = Server(self.path, Handler)
+        finally:
+            os.umask(old_umask)
+        self.output.info('layman-daemon listening on %s' % self.path, 2)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+    def _remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except (IOError, OSError):
+            # Left behind by a daemon that died
+            os.unlink(self.path)
+        else:
+            raise DaemonError('Another layman-daemon is listening on %s'
+                              % self.path)
+        finally:
+            probe.close()
+
+
+    def handle(self, line, stream=None):
+        '''
+        Runs one request.
+
+        @param line: the JSON encoded request.
+        @param stream: file-like object what the method prints is written
+        to as it comes, else it is collected in the response.
+        @rtype dict: the response.
+        '''
+        try:
+            request = _loads(line)
+            method = request['method']
+            args = request.get('args', [])
+            kwargs = request.get('kwargs', {})
+            options = request.get('options', {})
+            levels = request.get('levels')
+            if not isinstance(options, dict):
+                raise TypeError('options must be an object')
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            return {'result': None, 'error': 'Bad request: %s' % error,
+                    'output': ''}
+
+        if method != 'hello' and not method in METHODS:
+            return {'result': None, 'output': '',
+                    'error': 'Unknown method "%s"' % method}
+
+        with self._lock:
+            if self._state != self._files_state():
+                self.api.reload()
+            # Compared while no other request has its options applied
+            changed, refused = self._compare_options(options)
+            if refused:
+                return {'result': None, 'output': '',
+                        'error': 'The daemon uses a different %s'
+                                 % ', '.join(refused)}
+            if method == 'hello':
+                return {'result': {'version': VERSION, 'pid': os.getpid()},
+                        'error': None, 'output': ''}
+            saved = self._apply_options(changed, levels)
+            self.output.buffer_output(stream)
+            error = None
+            result = None
+            try:
+                result = getattr(self.api, method)(*args, **kwargs)
+            except Exception as err:
+                error = '%s: %s' % (err.__class__.__name__, str(err))
+            finally:
+                text = self.output.release_output()
+                self._restore_options(saved)
+                self._state = self._files_state()
+        return {'result': result, 'error': error, 'output': text}
+
+
+    def _compare_options(self, options):
+        '''
+        Compares the caller's options with the daemon's.
+
+        @rtype tuple: (dict of the options to take over for the request,
+        sorted list of the DB_OPTIONS the caller has other values of).
+        '''
+        changed = {}
+        refused = []
+        for key, value in options.items():
+            if key in PATH_OPTIONS:
+                same = _same_path(value, self.config[key])
+            else:
+                same = value == _plain(self.config[key])
+            if same:
+                continue
+            if key in DB_OPTIONS:
+                refused.append(key)
+            else:
+                changed[key] = value
+        return changed, sorted(refused)
+
+
+    def _files_state(self):
+        '''The modification times of the installed db and the cached
+        remote lists, to notice changes made by other processes.'''
+        paths = [self.config['installed']]
+        paths += sorted(glob.glob(self.config['cache'] + '*'))
+        state = []
+        for name in paths:
+            try:
+                state.append((name, os.stat(name).st_mtime))
+            except OSError:
+                state.append((name, None))
+        return state
+
+
+    def _apply_options(self, options, levels):
+        saved = {'levels': _output_levels(self.output),
+                 'options': self.config.save_options()}
+        for key, value in options.items():
+            self.config.set_option(key, value)
+        # Only the records of this request, the daemon keeps none
+        self.config.set_option('stats', StatsRecorder())
+        if levels:
+            _set_output_levels(self.output, levels)
+        self.output.set_colorize(not self.config['nocolor'])
+        return saved
+
+
+    def _restore_options(self, saved):
+        self.config.restore_options(saved['options'])
+        _set_output_levels(self.output, saved['levels'])
+        self.output.set_colorize(not self.config['nocolor'])
+
+
+class DaemonClient(object):
+    '''Stands in for a LaymanAPI instance by calling the methods of the
+    one held by layman-daemon. What the daemon printed is printed to the
+    caller's output.'''
+
+    def __init__(self, config, path=None):
+        self.config = config
+        self.output = config['output']
+        self.path = path or config['daemon_socket']
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(self.path)
+        self._file = self._socket.makefile('rb')
+
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+    def __getattr__(self, name):
+        if name in METHODS:
+            return functools.partial(self.call, name)
+        raise AttributeError(name)
+
+
+    def hello(self):
+        return self.call('hello')
+
+
+    def call(self, method, *args, **kwargs):
+        '''
+        Runs an API method in the daemon, with all options of the caller.
+        What it prints is printed as it comes.
+
+        @raise DaemonError: if the daemon refused the request or the
+        method raised an exception.
+        '''
+        self._socket.sendall(_dumps({'method': method, 'args': args,
+                                     'kwargs': kwargs,
+                                     'options': _caller_options(self.config),
+                                     'levels': _output_levels(self.output)}))
+        while True:
+            line = self._file.readline()
+            if not line:
+                raise DaemonError('layman-daemon closed the connection')
+            response = _loads(line)
+            if response.get('output'):
+                self.output.std_out.write(response['output'])
+                self.output.std_out.flush()
+            if 'result' in response:
+                break
+        if response.get('error'):
+            raise DaemonError(response['error'])
+        return response.get('result')
+
+
+def connect(config):
+    '''
+    Connects to a running layman-daemon serving the same config and
+    storage as the caller's.
+
+    @rtype DaemonClient or None if there is no usable daemon.
+    '''
+    if not config['use_daemon'] or not config['daemon_socket']:
+        return None
+    if not os.path.exists(config['daemon_socket']):
+        return None
+    try:
+        client = DaemonClient(config)
+    except (IOError, OSError) as error:
+        config['output'].debug('daemon.connect(); no daemon at %s: %s', 4,
+                               config['daemon_socket'], error)
+        return None
+    try:
+        client.hello()
+    except (IOError, OSError, ValueError, DaemonError) as error:
+        config['output'].debug('daemon.connect(); not using the daemon: %s',
+                               4, error)
+        client.close()
+        return None
+    return client
+
+
+class Main(object):
+    '''Runs layman-daemon in the foreground.'''
+
+    def __init__(self, root=None):
+        self.root = root
+
+
+    def args_parser(self):
+        import argparse
+        parser = argparse.ArgumentParser(prog='layman-daemon',
+            description='Serves the layman API over a unix domain socket.')
+        parser.add_argument('-c', '--config',
+            help='the path to config file')
+        parser.add_argument('-s', '--socket',
+            help='the socket to listen on, defaults to the daemon_socket '
+                 'setting of the config file')
+        parser.add_argument('--version', action='version',
+            version='%(prog)s ' + VERSION)
+        return parser.parse_args()
+
+
+    def __call__(self):
+        args = self.args_parser()
+        options = None
+        if args.config:
+            options = {'config': args.config}
+        config = OptionConfig(options=options, root=self.root)
+        # fix the config path
+        defaults = config.get_defaults()
+        defaults['config'] = defaults['config'] \
+            % {'configdir': defaults['configdir']}
+        config.update_defaults({'config': defaults['config']})
+        config.read_config(defaults)
+
+        daemon = LaymanDaemon(config, args.socket)
+        try:
+            daemon.serve_forever()
+        except DaemonError as error:
+            config['output'].die(str(error))
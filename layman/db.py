@@ -27,8 +27,10 @@ __version__ = "$Id: db.py 309 2007-04-09 16:23:38Z wrobel $"
 #
 #-------------------------------------------------------------------------------
 
+import json
 import os, os.path
 
+from   layman.compatibility     import fileopen
 from   layman.utils             import path, delete_empty_directory, get_ans
 from   layman.dbbase            import DbBase
 from   layman.repoconfmanager   import RepoConfManager
@@ -48,7 +50,8 @@ class DB(DbBase):
         self.output = config['output']
 
         self.path = config['installed']
-        self.output.debug("DB.__init__(): config['installed'] = %s" % self.path, 3)
+        self.output.debug("DB.__init__(): config['installed'] = %s", 3,
+                          self.path)
 
         if config['nocheck']:
             ignore = 2
@@ -65,6 +68,10 @@ class DB(DbBase):
 
         self.repo_conf = RepoConfManager(self.config, self.overlays)
 
+        # see start_batch()
+        self._batch = False
+        self._pending_write = None
+
         self.output.debug('DB handler initiated', 6)
 
         # check and handle the name change
@@ -104,6 +111,43 @@ class DB(DbBase):
         return True
 
 
+    def _write_db(self, remove=False):
+        '''
+        Writes the installed db, or just remembers to do so at the end
+        of a batch.
+        '''
+        if not self._batch:
+            self.write(self.path, remove=remove)
+        elif self._pending_write is None:
+            self._pending_write = remove
+        else:
+            self._pending_write = self._pending_write and remove
+
+
+    def start_batch(self):
+        '''
+        Starts a batch of add/delete/enable/disable operations. Until
+        commit_batch() is called the changes are only applied in memory,
+        the installed db and the repo configs are written once at the end.
+        '''
+        self._batch = True
+        self._pending_write = None
+        self.repo_conf.start_batch()
+
+
+    def commit_batch(self):
+        '''
+        Writes out the changes made since start_batch().
+
+        @rtype bool: reflects success or failure to write the repo configs.
+        '''
+        self._batch = False
+        if self._pending_write is not None:
+            self.write(self.path, remove=self._pending_write)
+            self._pending_write = None
+        return self.repo_conf.commit_batch()
+
+
     def add(self, overlay):
         '''
         Add an overlay to the local list of overlays.
@@ -111,12 +155,16 @@ class DB(DbBase):
         if overlay.name not in self.overlays.keys():
             if not self._check_official(overlay):
                 return False
-            result = overlay.add(self.config['storage'])
+            with self.config['stats'].measure(self.config, 'add',
+                    overlay.name, type=','.join(overlay.source_types())) \
+                    as stats:
+                result = overlay.add(self.config['storage'])
+                stats['result'] = result
             if result == 0:
                 if 'priority' in self.config.keys():
                     overlay.set_priority(self.config['priority'])
                 self.overlays[overlay.name] = overlay
-                self.write(self.path)
+                self._write_db()
                 repo_ok = self.repo_conf.add(overlay)
                 if False in repo_ok:
                     return False
@@ -147,9 +195,10 @@ class DB(DbBase):
         '''
         if overlay.name in self.overlays.keys():
             overlay.delete(self.config['storage'])
+            self._write_sync_state(overlay.name, None)
             repo_ok = self.repo_conf.delete(overlay)
             self.remove(overlay, self.path)
-            self.write(self.path, remove=True)
+            self._write_db(remove=True)
         else:
             self.output.error('No local overlay named "' + overlay.name + '"!')
             return False
@@ -196,10 +245,15 @@ class DB(DbBase):
         @params available_srcs: set of available source URLs.
         '''
 
-        source, result = self.overlays[overlay.name].update(self.config['storage'],
-                                                    available_srcs)
+        with self.config['stats'].measure(self.config, 'update',
+                overlay.name, type=','.join(overlay.source_types())) \
+                as stats:
+            source, result = self.overlays[overlay.name].update(
+                self.config['storage'], available_srcs)
+            stats['result'] = 0 if result else 1
         result = [result]
         self.overlays[overlay.name].sources = source
+        self.overlays.mark_dirty(overlay.name)
         result.extend(self.repo_conf.update(self.overlays[overlay.name]))
         self.write(self.path)
 
@@ -210,11 +264,89 @@ class DB(DbBase):
 
 
     def sync(self, overlay_name):
-        '''Synchronize the given overlay.'''
+        '''
+        Synchronize the given overlay.
+
+        @rtype bool: False if the sync was skipped because the overlay
+        did not change upstream since its last sync.
+        '''
 
         overlay = self.select(overlay_name)
+        with self.config['stats'].measure(self.config, 'sync', overlay_name,
+                type=','.join(overlay.source_types())) as stats:
+            return self._sync(overlay, stats)
+
+
+    def _sync(self, overlay, stats):
+        overlay_name = overlay.name
+        state = None
+        if self.config['check_upstream']:
+            state = self._upstream_state(overlay)
+            if state is not None and \
+                    state == self._read_sync_state(overlay_name) and \
+                    os.path.isdir(path([self.config['storage'],
+                                        overlay_name])):
+                self.output.info('Overlay "%(repo)s" is unchanged upstream '
+                    '(%(rev)s), skipping the sync.'
+                    % {'repo': overlay_name, 'rev': state['revision']}, 3)
+                stats.update(result=0, skipped=True)
+                return False
+
         result = overlay.sync(self.config['storage'])
+        stats['result'] = result
         if result:
+            self._write_sync_state(overlay_name, None)
             raise Exception('Syncing overlay "' + overlay_name +
                             '" returned status ' + str(result) + '!' +
                             '\ndb.sync()')
+        if state is not None:
+            self._write_sync_state(overlay_name, state)
+        return True
+
+
+    def _upstream_state(self, overlay):
+        '''
+        Returns what identifies the upstream state of an overlay: its
+        source and the current upstream revision.
+
+        @rtype dict or None if the revision can not be looked up.
+        '''
+        revision = overlay.upstream_revision()
+        if not revision:
+            return None
+        source = overlay.sources[0]
+        return {'source': source.src, 'branch': source.branch,
+                'revision': revision}
+
+
+    def _sync_state_path(self, overlay_name):
+        return path([self.config['storage'], '.sync-state',
+                     overlay_name + '.json'])
+
+
+    def _read_sync_state(self, overlay_name):
+        try:
+            with fileopen(self._sync_state_path(overlay_name)) as state:
+                return json.load(state)
+        except (IOError, OSError, ValueError):
+            return None
+
+
+    def _write_sync_state(self, overlay_name, state):
+        '''
+        Stores the upstream state an overlay was synced to, or forgets
+        it if state is None.
+        '''
+        spath = self._sync_state_path(overlay_name)
+        try:
+            if state is None:
+                if os.path.exists(spath):
+                    os.unlink(spath)
+                return
+            if not os.path.isdir(os.path.dirname(spath)):
+                os.makedirs(os.path.dirname(spath))
+            with fileopen(spath, 'w') as out_file:
+                out_file.write(json.dumps(state))
+        except (IOError, OSError) as error:
+            self.output.debug('DB._write_sync_state(); failed for %s: %s', 4,
+                overlay_name, error)
@@ -29,7 +29,7 @@ __version__ = "$Id: json.py 273 2015-07-10 10:10:49Z twitch153 $"
 import json
 import sys
 
-from   layman.compatibility      import fileopen
+from   layman.compatibility      import encode, fileopen
 from   layman.overlays.overlay   import Overlay
 
 
@@ -103,8 +103,11 @@ class DBHandler(object):
         load = json.loads(document)['repo']
 
         for ovl in load:
-            overlay = Overlay(self.config, json=ovl, ignore=self.ignore)
-            self.overlays[overlay.name] = overlay
+            if ovl.get('name') is None:
+                # Let Overlay() complain about it
+                Overlay(self.config, json=ovl, ignore=self.ignore)
+            self.overlays.add_record(encode(ovl['name']), 'json', ovl,
+                                     self.config, self.ignore)
 
         return True
 
@@ -26,11 +26,11 @@ __version__ = "$Id: sqlite_db.py 273 2015-08-03 20:17:30Z twitch153 $"
 #
 #-------------------------------------------------------------------------------
 
+import functools
 import os
 import sys
 import sqlite3
 
-from   layman.overlays.overlay   import Overlay
 
 #py3.2+
 if sys.hexversion >= 0x30200f0:
@@ -38,6 +38,13 @@ if sys.hexversion >= 0x30200f0:
 else:
     _UNICODE = 'UTF-8'
 
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS = ('off', 'normal', 'full', 'extra')
+
+# Lower than any SQLITE_MAX_VARIABLE_NUMBER, longer name lists are
+# looked up by reading the whole db.
+MAX_VARIABLES = 500
+
 
 #===============================================================================
 #
@@ -88,14 +95,17 @@ class DBHandler(object):
 
             raise Exception(msg)
 
-        self.__create_database__(path)
+        # Reads of an existing database must not write to it, it may
+        # well be read only.
+        if not os.path.exists(path) or not os.path.getsize(path):
+            self.__create_database__(path)
 
         return sqlite3.connect(path)
 
 
     def __create_database__(self, path):
         '''
-        Create the LaymanOverlays database if it doesn't exist.
+        Create the LaymanOverlays database.
         '''
         with sqlite3.connect(path) as connection:
             cursor = connection.cursor()
@@ -145,15 +155,33 @@ class DBHandler(object):
 
                 raise err
 
+            self._create_indexes(connection)
 
-    def read_db(self, path, text=None):
+
+    def _create_indexes(self, connection):
         '''
-        Read the overlay definitions from the database and generate overlays.
+        Adds the indexes missing from databases created by an older
+        layman.
         '''
-        cursor = None
-        overlay_id = None
-        overlay = {}
+        # The UNIQUE constraints already index Overlay.Name,
+        # Source.Type and the Overlay_ID side of the other tables,
+        # these cover looking up the overlays of a source or owner.
+        try:
+            with connection:
+                connection.execute('''CREATE INDEX IF NOT EXISTS
+                Overlay_Source_Source_ID ON Overlay_Source (Source_ID)''')
+                connection.execute('''CREATE INDEX IF NOT EXISTS
+                Overlay_Owner_Owner_ID ON Overlay_Owner (Owner_ID)''')
+        except sqlite3.OperationalError as err:
+            self.output.debug('SQLite DBHandler; could not create indexes: '
+                              '%s', 4, err)
+
 
+    def read_db(self, path, text=None):
+        '''
+        Read the overlay names from the database, the definitions are
+        only fetched once an overlay is accessed.
+        '''
         try:
             connection = self.__connect__(path)
         except sqlite3.DatabaseError as err:
@@ -161,64 +189,158 @@ class DBHandler(object):
             self.output.error(msg)
             return False
 
-        cursor = connection.cursor()
-        cursor.execute('''SELECT Overlay_ID, Name, Priority, Status,
-        Quality, Homepage, IRC, License FROM Overlay''')
-        overlays_info = cursor.fetchall()
-        connection.commit()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('''SELECT Name FROM Overlay''')
+            names = [row[0] for row in cursor.fetchall()]
+        except sqlite3.DatabaseError as err:
+            msg = 'SQLite DBHandler DatabaseError: %(err)s' % {'err': err}
+            self.output.error(msg)
+            return False
+        finally:
+            connection.close()
+
+        loader = functools.partial(self._read_overlays, path)
+        for name in names:
+            self.overlays.add_deferred(name, 'ovl_dict', loader, self.config,
+                                       self.ignore)
+        return True
+
+
+    def _read_overlays(self, path, names=None):
+        '''
+        Reads the definitions of the given overlays, or of all overlays,
+        with one query per table.
 
+        @rtype dict: overlay name -> overlay dict as taken by Overlay().
+        '''
+        where = ''
+        params = ()
+        if names is not None and len(names) <= MAX_VARIABLES:
+            where = 'WHERE Name IN ( %(vars)s )'\
+                    % {'vars': ', '.join(['?'] * len(names))}
+            params = tuple(names)
+
+        connection = sqlite3.connect(path)
+        try:
+            cursor = connection.cursor()
+            cursor.execute('''SELECT Overlay_ID, Name, Priority, Status,
+            Quality, Homepage, IRC, License FROM Overlay %(where)s'''
+            % {'where': where}, params)
+            overlays_info = cursor.fetchall()
+
+            cursor.execute('''SELECT Overlay_ID, URL, Type, Branch FROM
+            Overlay JOIN Overlay_Source USING (Overlay_ID) JOIN Source USING
+            (Source_ID) %(where)s ORDER BY Overlay_Source_ID'''
+            % {'where': where}, params)
+            sources = self._group_rows(cursor.fetchall())
+
+            cursor.execute('''SELECT Overlay_ID, Owner_Email, Owner_Name FROM
+            Overlay JOIN Overlay_Owner USING (Overlay_ID) JOIN Owner USING
+            (Owner_ID) %(where)s ORDER BY Overlay_Owner_ID'''
+            % {'where': where}, params)
+            owners = self._group_rows(cursor.fetchall())
+
+            cursor.execute('''SELECT Overlay_ID, Description FROM Overlay
+            JOIN Description USING (Overlay_ID) %(where)s
+            ORDER BY Description_ID''' % {'where': where}, params)
+            descriptions = self._group_rows(cursor.fetchall())
+
+            cursor.execute('''SELECT Overlay_ID, Feed FROM Overlay JOIN Feed
+            USING (Overlay_ID) %(where)s ORDER BY Feed_ID'''
+            % {'where': where}, params)
+            feeds = self._group_rows(cursor.fetchall())
+        finally:
+            connection.close()
+
+        result = {}
         for overlay_info in overlays_info:
             overlay = {}
             overlay_id = overlay_info[0]
             overlay['name'] = overlay_info[1]
+            overlay['source'] = sources.get(overlay_id, [])
 
-            cursor.execute('''SELECT URL, Type, Branch FROM Overlay_Source
-            JOIN Overlay USING (Overlay_ID) JOIN Source USING (Source_ID)
-            WHERE Overlay_ID = ?''', (overlay_id,))
-            overlay['source'] = cursor.fetchall()
-
-            cursor.execute('''SELECT Owner_Email, Owner_Name FROM Overlay_Owner
-            JOIN Overlay USING (Overlay_ID) JOIN Owner USING (Owner_ID)
-            WHERE Overlay_ID = ?''', (overlay_id,))
-            owner_info = cursor.fetchall()
             overlay['owner'] = []
-            for _owner in owner_info:
+            for _owner in owners.get(overlay_id, []):
                 owner = {}
                 if _owner[0]:
                     owner['email'] = _owner[0]
-                else:
-                    owner['email'] = None
-                if len(_owner) > 1:
-                    if _owner[1]:
-                        owner['name'] = _owner[1]
-                    else:
-                        owner['name'] = None
+                if _owner[1]:
+                    owner['name'] = _owner[1]
                 overlay['owner'].append(owner)
 
-            cursor.execute('''SELECT Description FROM Description
-            JOIN Overlay USING (Overlay_ID) WHERE Overlay_ID = ?''',
-            (overlay_id,))
-            overlay['description'] = cursor.fetchall()[0]
-
-            overlay['status'] = overlay_info[3]
-            overlay['quality'] = overlay_info[4]
-            overlay['priority'] = overlay_info[2]
-            overlay['license'] = overlay_info[7]
-            overlay['homepage'] = overlay_info[5]
-            overlay['IRC'] = overlay_info[6]
-
-            cursor.execute('''SELECT Feed FROM Feed JOIN Overlay USING
-            (Overlay_ID) WHERE Overlay_ID = ?''', (overlay_id,))
-            overlay['feed'] = cursor.fetchall()
-
-            if len(overlay['feed']):
-                overlay['feed'] = overlay['feed'][0]
-
-            self.overlays[overlay_info[1]] = Overlay(self.config,
-                                                     ovl_dict=overlay,
-                                                     ignore=self.ignore)
-        connection.close()
-        return True
+            overlay['description'] = [d[0] for d in
+                                      descriptions.get(overlay_id, [])]
+            overlay['feed'] = [f[0] for f in feeds.get(overlay_id, [])]
+
+            if overlay_info[2] is not None:
+                overlay['priority'] = overlay_info[2]
+            # from_dict() would turn missing values into 'None' strings
+            for key, value in (('status', overlay_info[3]),
+                               ('quality', overlay_info[4]),
+                               ('homepage', overlay_info[5]),
+                               ('irc', overlay_info[6]),
+                               ('license', overlay_info[7])):
+                if value is not None:
+                    overlay[key] = value
+
+            result[overlay_info[1]] = overlay
+        return result
+
+
+    def query(self, path, status=None, quality=None, source_type=None,
+              search=None):
+        '''
+        Looks up the names of the overlays matching all the given
+        criteria in the database, see DbBase.query().
+        '''
+        conditions = []
+        params = []
+        if status is not None:
+            conditions.append('Status = ?')
+            params.append(status)
+        if quality is not None:
+            conditions.append('Quality = ?')
+            params.append(quality)
+        if source_type is not None:
+            conditions.append('''Overlay_ID IN ( SELECT Overlay_ID FROM
+            Overlay_Source JOIN Source USING (Source_ID) WHERE Type = ? )''')
+            params.append(source_type)
+        if search is not None:
+            # LIKE only folds the case of ASCII letters, match the way
+            # DbBase.query() does instead
+            conditions.append('''( LAYMAN_CONTAINS(Name, ?) OR Overlay_ID IN
+            ( SELECT Overlay_ID FROM Description WHERE
+            LAYMAN_CONTAINS(Description, ?) ) )''')
+            params.extend([search.lower(), search.lower()])
+
+        where = ''
+        if conditions:
+            where = 'WHERE ' + ' AND '.join(conditions)
+
+        connection = sqlite3.connect(path)
+        connection.create_function('LAYMAN_CONTAINS', 2,
+            lambda text, search: text is not None and search in text.lower())
+        try:
+            cursor = connection.cursor()
+            cursor.execute('''SELECT Name FROM Overlay %(where)s
+            ORDER BY Name''' % {'where': where}, params)
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            connection.close()
+
+
+    @staticmethod
+    def _group_rows(rows):
+        '''
+        Groups (Overlay_ID, values...) rows by overlay.
+
+        @rtype dict: Overlay_ID -> list of value tuples, in row order.
+        '''
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row[0], []).append(tuple(row[1:]))
+        return grouped
 
 
     def add_new(self, document=None, origin=None):
@@ -237,130 +359,164 @@ class DBHandler(object):
         return True
 
 
-    def add_ovl(self, overlay, connection):
+    def _overlay_rows(self, names):
         '''
-        Adds an overlay to the database.
+        Flattens the given overlays into the parameter rows of the
+        statements in _insert_overlays().
         '''
-        overlay_id = None
-        owner_id = None
-        source_id = None
-        cursor = None
+        rows = {'overlay': [], 'owner': [], 'source': [], 'overlay_owner': [],
+                'overlay_source': [], 'description': [], 'feed': []}
 
-        cursor = connection.cursor()
-        cursor.execute('''INSERT INTO Overlay ( Name, Priority, Status, 
-        Quality, Homepage, IRC, License ) VALUES ( ?, ?, ?, ?, ?, ?, ? )''',
-        (overlay.name, overlay.priority, overlay.status, overlay.quality,
-        overlay.homepage, overlay.irc, overlay.license,))
-        connection.commit()
+        self.overlays.preload(names)
+        for name in names:
+            overlay = self.overlays[name]
+            rows['overlay'].append((overlay.name, overlay.priority,
+                overlay.status, overlay.quality, overlay.homepage, overlay.irc,
+                overlay.license))
 
-        cursor.execute('''SELECT Overlay_ID FROM Overlay WHERE Name = ?''',
-        (overlay.name,))
-        overlay_id = cursor.fetchone()[0]
+            for owner in overlay.owners:
+                rows['owner'].append((owner['name'], owner['email'],
+                    owner['name'], owner['email']))
+                rows['overlay_owner'].append((owner['name'], owner['email'],
+                    overlay.name))
 
-        for owner in overlay.owners:
-            _name = owner['name']
-            _email = owner['email']
+            for source in overlay.sources:
+                rows['source'].append((source.type_key, source.branch,
+                    source.src))
+                rows['overlay_source'].append((overlay.name, source.type_key,
+                    source.src))
 
-            cursor.execute('''INSERT INTO Owner ( Owner_Name, Owner_Email ) 
-            VALUES ( ?, ? )''', (owner['name'], owner['email'],))
-            connection.commit()
+            for description in overlay.descriptions:
+                rows['description'].append((description, overlay.name))
 
-            if _name != None:
-                cursor.execute('''SELECT Owner_ID from Owner WHERE 
-                Owner_Email = ? AND Owner_Name = ?''', (_email, _name,))
-            else:
-                cursor.execute('''SELECT Owner_ID from Owner WHERE 
-                Owner_Email = ?''', (_email,))
-            owner_id = cursor.fetchone()[0]
+            for feed in overlay.feeds:
+                rows['feed'].append((feed, overlay.name))
 
-            cursor.execute('''INSERT INTO Overlay_Owner ( Overlay_ID, 
-            Owner_ID ) VALUES ( ?, ? )''', (overlay_id, owner_id,))
+        return rows
 
-        for source in overlay.sources:
-            cursor.execute('''INSERT INTO Source ( Type, Branch, URL )
-            VALUES ( ?, ?, ? )''', (source.type_key, source.branch,
-            source.src,))
-            connection.commit()
 
-            cursor.execute('''SELECT Source_ID FROM Source WHERE URL = ?;''',
-            (source.src,))
-            source_id = cursor.fetchone()[0]
+    def _insert_overlays(self, cursor, rows):
+        '''
+        Inserts the overlays flattened by _overlay_rows(), which must not
+        be in the database yet.
+        '''
 
-            cursor.execute('''INSERT INTO Overlay_Source ( Overlay_ID, 
-            Source_ID ) VALUES ( ?, ? )''', (overlay_id, source_id, ))
+        cursor.executemany('''INSERT INTO Overlay ( Name, Priority, Status,
+        Quality, Homepage, IRC, License ) VALUES ( ?, ?, ?, ?, ?, ?, ? )''',
+        rows['overlay'])
+        # UNIQUE does not catch owners without a name, NULLs never compare
+        # equal.
+        cursor.executemany('''INSERT INTO Owner ( Owner_Name, Owner_Email )
+        SELECT ?, ? WHERE NOT EXISTS ( SELECT 1 FROM Owner WHERE
+        Owner_Name IS ? AND Owner_Email IS ? )''', rows['owner'])
+        cursor.executemany('''INSERT INTO Source ( Type, Branch, URL )
+        VALUES ( ?, ?, ? )''', rows['source'])
+
+        cursor.executemany('''INSERT INTO Overlay_Owner ( Overlay_ID,
+        Owner_ID ) SELECT Overlay_ID, ( SELECT MIN(Owner_ID) FROM Owner WHERE
+        Owner_Name IS ? AND Owner_Email IS ? ) FROM Overlay WHERE Name = ?''',
+        rows['overlay_owner'])
+        cursor.executemany('''INSERT INTO Overlay_Source ( Overlay_ID,
+        Source_ID ) SELECT Overlay_ID, Source_ID FROM Overlay, Source WHERE
+        Name = ? AND Type = ? AND URL = ?''', rows['overlay_source'])
+        cursor.executemany('''INSERT INTO Description ( Overlay_ID,
+        Description ) SELECT Overlay_ID, ? FROM Overlay WHERE Name = ?''',
+        rows['description'])
+        cursor.executemany('''INSERT INTO Feed ( Overlay_ID, Feed ) SELECT
+        Overlay_ID, ? FROM Overlay WHERE Name = ?''', rows['feed'])
+
+
+    def _delete_overlays(self, cursor, names):
+        '''
+        Deletes the given overlays and the owners and sources no other
+        overlay refers to.
+        '''
+        names = [(name,) for name in names]
+        for table in ('Feed', 'Description', 'Overlay_Source',
+                      'Overlay_Owner'):
+            cursor.executemany('''DELETE FROM %(table)s WHERE Overlay_ID IN
+            ( SELECT Overlay_ID FROM Overlay WHERE Name = ? )'''
+            % {'table': table}, names)
+        cursor.executemany('''DELETE FROM Overlay WHERE Name = ?''', names)
 
-        for description in overlay.descriptions:
-            cursor.execute('''INSERT INTO Description ( Overlay_ID, 
-            Description ) VALUES ( ?, ? )''', (overlay_id, description,))
+        cursor.execute('''DELETE FROM Owner WHERE Owner_ID NOT IN
+        ( SELECT Owner_ID FROM Overlay_Owner )''')
+        cursor.execute('''DELETE FROM Source WHERE Source_ID NOT IN
+        ( SELECT Source_ID FROM Overlay_Source )''')
 
-        for feed in overlay.feeds:
-            cursor.execute('''INSERT INTO Feed ( Overlay_ID, Feed ) VALUES ( ?,
-             ? )''', (overlay_id, feed,))
 
-        connection.commit()
+    def _set_pragmas(self, connection):
+        '''
+        Applies the sqlite_journal_mode and sqlite_synchronous options.
+        '''
+        for pragma, key, allowed in (
+                ('journal_mode', 'sqlite_journal_mode', JOURNAL_MODES),
+                ('synchronous', 'sqlite_synchronous', SYNCHRONOUS)):
+            try:
+                value = self.config[key]
+            except KeyError:
+                continue
+            if not value:
+                continue
+            value = value.strip().lower()
+            if value not in allowed:
+                msg = 'SQLite DBHandler warning; invalid %(key)s value '\
+                      '"%(value)s", expected one of: %(allowed)s'\
+                      % {'key': key, 'value': value,
+                         'allowed': ', '.join(allowed)}
+                self.output.warn(msg)
+                continue
+            connection.execute('PRAGMA %(pragma)s = %(value)s'
+                               % {'pragma': pragma, 'value': value})
 
 
     def remove(self, overlay, path):
         '''
         Remove an overlay from the database.
-        '''
-        cursor = None
-        overlay_id = 0
-        owner_ids = []
-        source_ids = []
 
+        The row is deleted by the next write(), together with the other
+        pending changes.
+        '''
         if overlay.name in self.overlays:
             del self.overlays[overlay.name]
 
-        with self.__connect__(path) as connection:
-            cursor = connection.cursor()
-            
-            cursor.execute('''SELECT Overlay_ID FROM Overlay WHERE Name = 
-            ?''', (overlay.name,))
-            overlay_id = cursor.fetchone()[0]
-
-            cursor.execute('''SELECT Owner_ID FROM Overlay_Owner WHERE 
-            Overlay_ID = ?''', (overlay_id,))
-            owner_ids = cursor.fetchall()[0]
-
-            cursor.execute('''SELECT Source_ID FROM Overlay_Source WHERE 
-            Overlay_ID = ?''', (overlay_id,))
-            source_ids = cursor.fetchall()[0]
-
-            cursor.execute('''DELETE FROM Feed WHERE Overlay_ID = ?''',
-            (overlay_id,))
-            cursor.execute('''DELETE FROM Description WHERE Overlay_ID = ?''',
-            (overlay_id,))
-            cursor.execute('''DELETE FROM Overlay_Source WHERE Overlay_ID = 
-            ?''', (overlay_id,))
-            cursor.execute('''DELETE FROM Overlay_Owner WHERE Overlay_ID = 
-            ?''', (overlay_id,))
-
-            for source_id in source_ids:
-               cursor.execute('''DELETE FROM Source WHERE Source_ID = ?''', 
-               (source_id,))
-
-            for owner_id in owner_ids:
-                cursor.execute('''DELETE FROM Owner WHERE Owner_ID = ?''',
-                (owner_id,))
-
-            cursor.execute('''DELETE FROM Overlay WHERE Overlay_ID = ?''',
-            (overlay_id,))
-
-            connection.commit()
-
 
     def write(self, path, remove=False):
         '''
         Write the list of overlays to the database.
-        '''
-        if remove:
-            return
 
+        If the overlays were read from this very database only the
+        overlays added, changed or removed since are written, otherwise
+        the database is replaced by the current list. Either way all
+        changes go in one transaction.
+        '''
+        incremental = self.overlays.read_paths == [path] and \
+                      os.path.exists(path)
+        if incremental:
+            changed = sorted(self.overlays.dirty & set(self.overlays))
+        else:
+            changed = sorted(self.overlays)
         try:
-            with self.__connect__(path) as connection:
-                for overlay in self.overlays:
-                    self.add_ovl(self.overlays[overlay], connection)
+            # Deferred overlays have to be fetched before the db changes.
+            rows = self._overlay_rows(changed)
+            connection = self.__connect__(path)
+            try:
+                self._set_pragmas(connection)
+                self._create_indexes(connection)
+                with connection:
+                    cursor = connection.cursor()
+                    if incremental:
+                        self._delete_overlays(cursor,
+                            changed + sorted(self.overlays.removed))
+                    else:
+                        for table in ('Feed', 'Description', 'Overlay_Source',
+                                      'Overlay_Owner', 'Owner', 'Source',
+                                      'Overlay'):
+                            cursor.execute('DELETE FROM %(table)s'
+                                           % {'table': table})
+                    self._insert_overlays(cursor, rows)
+            finally:
+                connection.close()
         except Exception as err:
             msg = 'Failed to write to overlays database: %(path)s\nError was'\
                   ': %(err)s' % {'path': path, 'err': err}
@@ -26,13 +26,14 @@ __version__ = "$Id: xml_db.py 273 2015-07-07 10:30:30Z twitch153 $"
 #
 #-------------------------------------------------------------------------------
 
+import io
 import sys
 import xml
 import xml.etree.ElementTree as ET # Python 2.5
 
-from   layman.utils              import indent
+from   layman.utils              import indent, open_compressed
 from   layman.compatibility      import fileopen
-from   layman.overlays.overlay   import Overlay
+from   layman.overlays.overlay   import Overlay, xml_name
 
 
 #py3.2+
@@ -100,21 +101,25 @@ class DBHandler(object):
         '''
         Read the overlay definition file.
         '''
-        document = text
+        if text:
+            return self.read(text, origin=path)
 
-        if not document:
-            try:
-                with fileopen(path, 'r') as df:
-                    document = df.read()
-            except Exception as error:
-                if not self.ignore_init_read_errors:
-                    msg = 'XML DBHandler - Failed to read the overlay list at '\
-                      '"%(path)s"' % {'path': path}
+        msg = 'XML DBHandler - Failed to read the overlay list at '\
+              '"%(path)s"' % {'path': path}
+        try:
+            document = open_compressed(path)
+        except Exception as error:
+            if not self.ignore_init_read_errors:
                 self.output.error(msg)
-                return False
+            return False
 
-        success = self.read(document, origin=path)
-        return success
+        with document:
+            try:
+                return self._parse(document, origin=path)
+            except (IOError, OSError, EOFError) as error:
+                # e.g. a truncated compressed cache
+                self.output.error(msg + ': %(err)s' % {'err': error})
+                return False
 
 
     def read(self, text, origin):
@@ -122,22 +127,58 @@ class DBHandler(object):
         Read an xml list of overlays (adding to and potentially overwriting
         existing entries)
         '''
+        if not isinstance(text, bytes) and sys.hexversion < 0x3000000:
+            text = text.encode('UTF-8')
+        if isinstance(text, bytes):
+            document = io.BytesIO(text)
+        else:
+            document = io.StringIO(text)
+        return self._parse(document, origin)
+
+
+    def _parse(self, document, origin):
+        '''
+        Streams the overlay entries out of an xml document. Each entry is
+        handed over as soon as its closing tag is parsed and then detached
+        from the document, so the tree never holds more than one entry.
+        The entries are kept as serialized xml until they are accessed,
+        which takes a fraction of the memory of the element trees.
+
+        @param document: file like object.
+        '''
+        depth = 0
+        root = None
         try:
-            document = ET.fromstring(text)
+            for event, element in ET.iterparse(document, ('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = element
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                if element.tag in ('overlay', 'repo'):
+                    self._add_element(element)
+                root.clear()
         except ET.ParseError as error:
             msg = 'XML DBHandler - ET.ParseError: %(err)s' % {'err': error}
             self.output.error(msg)
             return False
 
-        overlays = document.findall('overlay') + document.findall('repo')
+        return True
 
-        for overlay in overlays:
-            msg = 'XML DBHandler - Parsing overlay: %(ovl)s' % {'ovl': overlay}
-            self.output.debug(msg, 9)
-            ovl = Overlay(config=self.config, xml=overlay, ignore=self.ignore)
-            self.overlays[ovl.name] = ovl
 
-        return True
+    def _add_element(self, overlay):
+        self.output.debug('XML DBHandler - Parsing overlay: %s', 9, overlay)
+        name = xml_name(overlay)
+        if name is None:
+            # Let Overlay() complain about it
+            Overlay(config=self.config, xml=overlay, ignore=self.ignore)
+        # the whitespace up to the next entry
+        overlay.tail = None
+        self.overlays.add_record(name, 'xml', ET.tostring(overlay),
+                                 self.config, self.ignore)
 
 
     def add_new(self, xml=None, origin=None):
@@ -36,7 +36,7 @@ import os
 import os.path
 import sys
 
-from   layman.module             import Modules, InvalidModuleName
+from   layman.module             import get_modules, InvalidModuleName
 from   layman.overlays.overlay   import Overlay
 
 
@@ -67,6 +67,171 @@ class UnknownOverlayException(Exception):
         return UnknownOverlayMessage(self.repo_name)
 
 
+#===============================================================================
+#
+# Class OverlayDict
+#
+#-------------------------------------------------------------------------------
+
+class OverlayRecord(object):
+    '''
+    A raw overlay definition (xml element or its serialized text, json or
+    dict) that has not been turned into an Overlay yet.
+
+    Deferred records have no data yet, their loader is called with a list
+    of overlay names and returns a dict name -> data.
+    '''
+    __slots__ = ('config', 'kind', 'data', 'ignore', 'loader')
+
+    def __init__(self, config, kind, data, ignore, loader=None):
+        self.config = config
+        self.kind = kind
+        self.data = data
+        self.ignore = ignore
+        self.loader = loader
+
+
+    def load(self):
+        data = self.data
+        if self.kind == 'xml' and isinstance(data, bytes):
+            import xml.etree.ElementTree as ET
+            data = ET.fromstring(data)
+        kwargs = {self.kind: data}
+        return Overlay(self.config, ignore=self.ignore, **kwargs)
+
+
+class OverlayDict(dict):
+    '''
+    Maps overlay names to overlays.
+
+    The db handlers store the raw definitions with add_record(), each is
+    converted to an Overlay on first access. Commands that only need the
+    names or a single overlay don't pay for building the whole catalog.
+
+    Overlays set or deleted after reading are remembered in C{dirty} and
+    C{removed} so a db handler can write back just the changes.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        # the db files this dict was read from, see DbBase.read_db()
+        self.read_paths = []
+        self.dirty = set()
+        self.removed = set()
+
+
+    def add_record(self, name, kind, data, config, ignore):
+        '''
+        @param kind: 'xml', 'json' or 'ovl_dict', the Overlay() keyword the
+        definition is passed as.
+        '''
+        dict.__setitem__(self, name, OverlayRecord(config, kind, data, ignore))
+
+
+    def add_deferred(self, name, kind, loader, config, ignore):
+        '''
+        Like add_record() for db handlers that can look up single
+        overlays cheaply, the definition is only fetched from the db
+        once the overlay is accessed.
+
+        @param loader: callable taking a list of overlay names and
+        returning a dict name -> definition.
+        '''
+        dict.__setitem__(self, name,
+                         OverlayRecord(config, kind, None, ignore, loader))
+
+
+    def preload(self, names=None):
+        '''
+        Fetches the definitions of the given deferred overlays (all if
+        None) with one loader call per db instead of one per overlay.
+        '''
+        if names is None:
+            names = self.keys()
+        pending = {}
+        for name in names:
+            value = dict.get(self, name)
+            if isinstance(value, OverlayRecord) and value.data is None \
+                    and value.loader is not None:
+                pending.setdefault(value.loader, []).append(name)
+        for loader, _names in pending.items():
+            data = loader(_names)
+            for name in _names:
+                dict.__getitem__(self, name).data = data[name]
+
+
+    def is_loaded(self, name):
+        return not isinstance(dict.__getitem__(self, name), OverlayRecord)
+
+
+    def mark_dirty(self, name):
+        '''
+        Flags an overlay that was changed in place as needing a write.
+        '''
+        self.dirty.add(name)
+        self.removed.discard(name)
+
+
+    def mark_clean(self):
+        '''
+        Forgets the pending changes once they have been written.
+        '''
+        self.dirty.clear()
+        self.removed.clear()
+
+
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, name, value)
+        self.mark_dirty(name)
+
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name)
+        self.dirty.discard(name)
+        self.removed.add(name)
+
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        dict.update(self, other)
+        self.dirty.update(other)
+        self.removed.difference_update(other)
+
+
+    def __getitem__(self, name):
+        value = dict.__getitem__(self, name)
+        if isinstance(value, OverlayRecord):
+            if value.data is None:
+                self.preload([name])
+            value = value.load()
+            dict.__setitem__(self, name, value)
+        return value
+
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+
+    def pop(self, name, *default):
+        if name in self:
+            value = self[name]
+            del self[name]
+            return value
+        return dict.pop(self, name, *default)
+
+
+    def values(self):
+        self.preload()
+        return [self[name] for name in self]
+
+
+    def items(self):
+        self.preload()
+        return [(name, self[name]) for name in self]
+
+
 #===============================================================================
 #
 # Class DbBase
@@ -85,11 +250,11 @@ class DbBase(object):
         self.db_type = config['db_type']
         self.ignore = ignore
         self.ignore_init_read_errors = ignore_init_read_errors
-        self.mod_ctl = Modules(path=MOD_PATH,
-                               namepath='layman.db_modules',
-                               output=config['output'])
+        self.mod_ctl = get_modules(path=MOD_PATH,
+                                   namepath='layman.db_modules',
+                                   output=config['output'])
         self.output = config['output']
-        self.overlays = {}
+        self.overlays = OverlayDict()
         self.paths = paths
 
         path_found = False
@@ -131,6 +296,8 @@ class DbBase(object):
 
 
     def __eq__(self, other):
+        self.overlays.preload()
+        other.overlays.preload()
         for key in set(self.overlays.keys()) | set(other.overlays.keys()):
             if self.overlays[key] != other.overlays[key]:
                 return False
@@ -165,13 +332,18 @@ class DbBase(object):
         raise NotImplementedError(msg)
 
 
-    def _get_dbctl(self, db_type):
+    def _get_dbctl(self, db_type, overlays=None):
         '''
         Returns database module controller for class or dies trying.
+
+        @param overlays: optional dict the controller stores the overlays it
+        reads in, defaults to self.overlays.
         '''
+        if overlays is None:
+            overlays = self.overlays
         try:
             db_ctl = self.mod_ctl.get_class(db_type)(self.config,
-                        self.overlays,
+                        overlays,
                         self.paths,
                         self.ignore,
                         self.ignore_init_read_errors)
@@ -205,9 +377,12 @@ class DbBase(object):
         return
 
 
-    def read_db(self, path, text=None, text_type=None):
+    def read_db(self, path, text=None, text_type=None, overlays=None):
         '''
         Read the overlay database for installed overlay definitions.
+
+        @param overlays: optional dict to read the overlays into instead
+        of self.overlays.
         '''
         db_type = self.db_type
 
@@ -218,8 +393,12 @@ class DbBase(object):
         if 'cache' in path and '.xml' in path:
             db_type = 'xml_db'
 
-        db_ctl = self._get_dbctl(db_type)
-        return db_ctl.read_db(path, text=text)
+        db_ctl = self._get_dbctl(db_type, overlays)
+        success = db_ctl.read_db(path, text=text)
+        if success and overlays is None and text is None \
+                and db_type == self.db_type:
+            self.overlays.read_paths.append(path)
+        return success
 
 
     def write(self, path, remove=False, migrate_type=None):
@@ -233,6 +412,8 @@ class DbBase(object):
 
         db_ctl = self._get_dbctl(db_type)
         db_ctl.write(path, remove=remove)
+        if path in self.overlays.read_paths:
+            self.overlays.mark_clean()
 
 
     def remove(self, overlay, path):
@@ -247,16 +428,13 @@ class DbBase(object):
         '''
         Select an overlay from the list.
         '''
-        ovl = {'ovl': overlay}
-        msg = 'DbBase.select(), overlay = %(ovl)s' % ovl
-        self.output.debug(msg, 5)
+        self.output.debug('DbBase.select(), overlay = %s', 5, overlay)
 
         if not overlay in self.overlays.keys():
-            msg = 'DbBase.select(), unknown overlay = %(ovl)s' % ovl
-            self.output.debug(msg, 4)
-            ovls = {'ovls': ', '.join(self.overlays.keys())}
-            msg = 'DbBase.select(), known overlays = %(ovls)s' % ovls
-            self.output.debug(ovls, 4)
+            self.output.debug('DbBase.select(), unknown overlay = %s', 4,
+                              overlay)
+            self.output.debug(lambda: 'DbBase.select(), known overlays = %s'
+                              % ', '.join(self.overlays.keys()), 4)
             raise UnknownOverlayException(overlay)
         return self.overlays[overlay]
 
@@ -267,9 +445,10 @@ class DbBase(object):
         '''
         result = []
 
-        selection = [overlay for (a, overlay) in self.overlays.items()]
-        if repos is not None:
-            selection = [ovl for ovl in selection if ovl.name in repos]
+        names = [name for name in self.overlays
+                 if repos is None or name in repos]
+        self.overlays.preload(names)
+        selection = [self.overlays[name] for name in names]
 
         for overlay in selection:
             if verbose:
@@ -290,3 +469,48 @@ class DbBase(object):
         Returns a list of the overlay names
         '''
         return sorted(self.overlays)
+
+
+    def query(self, status=None, quality=None, source_type=None,
+              search=None):
+        '''
+        Returns the sorted names of the overlays matching all the given
+        criteria.
+
+        If the list was read from a single db whose handler can answer
+        the query itself (e.g. sqlite) and has no unwritten changes, the
+        query is passed on to the db handler, so no overlay needs to be
+        loaded.
+
+        @param status: e.g. 'official' or 'unofficial'.
+        @param quality: e.g. 'stable', 'testing' or 'experimental'.
+        @param source_type: type key of any of the sources, e.g. 'git'.
+        @param search: case insensitive text searched for in the names
+        and descriptions.
+        @rtype list of str
+        '''
+        overlays = self.overlays
+        if len(overlays.read_paths) == 1 and not overlays.dirty \
+                and not overlays.removed:
+            db_ctl = self._get_dbctl(self.db_type)
+            if hasattr(db_ctl, 'query'):
+                return db_ctl.query(overlays.read_paths[0], status=status,
+                                    quality=quality, source_type=source_type,
+                                    search=search)
+
+        if search is not None:
+            search = search.lower()
+        result = []
+        for name, overlay in overlays.items():
+            if status is not None and overlay.status != status:
+                continue
+            if quality is not None and overlay.quality != quality:
+                continue
+            if source_type is not None and not source_type in \
+                    [source.type_key for source in overlay.sources]:
+                continue
+            if search is not None and not search in name.lower() and not \
+                    [d for d in overlay.descriptions if search in d.lower()]:
+                continue
+            result.append(name)
+        return sorted(result)
@@ -257,7 +257,7 @@ class DebugMessage(Message):
     #############################################################################
     ## Output Functions
 
-    def debug (self, message, level = DEBUG_LEVEL):
+    def debug (self, message, level = DEBUG_LEVEL, *args):
         '''
         This is a generic debugging method.
         '''
@@ -265,6 +265,12 @@ class DebugMessage(Message):
         if level > self.debug_lev:
             return
 
+        ## Build lazily passed messages, see output.Message.debug()
+        if callable(message):
+            message = message()
+        if args:
+            message = message % args
+
         ## Maybe this should be debugged. So get the stack first.
         stack = inspect.stack()
 
@@ -4,9 +4,14 @@
 from __future__ import print_function
 
 import os
+import threading
 
 from layman.output import Message
 
+# Modules instances shared by the whole process, see get_modules()
+_registry = {}
+_registry_lock = threading.Lock()
+
 class InvalidModuleName(Exception):
     '''An invalid or unknown module name.'''
 
@@ -73,9 +78,9 @@ class Module(object):
         @rtype mod_class: instance of plug-in module's class
         '''
         if not name or name not in self.kids_names:
-            raise InvalidModuleName('Module name "%(name)" was invalid or not'\
-                    'part of the module "%(mod_name)"' ({'mod_name':self.name,
-                                                         'name': name}))
+            raise InvalidModuleName('Module name "%(name)s" was invalid or not'\
+                    ' part of the module "%(mod_name)s"' % ({'mod_name':self.name,
+                                                             'name': name}))
         kid = self.kids[name]
         if kid['is_imported']:
             module = kid['instance']
@@ -218,3 +223,25 @@ class Modules(object):
             raise InvalidModuleName('Module name "%(name)s" was invalid or'\
                 ' not found.' % ({'name': modname}))
         return desc
+
+
+def get_modules(path, namepath, output=None):
+    '''
+    Returns the Modules instance of a plug-in directory. The directory is
+    only scanned and its plug-ins imported the first time, every later
+    call of the process gets the same instance.
+
+    @param path: path to the "modules" directory
+    @param namepath: python import path to the "modules" directory
+    @param output: Optional output, used when scanning the directory
+    @rtype Modules
+    '''
+    key = (path, namepath)
+    modules = _registry.get(key)
+    if modules is None:
+        with _registry_lock:
+            modules = _registry.get(key)
+            if modules is None:
+                modules = Modules(path=path, namepath=namepath, output=output)
+                _registry[key] = modules
+    return modules
@@ -24,7 +24,6 @@ Controls all mountable overlay types.
 #------------------------------------------------------------------------------
 from __future__ import unicode_literals
 
-import argparse
 import copy
 import os
 import sys
@@ -234,6 +233,7 @@ class Interactive(object):
 
         @rtype argparse.NameSpace object.
         '''
+        import argparse
         self.parser = argparse.ArgumentParser(prog='layman-mounter',
             description='Layman\'s utility script to handle mountable '\
                         'overlays.')
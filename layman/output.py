@@ -12,7 +12,9 @@ from __future__ import print_function
 __version__ = "0.1"
 
 
+import io
 import sys
+import threading
 
 from layman.constants import codes, INFO_LEVEL, WARN_LEVEL, NOTE_LEVEL, DEBUG_LEVEL, OFF
 from layman.compatibility import encode
@@ -36,6 +38,9 @@ class MessageBase(object):
                  col = True,
                  error_callback=None
                  ):
+        # Per thread output buffers, see buffer_output()
+        self._buffers = threading.local()
+
         # Where should the error output go? This can also be a file
         if isinstance(err, BUILTIN_FILE_TYPE):
             self.error_out = err
@@ -69,6 +74,56 @@ class MessageBase(object):
         self.block_callback = False
 
 
+    @property
+    def std_out(self):
+        buf = getattr(self._buffers, 'out', None)
+        if buf is not None:
+            return buf
+        return self._std_out
+
+
+    @std_out.setter
+    def std_out(self, out):
+        self._std_out = out
+
+
+    @property
+    def error_out(self):
+        buf = getattr(self._buffers, 'out', None)
+        if buf is not None:
+            return buf
+        return self._error_out
+
+
+    @error_out.setter
+    def error_out(self, err):
+        self._error_out = err
+
+
+    def buffer_output(self, out=None):
+        """collects all output of the calling thread in memory, or
+        passes it to the file-like object out, until release_output()
+        is called
+        """
+        self._buffers.out = out if out is not None else io.StringIO()
+
+
+    def is_buffered(self):
+        """returns True if the calling thread's output is buffered"""
+        return getattr(self._buffers, 'out', None) is not None
+
+
+    def release_output(self):
+        """stops buffering the calling thread's output
+        and returns everything collected so far
+        """
+        buf = getattr(self._buffers, 'out', None)
+        self._buffers.out = None
+        if not isinstance(buf, io.StringIO):
+            return ''
+        return buf.getvalue()
+
+
     def _color (self, col, text):
         return codes[col] + text + codes['reset']
 
@@ -99,6 +154,13 @@ class MessageBase(object):
     def set_debug_level(self, debugging_level = DEBUG_LEVEL):
         self.debug_lev = debugging_level
 
+
+    def is_enabled(self, level):
+        """returns True if debug output of that level is shown,
+        to skip collecting what only a debug message needs
+        """
+        return level <= self.debug_lev
+
     def do_error_callback(self, error):
         """runs the error_callback function with the error
         that occurred
@@ -129,15 +191,22 @@ class Message(MessageBase):
 
     ## Output Functions
 
-    def debug(self, info, level = OFF):
-        """empty debug function, does nothing,
-        declared here for compatibility with DebugMessage
-        """
-        info = encode(info)
+    def debug(self, info, level = OFF, *args):
+        """prints a debug message if its level is enabled
 
+        The message is only built if it is printed: info may be a
+        format string for args, e.g. debug('Reading %s', 8, path), or
+        a callable returning the message.
+        """
         if level > self.debug_lev:
             return
 
+        if callable(info):
+            info = info()
+        if args:
+            info = info % args
+        info = encode(info)
+
         for i in info.split('\n'):
             print(self.color_func('yellow', 'DEBUG: ') + i, file=self.std_out)
 
@@ -6,14 +6,11 @@ import sys
 import shutil
 import tempfile
 
-import xml.etree.ElementTree as ET # Python 2.5
-
 from  layman.constants         import MOUNT_TYPES
 from  layman.compatibility     import fileopen
 from  layman.overlays.source   import OverlaySource, require_supported
-from  layman.utils             import path
+from  layman.utils             import path, retry_call
 from  layman.version           import VERSION
-from  sslfetch.connections     import Connector
 
 USERAGENT = "Layman-" + VERSION
 
@@ -46,6 +43,7 @@ class ArchiveOverlay(OverlaySource):
         ext = self.get_extension()
  
         if 'file://' not in archive_url:
+            from sslfetch.connections import Connector
             # set up ssl-fetch output map
             connector_output = {
                 'info': self.output.debug,
@@ -57,7 +55,12 @@ class ArchiveOverlay(OverlaySource):
 
             fetcher = Connector(connector_output, self.proxies, USERAGENT)
 
-            success, archive, timestamp = fetcher.fetch_content(archive_url)
+            success, archive, timestamp = retry_call(self.config,
+                lambda: fetcher.fetch_content(archive_url),
+                failed=lambda result: not result[0],
+                what='Fetching %s' % archive_url)
+            if success:
+                self.config['stats'].count_bytes(len(archive))
 
             pkg = path([base, self.parent.name + ext])
 
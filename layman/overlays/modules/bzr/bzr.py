@@ -28,7 +28,7 @@ __version__ = "$Id: bzr.py 236 2006-09-05 20:39:37Z wrobel $"
 #
 #-------------------------------------------------------------------------------
 
-from   layman.utils             import path, run_command
+from   layman.utils             import command_output, path, run_command
 from   layman.overlays.source   import OverlaySource, require_supported
 
 #===============================================================================
@@ -119,6 +119,20 @@ class BzrOverlay(OverlaySource):
                         cmd=self.type),
             cwd=target)
 
+    def upstream_revision(self):
+        '''Revision id of the source branch.'''
+
+        if not self.supported():
+            return None
+
+        # bzr revision-info -d SOURCE
+        args = ['revision-info', '-d', self._fix_bzr_source(self.src)]
+        text = command_output(self.config, self.command(), args,
+                              cmd=self.type)
+        if not text or not text.strip():
+            return None
+        return text.split()[-1]
+
     def supported(self):
         '''Overlay type supported?'''
 
@@ -26,8 +26,25 @@ __version__ = "$Id: git.py 146 2006-05-27 09:52:36Z wrobel $"
 #
 #-------------------------------------------------------------------------------
 
-from   layman.utils             import path, run_command
-from   layman.overlays.source   import OverlaySource, require_supported
+import os
+import threading
+
+from   layman.utils             import (command_output, get_int_option,
+                                        path, run_command)
+from   layman.overlays.source   import (NETWORK_ERRORS, OverlaySource,
+                                        require_supported)
+
+# Values of the git_clone_mode option and the extra clone arguments
+CLONE_MODES = {
+    'full': [],
+    'shallow': None, # --depth, see GitOverlay.clone_args()
+    'blobless': ['--filter=blob:none'],
+    'treeless': ['--filter=tree:0'],
+}
+
+# Serializes creating and gc'ing the shared object cache between
+# parallel syncs.
+_object_cache_lock = threading.Lock()
 
 #===============================================================================
 #
@@ -40,6 +57,17 @@ class GitOverlay(OverlaySource):
 
     type = 'Git'
     type_key = 'git'
+    # git dies with 128 on any fatal error, "git pull" with 1 if its
+    # fetch failed; only those printing a network error are retried
+    transient_codes = (1, 128)
+    transient_errors = NETWORK_ERRORS + [
+        'the remote end hung up unexpectedly',
+        'early EOF',
+        'RPC failed',
+        'Failed to connect to',
+        'returned error: 5\\d\\d',
+        'gnutls_handshake\\(\\) failed',
+    ]
 
     def __init__(self, parent, config, _location, ignore = 0):
         super(GitOverlay, self).__init__(parent, config,
@@ -74,6 +102,10 @@ class GitOverlay(OverlaySource):
             args.append('-q')
         if len(cfg_opts):
             args.extend(cfg_opts.split())
+        args.extend(self.clone_args())
+        cache = self._object_cache()
+        if cache and self._update_object_cache(cache):
+            args.extend(['--reference', cache])
         args.append(self._fix_git_source(self.src))
         args.append(target)
 
@@ -86,22 +118,124 @@ class GitOverlay(OverlaySource):
         # but changing dir works around it.
         success = run_command(self.config, self.command(), args,cmd=self.type,
                               cwd=base)
-        self.output.debug("cloned git repo...success=%s" % str(success), 8)
+        self.output.debug("cloned git repo...success=%s", 8, success)
         success = self.set_user(target)
         return self.postsync(success, cwd=target)
 
+    def clone_mode(self):
+        '''
+        Returns the clone mode of this overlay. git_clone_mode holds the
+        default mode and optionally "name=mode" entries for single
+        overlays, e.g. "full gentoo-zh=shallow kde=blobless".
+        '''
+        mode = 'full'
+        for entry in (self.config['git_clone_mode'] or '').split():
+            name, sep, value = entry.rpartition('=')
+            if not sep:
+                mode = value
+            elif name == self.parent.name:
+                mode = value
+                break
+        if not mode in CLONE_MODES:
+            self.output.warn('Invalid git_clone_mode "%(mode)s" for overlay'
+                ' "%(repo)s", using a full clone.'
+                % {'mode': mode, 'repo': self.parent.name})
+            return 'full'
+        return mode
+
+    def clone_args(self):
+        '''Extra git clone arguments of the clone mode.'''
+        mode = self.clone_mode()
+        if mode == 'shallow':
+            return ['--depth', str(self._depth())]
+        return CLONE_MODES[mode]
+
+    def _depth(self):
+        return max(1, get_int_option(self.config, 'git_depth', 1))
+
+    def _object_cache(self):
+        '''
+        Returns the path of the shared object cache if full clones of
+        this overlay should borrow objects from it, else None.
+        '''
+        cache = self.config['git_object_cache']
+        if not cache or self.clone_mode() != 'full':
+            return None
+        return cache
+
+    def _uses_object_cache(self, target, cache):
+        alternates = path([target, '.git', 'objects', 'info', 'alternates'])
+        try:
+            with open(alternates) as f:
+                paths = [os.path.realpath(p.strip()) for p in f]
+        except (IOError, OSError):
+            return False
+        return os.path.realpath(path([cache, 'objects'])) in paths
+
+    def _update_object_cache(self, cache):
+        '''
+        Fetches the branches of the overlay into the shared bare object
+        cache, under refs/layman/<overlay name>/. The refs stay after the
+        overlay is deleted, so adding it again only fetches what changed.
+
+        @rtype bool: False if the cache could not be updated.
+        '''
+        with _object_cache_lock:
+            if not os.path.isdir(cache) and self._init_object_cache(cache):
+                return False
+
+        # git --git-dir CACHE fetch -q --no-tags SOURCE REFSPEC
+        args = ['--git-dir', cache, 'fetch', '-q', '--no-tags',
+                self._fix_git_source(self.src),
+                '+refs/heads/*:refs/layman/%s/*' % self.parent.name]
+        if run_command(self.config, self.command(), args, cmd=self.type):
+            self.output.warn('Failed to update the git object cache "%s" '
+                'for overlay "%s", cloning without it.'
+                % (cache, self.parent.name))
+            return False
+
+        self.gc_object_cache(cache)
+        return True
+
+    def _init_object_cache(self, cache):
+        '''
+        Creates the shared object cache. Clones borrow objects from it
+        through their alternates, so it must never drop an object: auto
+        gc is off and gc_object_cache() never prunes.
+        '''
+        result = run_command(self.config, self.command(),
+                             ['init', '-q', '--bare', cache], cmd=self.type)
+        for key, value in (('gc.auto', '0'), ('gc.pruneExpire', 'never'),
+                           ('gc.reflogExpireUnreachable', 'never')):
+            if result:
+                break
+            result = run_command(self.config, self.command(),
+                                 ['--git-dir', cache, 'config', key, value],
+                                 cmd=self.type)
+        return result
+
+    def gc_object_cache(self, cache):
+        '''
+        Repacks the shared object cache when git deems it worthwhile.
+        Unreachable objects are kept, a clone may still depend on them.
+        '''
+        with _object_cache_lock:
+            return run_command(self.config, self.command(),
+                               ['--git-dir', cache, 'gc', '--auto', '--quiet',
+                                '--prune=never'], cmd=self.type)
+
     def set_user(self, target):
         '''Set dummy user.name and user.email to prevent possible errors'''
         user = '"%s"' % self.config['git_user']
         email = '"%s"' % self.config['git_email']
         args = ['config', 'user.name', user]
-        self.output.debug("set git user info...args=%s" % ' '.join(args), 8)
+        self.output.debug("set git user info...args=%s", 8, ' '.join(args))
         failure = run_command(self.config, self.command(), args, cmd=self.type, cwd=target)
         if failure:
             self.output.debug("set git user info...failure setting name")
             return failure
         args = ['config', 'user.email', email]
-        self.output.debug("set git user info...args=%s" % ' '.join(args), 8)
+        self.output.debug("set git user info...args=%s", 8, ' '.join(args))
         return run_command(self.config, self.command(), args, cmd=self.type,
                            cwd=target)
 
@@ -112,7 +246,7 @@ class GitOverlay(OverlaySource):
         @params base: base location where all overlays are installed.
         @params src:  source URL.
         '''
-        self.output.debug("git.update(); starting...%s" % self.parent.name, 6)
+        self.output.debug("git.update(); starting...%s", 6, self.parent.name)
         target = path([base, self.parent.name])
 
         # git remote set-url <name> <newurl> <oldurl>
@@ -124,13 +258,23 @@ class GitOverlay(OverlaySource):
     def sync(self, base):
         '''Sync overlay.'''
 
-        self.output.debug("git.sync(); starting...%s" % self.parent.name, 6)
+        self.output.debug("git.sync(); starting...%s", 6, self.parent.name)
         if not self.supported():
             return 1
 
-        cfg_opts = self.config["git_syncopts"]
         target = path([base, self.parent.name])
 
+        if self.clone_mode() == 'shallow':
+            return self.postsync(self._sync_shallow(target), cwd=target)
+
+        cfg_opts = self.config["git_syncopts"]
+
+        # Fetch the new objects into the shared cache, the pull then finds
+        # them there.
+        cache = self._object_cache()
+        if cache and self._uses_object_cache(target, cache):
+            self._update_object_cache(cache)
+
         args = ['pull']
         if self.config['quiet']:
             args.append('-q')
@@ -139,9 +283,57 @@ class GitOverlay(OverlaySource):
 
         return self.postsync(
             run_command(self.config, self.command(), args, cwd=target,
-                        cmd=self.type),
+                        cmd=self.type, errors=self.sync_errors),
             cwd=target)
 
+    def _sync_shallow(self, target):
+        '''
+        Fetches only the tip of the branch at the configured depth and
+        moves the checkout to it. Unlike "git pull", which deepens a
+        shallow clone with every sync, this keeps it shallow.
+        git_syncopts holds "git pull" options, git_fetchopts is used
+        instead.
+        '''
+        cfg_opts = self.config["git_fetchopts"]
+        # git fetch [-q] --depth DEPTH origin BRANCH|HEAD
+        args = ['fetch']
+        if self.config['quiet']:
+            args.append('-q')
+        if len(cfg_opts):
+            args.extend(cfg_opts.split())
+        args.extend(['--depth', str(self._depth()), 'origin',
+                     self.branch or 'HEAD'])
+        result = run_command(self.config, self.command(), args, cwd=target,
+                             cmd=self.type, errors=self.sync_errors)
+        if result:
+            return result
+
+        # git reset [-q] --merge FETCH_HEAD
+        args = ['reset']
+        if self.config['quiet']:
+            args.append('-q')
+        args.extend(['--merge', 'FETCH_HEAD'])
+        return run_command(self.config, self.command(), args, cwd=target,
+                           cmd=self.type)
+
+    def upstream_revision(self):
+        '''Commit id of the branch (or HEAD) in the source repo.'''
+
+        if not self.supported():
+            return None
+
+        ref = 'HEAD'
+        if self.branch:
+            ref = 'refs/heads/' + self.branch
+
+        # git ls-remote SOURCE REF
+        args = ['ls-remote', self._fix_git_source(self.src), ref]
+        text = command_output(self.config, self.command(), args,
+                              cmd=self.type)
+        if not text or not text.strip():
+            return None
+        return text.split()[0]
+
     def supported(self):
         '''Overlay type supported?'''
 
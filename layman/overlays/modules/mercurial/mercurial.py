@@ -29,8 +29,9 @@ __version__ = "$Id: mercurial.py 236 2006-09-05 20:39:37Z wrobel $"
 
 import re
 
-from   layman.utils             import path, run_command
-from   layman.overlays.source   import OverlaySource, require_supported
+from   layman.utils             import command_output, path, run_command
+from   layman.overlays.source   import (NETWORK_ERRORS, OverlaySource,
+                                        require_supported)
 
 #===============================================================================
 #
@@ -43,6 +44,13 @@ class MercurialOverlay(OverlaySource):
 
     type = 'Mercurial'
     type_key = 'mercurial'
+    # hg aborts with 255 on any error, only those printing a network
+    # error are retried
+    transient_codes = (255,)
+    transient_errors = NETWORK_ERRORS + [
+        'HTTP Error 5\\d\\d',
+        'no suitable response from remote hg',
+    ]
 
     def __init__(self, parent, config,
         _location, ignore = 0):
@@ -128,9 +136,26 @@ class MercurialOverlay(OverlaySource):
 
         return self.postsync(
             run_command(self.config, self.command(), args, cwd=target,
-                        cmd=self.type),
+                        cmd=self.type, errors=self.sync_errors),
             cwd=target)
 
+    def upstream_revision(self):
+        '''Changeset id of the branch (or tip) in the source repo.'''
+
+        if not self.supported():
+            return None
+
+        # hg identify [-r BRANCH] SOURCE
+        args = ['identify']
+        if self.branch:
+            args.extend(['-r', self.branch])
+        args.append(self._fix_mercurial_source(self.src))
+        text = command_output(self.config, self.command(), args,
+                              cmd=self.type)
+        if not text or not text.strip():
+            return None
+        return text.split()[0]
+
     def supported(self):
         '''Overlay type supported?'''
 
@@ -40,6 +40,8 @@ class RsyncOverlay(OverlaySource):
 
     type = 'Rsync'
     type_key = 'rsync'
+    # Protocol start, socket I/O, data stream and timeout errors
+    transient_codes = (5, 10, 12, 30, 35)
 
 
     def __init__(self, parent, config, _location, ignore = 0):
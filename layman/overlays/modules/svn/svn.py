@@ -30,8 +30,10 @@ from subprocess import PIPE, Popen
 #
 #------------------------------------------------------------------------------
 
-from layman.utils           import path, resolve_command, run_command
-from layman.overlays.source import (OverlaySource, require_supported)
+from layman.utils           import (command_output, path, resolve_command,
+                                   run_command)
+from layman.overlays.source import (NETWORK_ERRORS, OverlaySource,
+                                   require_supported)
 
 #==============================================================================
 #
@@ -44,6 +46,15 @@ class SvnOverlay(OverlaySource):
 
     type = 'Subversion'
     type_key = 'svn'
+    # svn fails with 1 on any error, only those printing a network error
+    # are retried
+    transient_codes = (1,)
+    transient_errors = NETWORK_ERRORS + [
+        # Host lookup, connection timed out/refused/reset, connection
+        # closed by the server
+        'E670002', 'E670008', 'E000110', 'E000111', 'E000104', 'E175012',
+        'E120108',
+    ]
 
     def __init__(self, parent, config, _location,
             ignore = 0):
@@ -86,7 +97,8 @@ class SvnOverlay(OverlaySource):
         args.append(self.target)
 
         return self.postsync(
-            run_command(self.config, self.command(), args, cmd=self.type),
+            run_command(self.config, self.command(), args, cmd=self.type,
+                        on_cancel=self.cleanup),
             cwd=self.target)
 
     def update(self, base, src):
@@ -97,7 +109,7 @@ class SvnOverlay(OverlaySource):
         @params src: source URL.
         '''
 
-        self.output.debug("svn.update(); starting...%s" % self.parent.name, 6)
+        self.output.debug("svn.update(); starting...%s", 6, self.parent.name)
         target = path([base, self.parent.name])
 
         # svn switch --relocate <oldurl> <newurl>
@@ -138,9 +150,27 @@ class SvnOverlay(OverlaySource):
         args.append(self.target)
 
         return self.postsync(
-            run_command(self.config, self.command(), args, cmd=self.type),
+            run_command(self.config, self.command(), args, cmd=self.type,
+                        on_cancel=self.cleanup, errors=self.sync_errors),
             cwd=self.target)
 
+    def upstream_revision(self):
+        '''Last changed revision of the source url.'''
+
+        if not self.supported():
+            return None
+
+        # svn info --non-interactive SOURCE
+        args = ['info', '--non-interactive', self._fix_svn_source(self.src)]
+        text = command_output(self.config, self.command(), args,
+                              cmd=self.type)
+        if not text:
+            return None
+        for line in text.splitlines():
+            if line.startswith('Last Changed Rev:'):
+                return line.split(':', 1)[1].strip()
+        return None
+
     def supported(self):
         '''Overlay type supported?'''
 
@@ -175,7 +205,7 @@ class SvnOverlay(OverlaySource):
 
         upgrade_output = stdout.strip('\n')
         if upgrade_output:
-            self.output.debug("  output: %r" % upgrade_output, 4)
+            self.output.debug("  output: %r", 4, upgrade_output)
         self.output.debug("SVN: check_upgrade()... svn upgrade done", 4)
         pipe.terminate()
         pipe.stdout.close()
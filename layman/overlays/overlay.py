@@ -38,11 +38,11 @@ import os
 import os.path
 import re
 import sys
-import xml.etree.ElementTree as ET # Python 2.5
 
 from  layman.compatibility import encode
-from  layman.module        import Modules, InvalidModuleName
-from  layman.utils         import pad, terminal_width, get_encoding, encoder
+from  layman.module        import get_modules, InvalidModuleName
+from  layman.utils         import (command_deadline, pad, retry_call,
+                                  terminal_width, get_encoding, encoder)
 
 #===============================================================================
 #
@@ -56,15 +56,29 @@ QUALITY_LEVELS = 'core|stable|testing|experimental|graveyard'.split('|')
 WHITESPACE_REGEX = re.compile('\s+')
 
 
+def xml_name(xml):
+    '''
+    Returns the name of an xml overlay definition, None if it has none.
+    '''
+    _name = xml.find('name')
+    if _name != None:
+        if _name.text is None:
+            return encode('')
+        return encode(_name.text.strip())
+    if 'name' in xml.attrib:
+        return encode(xml.attrib['name'])
+    return None
+
+
 class Overlay(object):
     ''' Derive the real implementations from this.'''
 
     def __init__(self, config, json=None, ovl_dict=None, xml=None, ignore=0):
         self.config = config
         self.output = config['output']
-        self.module_controller = Modules(path=MOD_PATH,
-                                         namepath='layman.overlays.modules',
-                                         output=self.output)
+        self.module_controller = get_modules(path=MOD_PATH,
+                                             namepath='layman.overlays.modules',
+                                             output=self.output)
         self._encoding_ = get_encoding(self.output)
 
         if xml is not None:
@@ -110,7 +124,8 @@ class Overlay(object):
             if not first_s:
                 self.output.info('\nTrying next source of listed sources...', 4)
             try:
-                res = s.add(base)
+                with command_deadline(s.timeout()):
+                    res = s.add(base)
                 if res == 0:
                     # Worked, throw other sources away
                     self.sources = [s]
@@ -152,8 +167,7 @@ class Overlay(object):
         '''
         Process an overlay dictionary definition
         '''
-        msg = 'Overlay from_dict(); overlay %(ovl)s' % {'ovl': str(overlay)}
-        self.output.debug(msg, 6)
+        self.output.debug('Overlay from_dict(); overlay %s', 6, overlay)
 
         _name = overlay['name']
         if _name != None:
@@ -181,10 +195,11 @@ class Overlay(object):
                 _class = self.module_controller.get_class('stub')
 
             _location = encode(_src)
+            # An unset branch is '', the same as from_xml() leaves it
             if _sub:
                 self.branch = encode(_sub)
             else:
-                self.branch = None
+                self.branch = ''
 
             return _class(parent=self, config=self.config,
                 _location=_location, ignore=ignore)
@@ -196,7 +211,7 @@ class Overlay(object):
         if 'owner' in overlay:
             for _owner in overlay['owner']:
                 owner = {}
-                if 'name' in _owner and _owner['name']:
+                if _owner.get('name') is not None:
                     owner['name'] = encode(_owner['name'])
                 else:
                     owner['name'] = None
@@ -272,8 +287,7 @@ class Overlay(object):
         '''
         Process a json overlay definition
         '''
-        msg = 'Overlay from_json(); overlay %(ovl)s' % {'ovl': str(json)}
-        self.output.debug(msg, 6)
+        self.output.debug('Overlay from_json(); overlay %s', 6, json)
 
         _name = json['name']
         if _name != None:
@@ -403,12 +417,10 @@ class Overlay(object):
                 return ''
             return res.strip()
 
-        _name = xml.find('name')
+        _name = xml_name(xml)
 
         if _name != None:
-            self.name = encode(strip_text(_name))
-        elif 'name' in xml.attrib:
-            self.name = encode(xml.attrib['name'])
+            self.name = _name
         else:
             msg = 'Overlay from_xml(), "name" entry missing from xml!'
             raise Exception(msg)
@@ -420,6 +432,7 @@ class Overlay(object):
             _sources = [e for e in _sources if 'type' in e.attrib]
         #old xml format
         elif ('src' in xml.attrib) and ('type' in xml.attrib):
+            import xml.etree.ElementTree as ET
             s = ET.Element('source', type=xml.attrib['type'])
             s.text = xml.attrib['src']
             _sources = [s]
@@ -668,11 +681,56 @@ class Overlay(object):
 
 
     def sync(self, base):
-        msg = 'Overlay.sync(); name = %(name)s' % {'name': self.name}
-        self.output.debug(msg, 4)
+        self.output.debug('Overlay.sync(); name = %s', 4, self.name)
 
         assert len(self.sources) == 1
-        return self.sources[0].sync(base)
+        source = self.sources[0]
+
+        def attempt():
+            source.sync_errors = []
+            with command_deadline(source.timeout()):
+                return source.sync(base)
+
+        return retry_call(self.config, attempt, failed=source.is_transient,
+                          what='Syncing overlay "%s"' % self.name)
+
+
+    def upstream_revision(self):
+        '''
+        Returns the id of the current upstream revision or None if it can
+        not be looked up cheaply, see OverlaySource.upstream_revision().
+        '''
+        assert len(self.sources) == 1
+        with command_deadline(self.sources[0].timeout()):
+            return self.sources[0].upstream_revision()
+
+
+    def to_dict(self):
+        '''
+        Convert to a dictionary that from_dict() turns back into an equal
+        overlay. Entries without a value are left out.
+        '''
+        repo = {}
+
+        repo['name'] = self.name
+        repo['source'] = [(i.src, i.__class__.type_key, i.branch)
+                          for i in self.sources]
+        repo['owner'] = []
+        for _owner in self.owners:
+            owner = {}
+            for key in ('name', 'email'):
+                if _owner.get(key) != None:
+                    owner[key] = _owner[key]
+            repo['owner'].append(owner)
+        repo['description'] = list(self.descriptions)
+        repo['quality'] = self.quality
+        repo['priority'] = self.priority
+        repo['feed'] = list(self.feeds or [])
+        for key in ('status', 'license', 'homepage', 'irc'):
+            if getattr(self, key) != None:
+                repo[key] = getattr(self, key)
+
+        return repo
 
 
     def to_json(self):
@@ -713,6 +771,7 @@ class Overlay(object):
         '''
         Convert to xml.
         '''
+        import xml.etree.ElementTree as ET
         repo = ET.Element('repo')
         if self.status != None:
             repo.attrib['status'] = self.status
@@ -790,7 +849,8 @@ class Overlay(object):
                 if not first_src:
                     self.output.info('\nTrying next source of listed sources...', 4)
                 try:
-                    res = self.sources[0].update(base, src)
+                    with command_deadline(self.sources[0].timeout()):
+                        res = self.sources[0].update(base, src)
                     if res == 0:
                         # Updating it worked, no need to bother 
                         # checking other sources.
@@ -804,9 +864,8 @@ class Overlay(object):
             # Update the overlay source with the remote
             # source, assuming that it's telling the truth
             # so it can be written to the installed.xml.
-            msg = 'Overlay.update(); type: "%(src_type)s does not support '\
-                  'source URL updating' % {'src_type': self.sources[0].type}
-            self.output.debug(msg, 4)
+            self.output.debug('Overlay.update(); type: "%s does not support '
+                              'source URL updating', 4, self.sources[0].type)
 
             self.sources[0].src = available_srcs.pop()
             result = True
@@ -17,13 +17,28 @@ from __future__ import unicode_literals
 
 import os
 import copy
+import re
 import sys
 import shutil
 import subprocess
-from layman.utils import path, resolve_command, run_command
+from layman.utils import get_int_option, path, resolve_command, run_command
 
 supported_cache = {}
 
+# What commands print on stderr when the network fails them, in the C
+# locale; failures reported in other languages are not retried.
+NETWORK_ERRORS = [
+    'Could not resolve host',
+    'Temporary failure in name resolution',
+    'Name or service not known',
+    'Connection refused',
+    'Connection reset',
+    'Connection timed out',
+    'Operation timed out',
+    'Network is unreachable',
+    'No route to host',
+]
+
 def _supported(key, check_supported=None):
     """internal caching function that checks tracks any
     un-supported/supported repo types."""
@@ -49,6 +64,13 @@ def require_supported(binaries, _output):
 class OverlaySource(object):
 
     type_key = None
+    # Exit codes of a failed sync that may be caused by the network and
+    # are worth another attempt
+    transient_codes = ()
+    # Patterns of network errors on stderr. If set, a sync failing with
+    # one of the transient_codes is only retried if one of them matches
+    # what it printed, for commands with one exit code for all errors.
+    transient_errors = ()
 
     def __init__(self, parent, config, _location,
             ignore = 0):
@@ -56,6 +78,8 @@ class OverlaySource(object):
         self.src = _location
         self.config = config
         self.ignore = ignore
+        # What the commands of the last sync printed on stderr
+        self.sync_errors = []
 
         self.output = config['output']
 
@@ -90,6 +114,27 @@ class OverlaySource(object):
         '''Sync the overlay.'''
         pass
 
+    def is_transient(self, result):
+        '''
+        Tells whether a sync that returned result failed because of the
+        network and is worth another attempt.
+        '''
+        if not result in self.transient_codes:
+            return False
+        if not self.transient_errors:
+            return True
+        pattern = re.compile('|'.join(self.transient_errors), re.IGNORECASE)
+        return any(pattern.search(line) for line in self.sync_errors)
+
+    def upstream_revision(self):
+        '''
+        Returns an id of the current upstream revision if the overlay
+        type can look it up without fetching any content, else None.
+        Overlays whose upstream revision did not change since their last
+        sync are not synced again.
+        '''
+        return None
+
     def delete(self, base):
         '''Delete the overlay.'''
         mdir = path([base, self.parent.name])
@@ -117,6 +162,16 @@ class OverlaySource(object):
     def command(self):
         return self.config['%s_command' % self.__class__.type_key]
 
+    def timeout(self):
+        '''
+        Wall clock limit in seconds for the commands of one add, sync or
+        update of this type, 0 for none.
+        '''
+        key = '%s_timeout' % self.__class__.type_key
+        if self.config[key] is None:
+            return 0
+        return get_int_option(self.config, key, 0)
+
     def postsync(self, failed_sync, **kwargs):
         """Runs any repo specific postsync operations
         """
@@ -26,27 +26,42 @@ __version__ = "$Id: db.py 309 2007-04-09 16:23:38Z wrobel $"
 #
 #-------------------------------------------------------------------------------
 
+import functools
+import gzip
+import io
+import json
 import os, os.path
 import sys
 import hashlib
-
-GPG_ENABLED = False
-try:
-    from pygpg.config import GPGConfig
-    from pygpg.gpg import GPG
-    GPG_ENABLED = True
-except ImportError:
-    pass
-
-
-from   layman.utils             import encoder
-from   layman.dbbase            import DbBase
+import pickle
+
+# pygpg is imported by init_gpg(), only if a signed list is fetched
+if sys.hexversion >= 0x30400f0:
+    from importlib.util import find_spec
+    GPG_ENABLED = find_spec('pygpg') is not None
+else:
+    import imp
+    try:
+        imp.find_module('pygpg')
+        GPG_ENABLED = True
+    except ImportError:
+        GPG_ENABLED = False
+
+
+from   layman.utils             import (encoder, get_host, get_int_option,
+                                        retry_call, write_compressed,
+                                        COMPRESSIONS,
+                                        XZ_SUPPORT)
+from   layman.scheduler         import Scheduler
+from   layman.dbbase            import DbBase, OverlayDict
 from   layman.version           import VERSION
 from   layman.compatibility     import fileopen
-from   sslfetch.connections     import Connector
 
 USERAGENT = "Layman-" + VERSION
 
+# Bump whenever the layout of the parsed catalog snapshot changes
+SNAPSHOT_VERSION = 1
+
 class RemoteDB(DbBase):
     '''Handles fetching the remote overlay list.'''
 
@@ -76,12 +91,10 @@ class RemoteDB(DbBase):
         paths.extend([self.filepath(i) + '.xml' for i in self.signed_urls])
 
         self.output.debug('RemoteDB.__init__(), url lists= \nself.urls: '
-            '%s\nself.detached_urls: %s\nself.signed_urls: %s'
-            % (str(self.urls), str(self.detached_urls), str(self.signed_urls)),
-            2)
+            '%s\nself.detached_urls: %s\nself.signed_urls: %s', 2,
+            self.urls, self.detached_urls, self.signed_urls)
 
-        self.output.debug('RemoteDB.__init__(), paths to load = %s' %str(paths),
-            2)
+        self.output.debug('RemoteDB.__init__(), paths to load = %s', 2, paths)
         if config['nocheck']:
             ignore = 2
         else:
@@ -89,9 +102,16 @@ class RemoteDB(DbBase):
 
         #quiet = int(config['quietness']) < 3
 
+        self._load_snapshot()
+        self._http_index = None
+        # url -> validators of a download not yet written to the cache
+        self._new_validators = {}
+
         DbBase.__init__(self, config, paths=paths, ignore=ignore,
             ignore_init_read_errors=ignore_init_read_errors)
 
+        self._save_snapshot()
+
         self.gpg = None
         self.gpg_config = None
 
@@ -101,6 +121,99 @@ class RemoteDB(DbBase):
         return 'Try running "sudo layman -f" to re-fetch that file'
 
 
+    # overrider
+    def read_db(self, path, text=None, text_type=None, overlays=None):
+        '''
+        Read a cached overlay list, from the parsed catalog snapshot if
+        the list did not change since it was last parsed.
+        '''
+        if text or overlays is not None:
+            return DbBase.read_db(self, path, text=text, text_type=text_type,
+                                  overlays=overlays)
+
+        stamp = self._snapshot_stamp(path)
+        entry = self._snapshot.get(path)
+        if entry is not None and entry['stamp'] == stamp:
+            self.output.debug('RemoteDB.read_db(), using the snapshot of %s',
+                8, path)
+            for ovl_dict in entry['overlays']:
+                self.overlays.add_record(ovl_dict['name'], 'ovl_dict',
+                                         ovl_dict, self.config, self.ignore)
+            return True
+
+        parsed = OverlayDict()
+        success = DbBase.read_db(self, path, overlays=parsed)
+        self.overlays.update(parsed)
+        if success and stamp is not None:
+            self._snapshot[path] = {
+                'stamp': stamp,
+                'overlays': [ovl.to_dict() for ovl in parsed.values()],
+            }
+            self._snapshot_changed = True
+        return success
+
+
+    def _snapshot_path(self):
+        return self.config['cache'] + '_snapshot.pickle'
+
+
+    def _snapshot_stamp(self, path):
+        '''
+        Returns what a snapshot entry of path is valid for: the file's
+        mtime and size and the strictness it was parsed with.
+        '''
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, self.ignore)
+
+
+    def _load_snapshot(self):
+        '''
+        Loads the snapshot of the parsed cached overlay lists.
+        '''
+        self._snapshot = {}
+        self._snapshot_changed = False
+        try:
+            with open(self._snapshot_path(), 'rb') as snapshot:
+                data = pickle.load(snapshot)
+        except Exception as error:
+            self.output.debug('RemoteDB._load_snapshot(), no usable '
+                'snapshot: %s', 8, error)
+            return
+        if (isinstance(data, dict)
+            and data.get('version') == (SNAPSHOT_VERSION, VERSION)):
+            self._snapshot = data['paths']
+
+
+    def _save_snapshot(self):
+        '''
+        Writes the snapshot back if any list had to be parsed.
+        '''
+        if not self._snapshot_changed:
+            return
+        self._snapshot_changed = False
+        # Drop lists no longer configured
+        paths = set(self.paths)
+        for path in list(self._snapshot):
+            if not path in paths:
+                del self._snapshot[path]
+        spath = self._snapshot_path()
+        tmp = spath + '.%d.tmp' % os.getpid()
+        try:
+            with open(tmp, 'wb') as snapshot:
+                pickle.dump({'version': (SNAPSHOT_VERSION, VERSION),
+                             'paths': self._snapshot}, snapshot,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, spath)
+        except (IOError, OSError) as error:
+            self.output.debug('RemoteDB._save_snapshot(), failed to write '
+                '%s: %s', 4, spath, error)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+
     def cache(self):
         '''
         Copy the remote overlay list to the local cache.
@@ -108,14 +221,101 @@ class RemoteDB(DbBase):
         @rtype tuple: reflects whether the cache has updates and whether or not
         the cache retrieval was successful.
         '''
+        with self.config['stats'].measure(self.config, 'cache',
+                                          'remote lists') as stats:
+            has_updates, succeeded = self._cache()
+            stats.update(result=0 if succeeded else 1,
+                         skipped=not has_updates)
+        return has_updates, succeeded
+
+
+    def _cache(self):
         has_updates = False
         self._create_storage(self.config['storage'])
         # succeeded reset when a failure is detected
         succeeded = True
         url_lists = [self.urls, self.detached_urls, self.signed_urls]
         need_gpg = [False, True, True]
-        # setup the ssl-fetch output map
-        connector_output = {
+
+        if (self.detached_urls or self.signed_urls) and self.gpg is None:
+            #initialize our gpg instance
+            self.init_gpg()
+
+        # The lists (and detached signatures) are downloaded in parallel,
+        # verifying and parsing them happens here as each one arrives.
+        tasks = []
+        for index in range(0, 3):
+            for url in url_lists[index]:
+                src = url[0] if isinstance(url, tuple) else url
+                tasks.append(((index, url),
+                              functools.partial(self._fetch_list, url),
+                              get_host(src)))
+
+        self._load_http_index()
+        compression = self._cache_compression()
+        jobs = get_int_option(self.config, 'fetch_jobs', 1)
+        max_per_host = get_int_option(self.config, 'max_per_host', 0)
+        scheduler = Scheduler(self.output, jobs, max_per_host)
+
+        for (index, url), result, error in scheduler.iter_results(tasks):
+            if error is not None:
+                raise error
+            success, olist, timestamp = result
+            if not success:
+                #succeeded = False
+                continue
+
+            self.output.debug("RemoteDB.cache() len(olist) = %s", 2,
+                len(olist))
+            filepath, mpath, tpath, sig = self._paths(url)
+            # GPG handling
+            if need_gpg[index]:
+                olist, verified = self.verify_gpg(url, sig, olist)
+                if not verified:
+                    self.output.debug("RemoteDB.cache() gpg returned "
+                        "verified = %s", 2, verified)
+                    succeeded = False
+                    filename = os.path.join(self.config['storage'],
+                                            "Failed-to-verify-sig")
+                    self.write_cache(olist, filename)
+                    continue
+
+            # Before we overwrite the old cache, check that the downloaded
+            # file is intact and can be parsed
+            if isinstance(url, tuple):
+                olist, parsed = self._check_download(olist, url[0])
+            else:
+                olist, parsed = self._check_download(olist, url)
+
+            # Ok, now we can overwrite the old cache
+            updated = self.write_cache(olist, mpath, tpath, timestamp,
+                                       compression)
+            list_url = url[0] if isinstance(url, tuple) else url
+            if updated and list_url in self._new_validators:
+                self._http_index[list_url] = self._new_validators.pop(
+                    list_url)
+                self._http_index_changed = True
+            if updated:
+                # The check above already parsed the new list, keep that
+                # parse so loading the cache does not repeat it.
+                self._snapshot[mpath] = {
+                    'stamp': self._snapshot_stamp(mpath),
+                    'overlays': [ovl.to_dict() for ovl in parsed.values()],
+                }
+                self._snapshot_changed = True
+            has_updates = max(has_updates, updated)
+
+        self._save_snapshot()
+        self._save_http_index()
+
+        self.output.debug("RemoteDB.cache() self.urls:  has_updates, "
+            "succeeded %s, %s", 4, has_updates, succeeded)
+        return has_updates, succeeded
+
+
+    def _connector_output(self):
+        '''Returns the ssl-fetch output map.'''
+        return {
             'info':  self.output.info,
             'debug': self.output.debug,
             'error': self.output.error,
@@ -129,65 +329,171 @@ class RemoteDB(DbBase):
             'kwargs-error':{'level': None},
             'kwargs-warning': {'level': 2},
         }
-        fetcher = Connector(connector_output, self.proxies, USERAGENT)
 
-        for index in range(0, 3):
-            self.output.debug("RemoteDB.cache() index = %s" %str(index), 2)
-            urls = url_lists[index]
-            if need_gpg[index] and len(urls) and self.gpg is None:
-                #initialize our gpg instance
-                self.init_gpg()
-            # main working loop
-            for url in urls:
-                sig = ''
-                self.output.debug("RemoteDB.cache() url = %s is a tuple=%s"
-                    %(str(url), str(isinstance(url, tuple))), 2)
-                filepath, mpath, tpath, sig = self._paths(url)
-                if 'file://' in url:
-                    success, olist, timestamp = self._fetch_file(
-                        url, mpath, tpath)
-                elif sig:
-                    success, olist, timestamp = fetcher.fetch_content(
-                        url[0], tpath, climit=60)
-                else:
-                    success, olist, timestamp = fetcher.fetch_content(
-                        url, tpath, climit=60)
-                if not success:
-                    #succeeded = False
-                    continue
 
-                self.output.debug("RemoteDB.cache() len(olist) = %s"
-                    % str(len(olist)), 2)
-                # GPG handling
-                if need_gpg[index]:
-                    olist, verified = self.verify_gpg(url, sig, olist)
-                    if not verified:
-                        self.output.debug("RemoteDB.cache() gpg returned "
-                            "verified = %s" %str(verified), 2)
-                        succeeded = False
-                        filename = os.path.join(self.config['storage'],
-                                                "Failed-to-verify-sig")
-                        self.write_cache(olist, filename)
-                        continue
-
-                # Before we overwrite the old cache, check that the downloaded
-                # file is intact and can be parsed
-                if isinstance(url, tuple):
-                    olist = self._check_download(olist, url[0])
-                else:
-                    olist = self._check_download(olist, url)
-
-                # Ok, now we can overwrite the old cache
-                has_updates = max(has_updates,
-                    self.write_cache(olist, mpath, tpath, timestamp))
-
-            self.output.debug("RemoteDB.cache() self.urls:  has_updates, "
-                "succeeded %s, %s" % (str(has_updates), str(succeeded)), 4)
-        return has_updates, succeeded
+    def _fetch_list(self, url):
+        '''
+        Downloads one overlay list and its detached signature, if any.
+        Runs in a worker thread, so it uses a connection of its own.
+
+        @rtype tuple: (success, olist, timestamp)
+        '''
+        self.output.debug("RemoteDB._fetch_list() url = %s is a tuple=%s", 2,
+            url, isinstance(url, tuple))
+        stats = self.config['stats']
+        with stats.measure(self.config, 'fetch',
+                url[0] if isinstance(url, tuple) else url) as record:
+            success, olist, timestamp = self._fetch_list_files(url)
+            if success:
+                stats.count_bytes(len(olist))
+            record['result'] = 0 if success or record['skipped'] else 1
+        return success, olist, timestamp
+
+
+    def _fetch_list_files(self, url):
+        filepath, mpath, tpath, sig = self._paths(url)
+        if 'file://' in url:
+            return self._fetch_file(url, mpath, tpath)
+
+        list_url = url[0] if sig else url
+        if list_url.startswith(('http://', 'https://')):
+            success, olist, timestamp = self._fetch_url(list_url, mpath)
+        else:
+            from sslfetch.connections import Connector
+            fetcher = Connector(self._connector_output(), self.proxies,
+                                USERAGENT)
+            success, olist, timestamp = fetcher.fetch_content(
+                list_url, tpath, climit=60)
+        if not sig:
+            return success, olist, timestamp
+
+        from sslfetch.connections import Connector
+        fetcher = Connector(self._connector_output(), self.proxies, USERAGENT)
+        if success and not self.dl_sig(url[1], sig, fetcher):
+            self.output.error('RemoteDB._fetch_list(); Failed to fetch the '
+                'signature %s' % url[1])
+        return success, olist, timestamp
+
+
+    def _fetch_url(self, url, mpath):
+        '''
+        Downloads a list over http(s) with a conditional request, using
+        the ETag and Last-Modified of the cached copy. Nothing but the
+        headers is transferred if the list did not change.
+
+        @rtype tuple: (success, olist, timestamp), success is False
+        if the cached copy is still up to date.
+        '''
+        import zlib
+        if sys.hexversion >= 0x30200f0:
+            from http.client import HTTPException
+            from urllib.error import HTTPError
+            from urllib.request import build_opener, ProxyHandler, Request
+        else:
+            from httplib import HTTPException
+            from urllib2 import build_opener, HTTPError, ProxyHandler, Request
+
+        headers = {'User-Agent': USERAGENT, 'Accept-Encoding': 'gzip'}
+        validators = self._http_index.get(url) or {}
+        if os.path.exists(mpath):
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        if self.proxies:
+            opener = build_opener(ProxyHandler(self.proxies))
+        else:
+            # the default handler honours http_proxy and no_proxy
+            opener = build_opener()
+
+        def download():
+            response = opener.open(Request(url, headers=headers), timeout=60)
+            try:
+                return response.read(), response.info()
+            finally:
+                response.close()
+
+        try:
+            olist, info = retry_call(self.config, download,
+                                     what='Fetching %s' % url)
+            if info.get('Content-Encoding') in ('gzip', 'x-gzip'):
+                olist = gzip.GzipFile(fileobj=io.BytesIO(olist)).read()
+        except HTTPError as error:
+            if error.code == 304:
+                self.config['stats'].note(skipped=True)
+                self.output.info('Remote list already up to date: %s'
+                    % url, 4)
+            else:
+                self.output.error('RemoteDB._fetch_url(); Failed to update '
+                    'the overlay list from: %s\nHTTP error was: %s'
+                    % (url, str(error)))
+            return (False, '', '')
+        except (IOError, OSError, EOFError, ValueError, HTTPException,
+                zlib.error) as error:
+            # EOFError and zlib.error come from a truncated gzip body,
+            # ValueError from a malformed url
+            self.output.error('RemoteDB._fetch_url(); Failed to update the '
+                'overlay list from: %s\nError was: %s' % (url, str(error)))
+            return (False, '', '')
+
+        timestamp = info.get('Last-Modified')
+        self._new_validators[url] = {'etag': info.get('ETag'),
+                                     'last_modified': timestamp}
+        self.output.info('Fetching new list... %s' % url, 5)
+        return (True, olist, timestamp)
+
+
+    def _http_index_path(self):
+        return self.config['cache'] + '_http_index.json'
+
+
+    def _load_http_index(self):
+        '''
+        Loads the ETag and Last-Modified of the cached http(s) lists.
+        '''
+        self._http_index = {}
+        self._http_index_changed = False
+        try:
+            with fileopen(self._http_index_path(), 'r') as index:
+                data = json.load(index)
+        except (IOError, OSError, ValueError) as error:
+            self.output.debug('RemoteDB._load_http_index(), no usable '
+                'index: %s', 8, error)
+            return
+        if isinstance(data, dict):
+            self._http_index = data
+
+
+    def _save_http_index(self):
+        '''
+        Writes the http(s) validators back if any list was downloaded.
+        '''
+        if not self._http_index_changed:
+            return
+        self._http_index_changed = False
+        # Drop lists no longer configured
+        urls = set(self.urls) | set(self.signed_urls) | \
+               set([url[0] for url in self.detached_urls])
+        for url in list(self._http_index):
+            if not url in urls:
+                del self._http_index[url]
+        ipath = self._http_index_path()
+        tmp = ipath + '.%d.tmp' % os.getpid()
+        try:
+            with fileopen(tmp, 'w') as index:
+                index.write(json.dumps(self._http_index, indent=1,
+                                       sort_keys=True))
+            os.rename(tmp, ipath)
+        except (IOError, OSError) as error:
+            self.output.debug('RemoteDB._save_http_index(), failed to write '
+                '%s: %s', 4, ipath, error)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
 
 
     def _paths(self, url):
-        self.output.debug("RemoteDB._paths(), url is tuple %s" % str(url), 2)
+        self.output.debug("RemoteDB._paths(), url is tuple %s", 2, url)
         if isinstance(url, tuple):
             filepath = self.filepath(url[0])
             sig = filepath + '.sig'
@@ -223,7 +529,7 @@ class RemoteDB(DbBase):
         return base + '_' + hashlib.md5(url_encoded).hexdigest()
 
     def _fetch_file(self, url, mpath, tpath=None):
-        self.output.debug('RemoteDB._fetch_file() url = %s' % url, 2)
+        self.output.debug('RemoteDB._fetch_file() url = %s', 2, url)
         # check when the cache was last updated
         # and don't re-fetch it unless it has changed
 
@@ -261,14 +567,14 @@ class RemoteDB(DbBase):
             if url_timestamp is not None:
                 self.output.info('Last-modified: %s' % url_timestamp,
                     4 + quieter)
-            self.output.debug('RemoteDB._fetch_url(), olist type = %s'
-                % str(type(olist)),2)
+            self.output.debug('RemoteDB._fetch_url(), olist type = %s', 2,
+                type(olist))
 
             return (True, olist, url_timestamp)
 
     def check_path(self, paths, hint=True):
         '''Check for sufficient privileges'''
-        self.output.debug('RemoteDB.check_path; paths = ' + str(paths), 8)
+        self.output.debug('RemoteDB.check_path; paths = %s', 8, paths)
         is_ok = True
         for path in paths:
             if os.path.exists(path) and not os.access(path, os.W_OK):
@@ -284,31 +590,61 @@ class RemoteDB(DbBase):
 
 
     def _check_download(self, olist, url):
+        '''
+        Parses a downloaded list to be sure it is usable.
 
+        @rtype tuple: (olist as text, OverlayDict of the parsed overlays)
+        '''
+        parsed = OverlayDict()
         try:
-            self.read_db(url, text=olist, text_type="xml")
+            if not self.read_db(url, text=olist, text_type="xml",
+                                overlays=parsed):
+                raise ValueError('not a valid overlay list')
+            # Build every overlay to be sure the definitions are usable
+            parsed.values()
         except Exception as error:
-            self.output.debug("RemoteDB._check_download(), url=%s \nolist:\n"
-                % url,2)
+            self.output.debug("RemoteDB._check_download(), url=%s \nolist:\n",
+                2, url)
             self.output.debug(olist, 2)
             raise IOError('Failed to parse the overlays list fetched fr'
                           'om ' + url + '\nThis means that the download'
                           'ed file is somehow corrupt or there was a pr'
                           'oblem with the webserver. Check the content '
                           'of the file. Error was:\n' + str(error))
+        self.overlays.update(parsed)
 
         # the folowing is neded for py3 only
         if sys.hexversion >= 0x3000000 and hasattr(olist, 'decode'):
             olist = olist.decode("UTF-8")
-        return olist
+        return olist, parsed
+
+
+    def _cache_compression(self):
+        '''
+        Returns the validated cache_compression option.
+        '''
+        compression = (self.config['cache_compression'] or 'none').lower()
+        if not compression in COMPRESSIONS:
+            self.output.warn('Invalid cache_compression "%s", expected one '
+                'of: %s' % (compression, ', '.join(COMPRESSIONS)))
+            return 'none'
+        if compression == 'xz' and not XZ_SUPPORT:
+            self.output.warn('cache_compression "xz" needs the lzma module, '
+                'caching the overlay lists uncompressed')
+            return 'none'
+        return compression
 
 
     @staticmethod
-    def write_cache(olist, mpath, tpath=None, timestamp=None):
+    def write_cache(olist, mpath, tpath=None, timestamp=None,
+                    compression=None):
         has_updates = False
         try:
-            with fileopen(mpath, 'w') as out_file:
-                out_file.write(olist)
+            if compression and compression != 'none':
+                write_compressed(mpath, olist, compression)
+            else:
+                with fileopen(mpath, 'w') as out_file:
+                    out_file.write(olist)
 
             if timestamp is not None and tpath is not None:
                 with fileopen(tpath, 'w') as out_file:
@@ -324,13 +660,12 @@ class RemoteDB(DbBase):
     def verify_gpg(self, url, sig, olist):
         '''Verify and decode it.'''
         self.output.debug("RemoteDB: verify_gpg(), verify & decrypt olist: "
-            " %s, type(olist)=%s" % (str(url),str(type(olist))), 2)
+            " %s, type(olist)=%s", 2, url, type(olist))
         #self.output.debug(olist, 2)
 
         # detached sig
         if sig:
             self.output.debug("RemoteDB.verify_gpg(), detached sig", 2)
-            self.dl_sig(url[1], sig)
             gpg_result = self.gpg.verify(
                 inputtxt=olist,
                 inputfile=sig)
@@ -341,8 +676,8 @@ class RemoteDB(DbBase):
                 inputtxt=olist)
             olist = gpg_result.output
         # verify and report
-        self.output.debug("gpg_result, verified=%s, len(olist)=%s"
-            % (gpg_result.verified[0], str(len(olist))), 1)
+        self.output.debug("gpg_result, verified=%s, len(olist)=%s", 1,
+            gpg_result.verified[0], len(olist))
         if gpg_result.verified[0]:
             self.output.info("GPG verification succeeded for gpg-signed url.", 4)
             self.output.info('\tSignature result:' + str(gpg_result.verified), 4)
@@ -353,15 +688,21 @@ class RemoteDB(DbBase):
         return olist, gpg_result.verified[0]
 
 
-    def dl_sig(self, url, sig):
-        self.output.debug("RemoteDB.dl_sig() url=%s, sig=%s" % (url, sig), 2)
-        success, newsig, timestamp = self._fetch_url(url, sig)
+    def dl_sig(self, url, sig, fetcher):
+        self.output.debug("RemoteDB.dl_sig() url=%s, sig=%s", 2, url, sig)
+        success, newsig, timestamp = retry_call(self.config,
+            lambda: fetcher.fetch_content(url, climit=60),
+            failed=lambda result: not result[0],
+            what='Fetching %s' % url)
         if success:
+            self.config['stats'].count_bytes(len(newsig))
             success = self.write_cache(newsig, sig)
         return success
 
 
     def init_gpg(self):
+        from pygpg.config import GPGConfig
+        from pygpg.gpg import GPG
         self.output.debug("RemoteDB.init_gpg(), initializing", 2)
         if not self.gpg_config:
             self.gpg_config = GPGConfig()
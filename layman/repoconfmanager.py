@@ -18,7 +18,7 @@
 import os
 import sys
 
-from layman.module import Modules
+from layman.module import get_modules
 
 if sys.hexversion >= 0x30200f0:
     STR = str
@@ -36,9 +36,12 @@ class RepoConfManager:
         self.conf_types = config['conf_type']
         self.output = config['output']
         self.overlays = overlays
-        self.module_controller = Modules(path=MOD_PATH,
-                                         namepath='layman.config_modules',
-                                         output=self.output)
+        self.module_controller = get_modules(path=MOD_PATH,
+                                             namepath='layman.config_modules',
+                                             output=self.output)
+
+        # conf type -> handler while a batch is running, see start_batch()
+        self._batch = None
 
         if isinstance(self.conf_types, STR):
             self.conf_types = [x.strip() for x in self.conf_types.split(',')]
@@ -48,6 +51,40 @@ class RepoConfManager:
                 + '\nis required in order to continue...')
 
 
+    def _get_handler(self, types):
+        '''
+        Returns the config handler of a config type, the same one for the
+        whole batch if one is running.
+        '''
+        types = types.replace('.', '')
+        if self._batch is not None and types in self._batch:
+            return self._batch[types]
+        conf = self.module_controller.get_class(types)(self.config,
+                                                       self.overlays)
+        if self._batch is not None:
+            self._batch[types] = conf
+        return conf
+
+
+    def start_batch(self):
+        '''
+        Keeps the changes to the config files in memory until
+        commit_batch() writes every file once.
+        '''
+        self._batch = {}
+
+
+    def commit_batch(self):
+        '''
+        Writes the config files changed since start_batch().
+
+        @return boolean: represents success or failure.
+        '''
+        handlers, self._batch = self._batch or {}, None
+        results = [handlers[types].write() for types in sorted(handlers)]
+        return not False in results
+
+
     def add(self, overlay):
         '''
         Adds overlay information to the specified config type(s).
@@ -58,10 +95,8 @@ class RepoConfManager:
         if self.config['require_repoconfig']:
             results = []
             for types in self.conf_types:
-                types = types.replace('.', '')
-                conf = self.module_controller.get_class(types)\
-                                  (self.config, self.overlays)
-                conf_ok = conf.add(overlay)
+                conf = self._get_handler(types)
+                conf_ok = conf.add(overlay, no_write=self._batch is not None)
                 results.append(conf_ok)
             return results
         return [True]
@@ -78,10 +113,8 @@ class RepoConfManager:
         if self.config['require_repoconfig']:
             results = []
             for types in self.conf_types:
-                types = types.replace('.', '')
-                conf = self.module_controller.get_class(types)\
-                                  (self.config, self.overlays)
-                conf_ok = conf.delete(overlay)
+                conf = self._get_handler(types)
+                conf_ok = conf.delete(overlay, no_write=self._batch is not None)
                 results.append(conf_ok)
             return results
         return [True]
@@ -97,10 +130,8 @@ class RepoConfManager:
         '''
         if self.config['require_repoconfig']:
             for types in self.conf_types:
-                types = types.replace('.', '')
-                conf = self.module_controller.get_class(types)\
-                                  (self.config, self.overlays)
-                conf_ok = conf.disable(overlay)
+                conf = self._get_handler(types)
+                conf_ok = conf.disable(overlay, no_write=self._batch is not None)
             return conf_ok
         return True
 
@@ -115,10 +146,8 @@ class RepoConfManager:
         '''
         if self.config['require_repoconfig']:
             for types in self.conf_types:
-                types = types.replace('.', '')
-                conf = self.module_controller.get_class(types)\
-                                  (self.config, self.overlays)
-                conf_ok = conf.enable(overlay)
+                conf = self._get_handler(types)
+                conf_ok = conf.enable(overlay, no_write=self._batch is not None)
             return conf_ok
         return True
 
@@ -133,10 +162,8 @@ class RepoConfManager:
         if self.config['require_repoconfig']:
             results = []
             for types in self.conf_types:
-                types = types.replace('.', '')
-                conf = self.module_controller.get_class(types)\
-                                  (self.config, self.overlays)
-                conf_ok = conf.update(overlay)
+                conf = self._get_handler(types)
+                conf_ok = conf.update(overlay, no_write=self._batch is not None)
                 results.append(conf_ok)
             return results
         return [True]
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN COMMAND RUNNER
+#################################################################################
+# File:       runner.py
+#
+#             Runs the external commands (git, svn, rsync...) on an
+#             asyncio event loop.
+#
+# Copyright:
+#             Distributed under the terms of the GNU General Public License v2
+#
+
+'''Asyncio based runner for the commands of the overlay sources.
+
+This module needs python 3.8 or later and is only imported by
+layman.utils.run_command() when ASYNC_RUNNER is set.
+'''
+
+from __future__ import unicode_literals
+
+import asyncio
+import subprocess
+import threading
+
+from layman.utils import (command_timeout, CommandTimeout, KILL_GRACE,
+                          prepare_command, run_cancel_hook, StderrCopy)
+
+
+async def run_command_async(config, command, args, on_cancel=None,
+                            errors=None, **kwargs):
+    '''
+    Coroutine running a command with the semantics of
+    layman.utils.run_command().
+
+    @param on_cancel: callable run once the command was killed because
+    it timed out or the awaiting task was cancelled (e.g. by a
+    KeyboardInterrupt), used to repair a half updated checkout.
+    @param errors: list the lines the command writes to stderr are
+    appended to, as for run_command().
+    @param kwargs: cwd, env, cmd and timeout as for run_command().
+    @rtype int: the exit code of the command, 1 if it could not be run.
+    @raise CommandTimeout: if the command was killed by the timeout.
+    '''
+    output = config['output']
+    cmd = kwargs.get('cmd', '')
+    timeout, limit = command_timeout(cmd or command, kwargs)
+    args, cwd, env, command_repr = prepare_command(config, command, args,
+                                                   kwargs)
+    output.info('Running %s... # %s' % (cmd, command_repr), 2)
+
+    # When running as one of several parallel jobs the output is collected
+    # in the calling thread's buffer to keep it from interleaving.
+    buffered = output.is_buffered()
+
+    if config['quiet']:
+        # Make child non-interactive
+        input_source = subprocess.DEVNULL
+        output_target = subprocess.DEVNULL
+        error_target = config['stderr']
+        if buffered:
+            error_target = subprocess.PIPE
+    elif buffered:
+        # Parallel jobs can not share the terminal
+        input_source = subprocess.DEVNULL
+        output_target = subprocess.PIPE
+        error_target = subprocess.STDOUT
+    else:
+        # Re-use parent file descriptors
+        input_source = None
+        output_target = None
+        error_target = config['stderr']
+
+    error_copy = None
+    if errors is not None:
+        if error_target is subprocess.STDOUT:
+            error_target = subprocess.PIPE
+        elif error_target is not subprocess.PIPE:
+            error_copy = StderrCopy(error_target)
+            error_target = subprocess.PIPE
+
+    try:
+        proc = await asyncio.create_subprocess_exec(*args,
+            stdin=input_source,
+            stdout=output_target,
+            stderr=error_target,
+            cwd=cwd,
+            env=env)
+    except Exception as err:
+        output.error(
+            'Unknown exception running command: %s' % command_repr)
+        output.error('Original error was: %s' % str(err))
+        return 1
+
+    if error_copy is None:
+        waiting = proc.communicate()
+    else:
+        waiting = _copy_errors(proc, error_copy)
+    try:
+        captured = await asyncio.wait_for(waiting, timeout)
+    except asyncio.TimeoutError:
+        output.error('Command timed out after %s seconds: %s'
+                     % (limit, command_repr))
+        await _stop(proc)
+        run_cancel_hook(on_cancel, output)
+        raise CommandTimeout(cmd or command, limit)
+    except asyncio.CancelledError:
+        await _stop(proc)
+        run_cancel_hook(on_cancel, output)
+        raise
+
+    for text in captured:
+        if text:
+            output.std_out.write(text.decode('utf-8', 'replace'))
+    if error_copy is not None:
+        errors.extend(error_copy.lines())
+    elif errors is not None and captured[1]:
+        errors.extend(captured[1].decode('utf-8', 'replace').splitlines())
+    result = proc.returncode
+
+    if result:
+        output.info('Failure result returned from %s' % cmd , 2)
+
+    return result
+
+
+async def _copy_errors(proc, error_copy):
+    '''
+    Passes what the command writes to stderr on to error_copy while it
+    runs and waits for it to exit.
+
+    @rtype tuple: nothing else was captured.
+    '''
+    while True:
+        chunk = await proc.stderr.read(4096)
+        if not chunk:
+            break
+        error_copy.write(chunk)
+    await proc.wait()
+    return ()
+
+
+async def _stop(proc):
+    '''
+    Asks a command that is still running to terminate and kills it if
+    it did not exit after KILL_GRACE seconds.
+    '''
+    if proc.returncode is not None:
+        return
+    try:
+        proc.terminate()
+        await asyncio.wait_for(proc.wait(), KILL_GRACE)
+        return
+    except ProcessLookupError:
+        return
+    except asyncio.TimeoutError:
+        pass
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+    await proc.wait()
+
+
+def run_command(config, command, args, **kwargs):
+    '''
+    Runs run_command_async() to completion from synchronous code.
+
+    Every call gets a fresh event loop in the calling thread, which
+    keeps the Scheduler's worker threads independent of each other. If
+    the calling thread already runs a loop (e.g. an on_cancel hook
+    running a command itself) the command is run from a helper thread.
+    '''
+    coro = run_command_async(config, command, args, **kwargs)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    outcome = {}
+    buffered = config['output'].is_buffered()
+
+    def target():
+        if buffered:
+            # Keep collecting into the same block of output
+            config['output'].buffer_output()
+        try:
+            outcome['result'] = asyncio.run(coro)
+        except BaseException as err:
+            outcome['error'] = err
+        finally:
+            if buffered:
+                outcome['text'] = config['output'].release_output()
+
+    helper = threading.Thread(target=target)
+    helper.start()
+    helper.join()
+    if outcome.get('text'):
+        config['output'].std_out.write(outcome['text'])
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
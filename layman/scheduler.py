@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN JOB SCHEDULER
+#################################################################################
+# File:       scheduler.py
+#
+#             Runs independent jobs (e.g. overlay syncs) on a bounded
+#             pool of worker threads.
+#
+# Copyright:
+#             Distributed under the terms of the GNU General Public License v2
+#
+
+from __future__ import unicode_literals
+
+import sys
+import threading
+
+from collections import deque
+
+if sys.hexversion >= 0x30200f0:
+    import queue
+else:
+    import Queue as queue
+
+
+class Scheduler(object):
+    '''Runs a list of named jobs with at most C{jobs} of them at a time.
+
+    Every job may name the host it talks to. At most C{max_per_host}
+    jobs of the same host run at once and free workers take the next job
+    from the hosts in turn, so a forge carrying many overlays neither
+    gets hammered nor starves the overlays hosted elsewhere.
+
+    The output of each job is buffered while it runs and printed in one
+    block once the job is done, so the output of parallel jobs does not
+    interleave. With a single job everything runs in the calling thread
+    exactly as before.
+    '''
+
+    def __init__(self, output, jobs=1, max_per_host=0):
+        self.output = output
+        self.jobs = max(1, jobs)
+        # 0 means no per host limit
+        self.max_per_host = max(0, max_per_host)
+        self._print_lock = threading.Lock()
+        self._cond = threading.Condition()
+
+
+    def run(self, tasks):
+        '''
+        Runs the jobs and returns their outcome.
+
+        @param tasks: list of (name, callable) or (name, callable, host)
+        tuples. Jobs without a host ('' or None) are never limited.
+        @rtype dict: name -> (result, exception) where exception is None
+        if the job succeeded.
+        '''
+        results = {}
+        for name, result, error in self.iter_results(tasks):
+            results[name] = (result, error)
+        return results
+
+
+    def iter_results(self, tasks):
+        '''
+        Runs the jobs and yields their outcome as soon as each one is
+        done, so the caller can process the results in its own thread
+        while the remaining jobs are still running.
+
+        @param tasks: see run().
+        @rtype generator of (name, result, exception) tuples.
+        '''
+        if self.jobs == 1 or len(tasks) < 2:
+            for task in tasks:
+                result, error = self._run_task(task[1])
+                yield (task[0], result, error)
+            return
+
+        self._queues = {}
+        self._hosts = []
+        self._running = {}
+        self._turn = 0
+        for task in tasks:
+            host = task[2] if len(task) > 2 else ''
+            if not host in self._queues:
+                self._queues[host] = deque()
+                self._hosts.append(host)
+                self._running[host] = 0
+            self._queues[host].append(task[:2])
+
+        # The output of the jobs goes where the caller's output goes,
+        # which may be a buffer of its own (e.g. in layman-daemon).
+        self._target = self.output.std_out
+        done = queue.Queue()
+        for i in range(min(self.jobs, len(tasks))):
+            worker = threading.Thread(target=self._worker, args=(done,))
+            worker.daemon = True
+            worker.start()
+
+        for i in range(len(tasks)):
+            yield done.get()
+
+
+    def _next_task(self):
+        '''
+        Picks the next job, going round-robin over the hosts and
+        skipping those already at their limit. Blocks until a job
+        becomes available.
+
+        @rtype tuple: (host, name, callable) or None once all jobs
+        have been handed out.
+        '''
+        with self._cond:
+            while True:
+                if not any(self._queues.values()):
+                    return None
+                count = len(self._hosts)
+                for i in range(count):
+                    index = (self._turn + i) % count
+                    host = self._hosts[index]
+                    if not self._queues[host]:
+                        continue
+                    if (host and self.max_per_host
+                        and self._running[host] >= self.max_per_host):
+                        continue
+                    self._turn = index + 1
+                    self._running[host] += 1
+                    name, func = self._queues[host].popleft()
+                    return (host, name, func)
+                # Every host with pending jobs is busy
+                self._cond.wait()
+
+
+    def _task_done(self, host):
+        with self._cond:
+            self._running[host] -= 1
+            self._cond.notify_all()
+
+
+    def _worker(self, done):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            host, name, func = task
+            self.output.buffer_output()
+            try:
+                result, error = self._run_task(func)
+            finally:
+                self._flush_output()
+                self._task_done(host)
+            done.put((name, result, error))
+
+
+    def _flush_output(self):
+        text = self.output.release_output()
+        if not text:
+            return
+        with self._print_lock:
+            self._target.write(text)
+            self._target.flush()
+
+
+    @staticmethod
+    def _run_task(func):
+        try:
+            return (func(), None)
+        except Exception as error:
+            return (None, error)
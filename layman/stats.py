@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#################################################################################
+# LAYMAN STATISTICS
+#################################################################################
+# File:       stats.py
+#
+#             Records how long adding, syncing and downloading took.
+#
+# Copyright:
+#             Distributed under the terms of the GNU General Public License v2
+#
+
+from __future__ import unicode_literals
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+from layman.compatibility import fileopen
+from layman.utils import CommandTimeout
+
+if sys.hexversion >= 0x30300f0:
+    _clock = time.monotonic
+else:
+    _clock = time.time
+
+
+class StatsRecorder(object):
+    '''Collects one record per add, sync, source url update and remote
+    list download.
+
+    Every record is a dict holding the action, the overlay name (or list
+    url), when it started, the wall time in seconds, the result (the
+    exit code, 0 on success), whether the work was skipped, the bytes
+    transferred where they are known and the error, if any. When the
+    stats_file option is set each record is also appended to that file
+    as one line of JSON as soon as it is complete.
+    '''
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+
+    @contextlib.contextmanager
+    def measure(self, config, action, name, **fields):
+        '''
+        Times the block and records it once it is done. The block may
+        fill in the record it gets, e.g. its result.
+
+        @param action: 'add', 'sync', 'update', 'fetch' or 'cache'.
+        @param fields: further entries of the record, e.g. the type.
+        @rtype dict: the record.
+        '''
+        record = {'action': action, 'name': name,
+                  'started': round(time.time(), 3), 'seconds': None,
+                  'result': None, 'skipped': False, 'bytes': None,
+                  'error': None, 'timed_out': False}
+        record.update(fields)
+        previous = getattr(self._local, 'record', None)
+        self._local.record = record
+        start = _clock()
+        try:
+            yield record
+        except Exception as error:
+            record['error'] = str(error)
+            record['timed_out'] = isinstance(error, CommandTimeout)
+            if record['result'] is None:
+                record['result'] = 1
+            raise
+        finally:
+            self._local.record = previous
+            record['seconds'] = round(_clock() - start, 3)
+            self.add(config, record)
+
+
+    def note(self, **fields):
+        '''Updates the record of the block measured by the calling
+        thread, if any.'''
+        record = getattr(self._local, 'record', None)
+        if record is not None:
+            record.update(fields)
+
+
+    def count_bytes(self, count):
+        '''Adds to the bytes transferred by the block measured by the
+        calling thread.'''
+        record = getattr(self._local, 'record', None)
+        if record is not None and count:
+            record['bytes'] = (record['bytes'] or 0) + count
+
+
+    def add(self, config, record):
+        '''Stores a complete record and appends it to the stats file.'''
+        with self._lock:
+            self.records.append(record)
+            stats_file = config['stats_file']
+            if not stats_file:
+                return
+            try:
+                with fileopen(stats_file, 'a') as out:
+                    out.write(json.dumps(record, sort_keys=True) + '\n')
+            except (IOError, OSError) as error:
+                config['output'].warn('Failed to write the stats file '
+                    '"%s": %s' % (stats_file, str(error)), 2)
@@ -19,10 +19,20 @@ from __future__ import unicode_literals
 
 '''Runs external (non-doctest) test cases.'''
 
+import errno
+import gzip
+import io
+import json
 import os
 import sys
 import shutil
+import pickle
+import socket
+import sqlite3
+import subprocess
 import tempfile
+import threading
+import time
 import unittest
 import xml.etree.ElementTree as ET # Python 2.5
 #Py3
@@ -33,6 +43,8 @@ except ImportError:
 
 from  layman.argsparser       import ArgsParser
 from  layman.api              import LaymanAPI
+from  layman.daemon           import (connect, DaemonClient, DaemonError,
+                                     LaymanDaemon, _OutputStream)
 from  layman.db               import DB
 from  layman.dbbase           import DbBase
 from  layman.compatibility    import fileopen
@@ -42,9 +54,20 @@ from  layman.output           import Message
 from  layman.overlays.overlay import Overlay
 from  layman.remotedb         import RemoteDB
 from  layman.repoconfmanager  import RepoConfManager
-from  layman.utils            import path
+from  layman.scheduler        import Scheduler
+from  layman.utils            import (command_deadline, command_output,
+                                     CommandTimeout, get_host, is_transient_error, path,
+                                     retry_call, retry_delay, run_command,
+                                     XZ_SUPPORT)
 from  warnings import filterwarnings, resetwarnings
 
+if sys.hexversion >= 0x30200f0:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.error import HTTPError, URLError
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib2 import HTTPError, URLError
+
 encoding = sys.getdefaultencoding()
 
 if encoding != 'utf-8':
@@ -118,6 +141,58 @@ class AddDeleteEnableDisableFromConf(unittest.TestCase):
         shutil.rmtree(tmpdir)
 
 
+    def test_batch(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        makeconf = os.path.join(tmpdir, 'make.conf')
+        reposconf = os.path.join(tmpdir, 'repos.conf')
+
+        make_txt =\
+        'PORTDIR_OVERLAY="\n'\
+        '$PORTDIR_OVERLAY"'
+
+        with fileopen(makeconf, 'w') as f:
+            f.write(make_txt)
+
+        with fileopen(reposconf, 'w') as f:
+            f.write('')
+
+        my_opts = {
+                   'installed' :
+                   HERE + '/testfiles/global-overlays.xml',
+                   'make_conf' : makeconf,
+                   'nocheck'    : 'yes',
+                   'storage'   : tmpdir,
+                   'repos_conf' : reposconf,
+                   'conf_type' : ['make.conf', 'repos.conf'],
+                   }
+
+        config = OptionConfig(my_opts)
+        config.set_option('quietness', 3)
+
+        a = DB(config)
+        conf = RepoConfManager(config, a.overlays)
+
+        # Nothing is written before the batch is committed.
+        conf.start_batch()
+        for overlay in sorted(a.overlays):
+            self.assertFalse(False in conf.add(a.overlays[overlay]))
+        self.assertTrue(conf.disable(a.overlays['wrobel']))
+        with fileopen(makeconf, 'r') as f:
+            self.assertEqual(f.read(), make_txt)
+        self.assertTrue(conf.commit_batch())
+
+        with fileopen(makeconf, 'r') as f:
+            content = f.read()
+        self.assertTrue('DISABLED="\n%s/wrobel\n"' % tmpdir in content)
+        self.assertTrue('ENABLED="\n%s/wrobel-stable\n"' % tmpdir in content)
+        with fileopen(reposconf, 'r') as f:
+            content = f.read()
+        self.assertTrue('[wrobel-stable]' in content)
+        self.assertFalse('[wrobel]' in content)
+
+        shutil.rmtree(tmpdir)
+
+
 class AddDeleteDB(unittest.TestCase):
     def test(self):
         repo_name     = 'tar_test_overlay'
@@ -341,28 +416,37 @@ class CLIArgs(unittest.TestCase):
         self.assertTrue(test_url in a['overlays'].split('\n'))
 
         test_keys = ['auto_sync', 'bzr_addopts', 'bzr_command', 'bzr_postsync',
-                     'bzr_syncopts', 'cache', 'check_official', 'clean_archive',
+                     'bzr_syncopts', 'bzr_timeout', 'cache', 'cache_compression',
+                     'check_official', 'check_upstream', 'clean_archive',
                      'conf_module', 'conf_type', 'config', 'configdir',
                      'custom_news_pkg', 'cvs_addopts', 'cvs_command',
-                     'cvs_postsync', 'cvs_syncopts', 'darcs_addopts',
+                     'cvs_postsync', 'cvs_syncopts', 'cvs_timeout', 'daemon_socket', 'darcs_addopts',
                      'darcs_command', 'darcs_postsync', 'darcs_syncopts',
-                     'db_type', 'g-common_command', 'g-common_generateopts',
-                     'g-common_postsync', 'g-common_syncopts',
+                     'darcs_timeout',
+                     'db_type', 'fetch_jobs', 'g-common_command', 'g-common_generateopts',
+                     'g-common_postsync', 'g-common_syncopts', 'g-common_timeout',
                      'g-sorcery_command', 'g-sorcery_generateopts',
-                     'g-sorcery_postsync', 'g-sorcery_syncopts', 'git_addopts',
-                     'git_command', 'git_email', 'git_postsync', 'git_syncopts',
+                     'g-sorcery_postsync', 'g-sorcery_syncopts',
+                     'g-sorcery_timeout', 'git_addopts',
+                     'git_clone_mode', 'git_command', 'git_depth', 'git_email',
+                     'git_fetchopts', 'git_object_cache', 'git_postsync', 'git_syncopts', 'git_timeout',
                      'git_user', 'gpg_detached_lists', 'gpg_signed_lists',
                      'http_proxy', 'https_proxy', 'installed', 'local_list',
-                     'make_conf', 'mercurial_addopts', 'mercurial_command',
-                     'mercurial_postsync', 'mercurial_syncopts',
-                     'news_reporter', 'nocheck', 'overlay_defs', 'overlays',
-                     'protocol_filter', 'quietness', 'repos_conf',
-                     'require_repoconfig', 'rsync_command', 'rsync_postsync',
-                     'rsync_syncopts', 'squashfs_addopts', 'squashfs_command',
-                     'squashfs_postsync', 'squashfs_syncopts', 'storage',
+                     'make_conf', 'max_per_host', 'mercurial_addopts',
+                     'mercurial_command', 'mercurial_postsync',
+                     'mercurial_syncopts', 'mercurial_timeout', 'news_reporter', 'nocheck',
+                     'overlay_defs', 'overlays', 'protocol_filter',
+                     'quietness', 'repos_conf',
+                     'require_repoconfig', 'retries', 'retry_delay',
+                     'rsync_command', 'rsync_postsync',
+                     'rsync_syncopts', 'rsync_timeout', 'sqlite_journal_mode',
+                     'sqlite_synchronous', 'squashfs_addopts', 'squashfs_command',
+                     'squashfs_postsync', 'squashfs_syncopts',
+                     'squashfs_timeout', 'stats_file', 'storage',
                      'support_url_updates', 'svn_addopts', 'svn_command',
-                     'svn_postsync', 'svn_syncopts', 't/f_options',
-                     'tar_command', 'tar_postsync', 'umask', 'width']
+                     'svn_postsync', 'svn_syncopts', 'svn_timeout', 'sync_jobs',
+                     't/f_options', 'tar_command', 'tar_postsync', 'tar_timeout', 'umask', 'use_daemon',
+                     'width']
         # Due to this not being a dict object, the keys() invocation is needed.
         self.assertEqual(sorted(a.keys()), test_keys)
 
@@ -418,6 +502,54 @@ class CreateConfig(unittest.TestCase):
             getattr(self, 'make_%s' % i)
 
 
+class ConfigSnapshot(unittest.TestCase):
+
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        conf = os.path.join(tmpdir, 'layman.cfg')
+        with fileopen(conf, 'w') as f:
+            f.write('[MAIN]\nstorage : %s\ncheck_upstream : no\n'
+                    'protocol_filter : git, https\n' % tmpdir)
+        config = OptionConfig(options={'config': conf},
+                              defaults={'config': conf})
+        config.read_config(config.get_defaults())
+
+        self.assertEqual(config['cache'], tmpdir + '/cache')
+        self.assertEqual(config['check_upstream'], False)
+        self.assertEqual(config['protocol_filter'], ['git', 'https'])
+        self.assertEqual(config['support_url_updates'],
+                         ['Bzr', 'cvs', 'Git', 'Mercurial', 'Subversion'])
+        self.assertEqual(config['no_such_option'], None)
+
+        # Changing an option drops the snapshot
+        config.set_option('check_upstream', True)
+        config.set_option('protocol_filter', ['https'])
+        self.assertEqual(config['check_upstream'], True)
+        self.assertEqual(config.get_option('protocol_filter'), ['https'])
+
+        shutil.rmtree(tmpdir)
+
+
+    def test_args_parser(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        conf = os.path.join(tmpdir, 'layman.cfg')
+        # No protocol_filter key
+        with fileopen(conf, 'w') as f:
+            f.write('[MAIN]\nstorage : %s\n' % tmpdir)
+        argv = sys.argv
+        try:
+            sys.argv = ['layman', '--config', conf, '-L']
+            self.assertEqual(ArgsParser()['protocol_filter'], [])
+
+            with fileopen(conf, 'a') as f:
+                f.write('protocol_filter : git, https\n')
+            self.assertEqual(ArgsParser()['protocol_filter'],
+                             ['git', 'https'])
+        finally:
+            sys.argv = argv
+            shutil.rmtree(tmpdir)
+
+
 class FetchRemoteList(unittest.TestCase):
 
     def test(self):
@@ -467,6 +599,218 @@ class FetchRemoteList(unittest.TestCase):
         shutil.rmtree(tmpdir)
 
 
+    def test_parallel(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        lists = ['file://' + HERE + '/testfiles/global-overlays.xml',
+                 'file://' + HERE + '/testfiles/subpath-2.xml']
+
+        my_opts = {
+                   'overlays': lists,
+                   'db_type': 'xml',
+                   'cache': os.path.join(tmpdir, 'cache'),
+                   'storage': tmpdir,
+                   'nocheck': 'yes',
+                   'fetch_jobs': '2',
+                   'proxy': None,
+                   'quietness': 3
+                  }
+
+        config = OptionConfig(my_opts)
+        api = LaymanAPI(config)
+        self.assertTrue(api.fetch_remote_list())
+
+        db = api._get_remote_db()
+        for url in lists:
+            self.assertTrue(os.path.exists(db.filepath(url) + '.xml'))
+        self.assertEqual(api.get_available(),
+                         ['b_name', 'c_name', 'wrobel', 'wrobel-stable'])
+
+        shutil.rmtree(tmpdir)
+
+
+    def test_snapshot(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        my_opts = {
+                   'overlays': ['file://' + HERE + '/testfiles/global-overlays.xml'],
+                   'db_type': 'xml',
+                   'cache': os.path.join(tmpdir, 'cache'),
+                   'storage': tmpdir,
+                   'nocheck': 'yes',
+                   'proxy': None,
+                   'quietness': 3
+                  }
+        config = OptionConfig(my_opts)
+        db = RemoteDB(config)
+        self.assertEqual(db.cache(), (True, True))
+
+        # cache() keeps the parse of its download check, so not even the
+        # first instance has to parse the xml again.
+        snapshot = os.path.join(tmpdir, 'cache_snapshot.pickle')
+        self.assertTrue(os.path.exists(snapshot))
+        mpath = db.filepath(config['overlays']) + '.xml'
+        with open(snapshot, 'rb') as f:
+            self.assertTrue(mpath in pickle.load(f)['paths'])
+        loaded = RemoteDB(config)
+        self.assertFalse(loaded._snapshot_changed)
+
+        parsed = DbBase(config, [mpath])
+        self.assertEqual(loaded.list_ids(), ['wrobel', 'wrobel-stable'])
+        self.assertTrue(loaded == parsed)
+        self.assertEqual(loaded.list(verbose=True), parsed.list(verbose=True))
+        self.assertEqual(loaded.list(width=80), parsed.list(width=80))
+
+        # A changed list invalidates its snapshot entry.
+        shutil.copy(HERE + '/testfiles/subpath-2.xml', mpath)
+        self.assertEqual(RemoteDB(config).list_ids(), ['b_name', 'c_name'])
+
+        shutil.rmtree(tmpdir)
+
+
+    def test_conditional(self):
+        with fileopen(HERE + '/testfiles/global-overlays.xml', 'rb') as f:
+            xml = f.read()
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(xml)
+        body = buf.getvalue()
+        sent = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                if not 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    self.send_response(406)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('ETag', '"v1"')
+                self.send_header('Last-Modified',
+                                 'Mon, 03 Aug 2015 20:17:30 GMT')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                sent.append(len(body))
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        url = 'http://127.0.0.1:%d/repositories.xml' % server.server_port
+        my_opts = {
+                   'overlays': [url],
+                   'db_type': 'xml',
+                   'cache': os.path.join(tmpdir, 'cache'),
+                   'storage': tmpdir,
+                   'nocheck': 'yes',
+                   'proxy': None,
+                   'quietness': 3
+                  }
+        config = OptionConfig(my_opts)
+        try:
+            self.assertEqual(RemoteDB(config).cache(), (True, True))
+            self.assertEqual(sent, [len(body)])
+
+            # Nothing changed: a 304 and no body.
+            db = RemoteDB(config)
+            self.assertEqual(db.cache(), (False, True))
+            self.assertEqual(sent, [len(body)])
+            self.assertEqual(db.list_ids(), ['wrobel', 'wrobel-stable'])
+
+            # Without the cached copy the validators are not sent.
+            os.unlink(db.filepath(url) + '.xml')
+            self.assertEqual(RemoteDB(config).cache(), (True, True))
+            self.assertEqual(sent, [len(body), len(body)])
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tmpdir)
+
+
+    def test_broken_response(self):
+        with fileopen(HERE + '/testfiles/global-overlays.xml', 'rb') as f:
+            xml = f.read()
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(xml)
+        # A gzip body cut short
+        body = buf.getvalue()[:len(buf.getvalue()) // 2]
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        url = 'http://127.0.0.1:%d/repositories.xml' % server.server_port
+        my_opts = {
+                   'overlays': [url, 'http://[::1/repositories.xml'],
+                   'db_type': 'xml',
+                   'cache': os.path.join(tmpdir, 'cache'),
+                   'storage': tmpdir,
+                   'nocheck': 'yes',
+                   'proxy': None,
+                   'quietness': 3
+                  }
+        config = OptionConfig(my_opts)
+        try:
+            # Both lists fail without an exception escaping.
+            self.assertEqual(RemoteDB(config).cache(), (False, True))
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tmpdir)
+
+
+    def test_compressed_cache(self):
+        magic = {'gzip': b'\x1f\x8b', 'xz': b'\xfd7zXZ\x00'}
+        compressions = ['gzip']
+        if XZ_SUPPORT:
+            compressions.append('xz')
+        for compression in compressions:
+            tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+            my_opts = {
+                   'overlays': ['file://' + HERE + '/testfiles/global-overlays.xml'],
+                   'db_type': 'xml',
+                   'cache': os.path.join(tmpdir, 'cache'),
+                   'cache_compression': compression,
+                   'storage': tmpdir,
+                   'nocheck': 'yes',
+                   'proxy': None,
+                   'quietness': 3
+                  }
+            config = OptionConfig(my_opts)
+            db = RemoteDB(config)
+            self.assertEqual(db.cache(), (True, True))
+
+            mpath = db.filepath(config['overlays']) + '.xml'
+            with open(mpath, 'rb') as f:
+                self.assertTrue(f.read(6).startswith(magic[compression]))
+            # Read the file itself rather than the catalog snapshot
+            self.assertEqual(DbBase(config, [mpath]).list_ids(),
+                             ['wrobel', 'wrobel-stable'])
+            shutil.rmtree(tmpdir)
+
+
 class FormatBranchCategory(unittest.TestCase):
     def _run(self, number):
         #config = {'output': Message()}
@@ -589,6 +933,30 @@ class OverlayObjTest(unittest.TestCase):
         self.getshortlist()
 
 
+    def test_dict_round_trip(self):
+        config = BareConfig()
+        for name in ('global-overlays.xml', 'overlays_bug_184449.xml',
+                     'overlays_bug_286290.xml', 'subpath-1.xml'):
+            document = ET.parse(os.path.join(HERE, 'testfiles', name))
+            for xml in document.findall('overlay') + document.findall('repo'):
+                ovl = Overlay(config, xml=xml)
+                copy = Overlay(config, ovl_dict=ovl.to_dict())
+                self.assertEqual(copy, ovl)
+                self.assertEqual(copy.to_dict(), ovl.to_dict())
+                self.assertEqual((copy.branch, copy.owners),
+                                 (ovl.branch, ovl.owners))
+
+        # An unset branch and an empty owner name survive the round trip
+        xml = ET.fromstring('<repo><name>x</name><description>x'
+            '</description><owner><email>x@example.org</email><name/>'
+            '</owner><source type="git">git://example.org/x.git</source>'
+            '</repo>')
+        ovl = Overlay(config, xml=xml)
+        copy = Overlay(config, ovl_dict=ovl.to_dict())
+        self.assertEqual((copy.branch, copy.sources[0].branch, copy.owners),
+                         ('', '', [{'email': 'x@example.org', 'name': ''}]))
+
+
 class PathUtil(unittest.TestCase):
 
     def test(self):
@@ -686,8 +1054,19 @@ class ReadWriteSelectListDbBase(unittest.TestCase):
         config = {'output': output,
                   'db_type': 'xml',}
         db = DbBase(config, [HERE + '/testfiles/global-overlays.xml', ])
+        self.assertEqual(db.list_ids(), ['wrobel', 'wrobel-stable'])
+        self.assertFalse(db.overlays.is_loaded('wrobel-stable'))
+        # The unread entries are kept as xml text, not as element trees.
+        record = dict.__getitem__(db.overlays, 'wrobel')
+        self.assertTrue(isinstance(record.data, bytes))
         url = ['rsync://gunnarwrobel.de/wrobel-stable']
         self.assertEqual(list(db.select('wrobel-stable').source_uris()), url)
+        # Only the selected overlay got built.
+        self.assertTrue(db.overlays.is_loaded('wrobel-stable'))
+        self.assertFalse(db.overlays.is_loaded('wrobel'))
+        # All overlays share the plug-in modules scanned once per process.
+        self.assertTrue(db.select('wrobel').module_controller is
+                        db.select('wrobel-stable').module_controller)
 
         config['db_type'] = 'json'
         db = DbBase(config, [HERE + '/testfiles/global-overlays.json', ])
@@ -722,9 +1101,92 @@ class ReadWriteSelectListDbBase(unittest.TestCase):
         keys = sorted(c.overlays)
         self.assertEqual(keys, ['twitch153'])
 
+        # The sqlite db has to hand back what was migrated into it.
+        test_sqlite = os.path.join(tmpdir, 'test.db')
+        config.set_option('db_type', 'xml')
+        a = DbBase(config, [HERE + '/testfiles/global-overlays.xml', ])
+        a.write(test_sqlite, migrate_type='sqlite')
+
+        config.set_option('db_type', 'sqlite')
+        c = DbBase(config, [test_sqlite,])
+        self.assertEqual(sorted(c.overlays), sorted(a.overlays))
+        for name in a.overlays:
+            self.assertEqual(c.overlays[name].to_dict(),
+                             a.overlays[name].to_dict())
+
+        # Reading does not touch the db: the index a newer layman
+        # adds is only created by the next write.
+        connection = sqlite3.connect(test_sqlite)
+        connection.execute('DROP INDEX Overlay_Owner_Owner_ID')
+        connection.commit()
+        connection.close()
+        c = DbBase(config, [test_sqlite,])
+        c.overlays.preload()
+        connection = sqlite3.connect(test_sqlite)
+        indexes = connection.execute('''SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'index' AND name = 'Overlay_Owner_Owner_ID' ''')
+        self.assertEqual(indexes.fetchone()[0], 0)
+        mode = connection.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'delete')
+        connection.close()
+
+        # Only the changes are written back, in one transaction.
+        c.remove(c.overlays['wrobel'], test_sqlite)
+        self.assertEqual(c.overlays.removed, set(['wrobel']))
+        c.write(test_sqlite, remove=True)
+        self.assertEqual(c.overlays.removed, set())
+        d = DbBase(config, [test_sqlite,])
+        self.assertEqual(sorted(d.overlays), ['wrobel-stable'])
+
+        d.overlays['wrobel'] = a.overlays['wrobel']
+        self.assertEqual(d.overlays.dirty, set(['wrobel']))
+        config.set_option('sqlite_journal_mode', 'wal')
+        d.write(test_sqlite)
+        d = DbBase(config, [test_sqlite,])
+        self.assertEqual(d.overlays['wrobel'].to_dict(),
+                         a.overlays['wrobel'].to_dict())
+        self.assertEqual(d.overlays['wrobel-stable'].to_dict(),
+                         a.overlays['wrobel-stable'].to_dict())
+
+        connection = sqlite3.connect(test_sqlite)
+        mode = connection.execute('PRAGMA journal_mode').fetchone()[0]
+        owners = connection.execute('SELECT COUNT(*) FROM Owner').fetchone()[0]
+        indexes = connection.execute('''SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'index' AND name = 'Overlay_Owner_Owner_ID' ''')
+        self.assertEqual(indexes.fetchone()[0], 1)
+        connection.close()
+        self.assertEqual(mode, 'wal')
+        self.assertEqual(owners, 1)
+
+        # Lookups are answered by the db without loading the catalog,
+        # the in memory fallback has to give the same answers.
+        d = DbBase(config, [test_sqlite,])
+        for db in (d, a):
+            self.assertEqual(db.list_ids(), ['wrobel', 'wrobel-stable'])
+            self.assertEqual(db.query(source_type='rsync'), ['wrobel-stable'])
+            self.assertEqual(db.query(status='official', search='TEST'),
+                             ['wrobel'])
+            self.assertEqual(db.query(quality='stable'), [])
+        self.assertFalse(d.overlays.is_loaded('wrobel'))
+        self.assertEqual(d.select('wrobel').name, 'wrobel')
+        self.assertFalse(d.overlays.is_loaded('wrobel-stable'))
+
+        # Both fold the case of non-ASCII letters as well
+        test_unicode = os.path.join(tmpdir, 'unicode.db')
+        config.set_option('db_type', 'xml')
+        a = DbBase(config, [HERE + '/testfiles/overlays_bug_184449.xml'])
+        a.write(test_unicode, migrate_type='sqlite')
+        config.set_option('db_type', 'sqlite')
+        d = DbBase(config, [test_unicode,])
+        for db in (d, a):
+            self.assertEqual(db.query(search='WRöBEL'), ['wrÖbel'])
+            self.assertEqual(db.query(search='test Ä'), ['wrÖbel'])
+
         # Clean up:
         os.unlink(test_xml)
         os.unlink(test_json)
+        os.unlink(test_sqlite)
+        os.unlink(test_unicode)
         shutil.rmtree(tmpdir)
 
 
@@ -766,6 +1228,742 @@ class RemoteDBCache(unittest.TestCase):
         shutil.rmtree(tmpdir)
 
 
+class ParallelJobs(unittest.TestCase):
+
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        out = open(os.path.join(tmpdir, 'out.txt'), 'w+')
+        output = Message(out=out)
+
+        def job(name):
+            def run():
+                for i in range(50):
+                    output.info('%s line %d' % (name, i), 1)
+                if name == 'broken':
+                    raise Exception('sync failed')
+                return name
+            return run
+
+        names = ['first', 'broken', 'second', 'third']
+        results = Scheduler(output, jobs=3).run(
+            [(name, job(name)) for name in names])
+
+        self.assertEqual(sorted(results), sorted(names))
+        self.assertEqual(results['first'], ('first', None))
+        self.assertEqual(results['broken'][0], None)
+        self.assertEqual(str(results['broken'][1]), 'sync failed')
+        self.assertFalse(output.is_buffered())
+
+        # The output of every job has to be printed in one block.
+        out.seek(0)
+        lines = [line.split(' line ')[0].split()[-1] for line in out]
+        blocks = [name for i, name in enumerate(lines)
+                  if i == 0 or lines[i - 1] != name]
+        self.assertEqual(sorted(blocks), sorted(names))
+
+        out.close()
+        shutil.rmtree(tmpdir)
+
+
+    def test_host_limit(self):
+        output = Message()
+        lock = threading.Lock()
+        running = {}
+        peak = {}
+        started = []
+
+        def job(host):
+            def run():
+                with lock:
+                    started.append(host)
+                    running[host] = running.get(host, 0) + 1
+                    peak[host] = max(peak.get(host, 0), running[host])
+                time.sleep(0.05)
+                with lock:
+                    running[host] -= 1
+            return run
+
+        urls = ['https://github.com/a/%d.git' % i for i in range(6)]
+        urls += ['git@github.com:b/b.git', 'git://anongit.gentoo.org/c.git',
+                 'rsync://anongit.gentoo.org/d']
+        tasks = [(url, job(get_host(url)), get_host(url)) for url in urls]
+        Scheduler(output, jobs=4, max_per_host=2).run(tasks)
+
+        # The free jobs go to the other host instead of waiting for github.
+        self.assertEqual(peak, {'github.com': 2, 'anongit.gentoo.org': 2})
+        self.assertEqual(len(started), len(urls))
+
+
+class RunCommand(unittest.TestCase):
+
+    def _config(self, out):
+        config = BareConfig(output=Message(out=out, err=out))
+        config.set_option('quiet', False)
+        return config
+
+
+    def test_buffered(self):
+        out = io.StringIO()
+        config = self._config(out)
+        config['output'].buffer_output()
+        result = run_command(config, 'sh', ['-c', 'echo out; echo err >&2'],
+                             cmd='sh')
+        text = config['output'].release_output()
+        self.assertEqual(result, 0)
+        self.assertTrue('out\nerr\n' in text)
+
+
+    def test_errors(self):
+        out = io.StringIO()
+        config = self._config(out)
+        config['output'].buffer_output()
+        errors = []
+        result = run_command(config, 'sh', ['-c', 'echo out; echo err >&2'],
+                             cmd='sh', errors=errors)
+        text = config['output'].release_output()
+        self.assertEqual((result, errors), (0, ['err']))
+        self.assertTrue('out\n' in text and 'err\n' in text)
+
+        # Attached to the terminal stderr is passed on as it comes
+        with tempfile.TemporaryFile('w+') as stderr:
+            config = BareConfig(output=Message(out=out, err=out),
+                                stderr=stderr)
+            config.set_option('quiet', True)
+            errors = []
+            result = run_command(config, 'sh', ['-c', 'echo err >&2; exit 3'],
+                                 cmd='sh', errors=errors)
+            stderr.seek(0)
+            self.assertEqual((result, errors, stderr.read()),
+                             (3, ['err'], 'err\n'))
+
+
+    def test_timeout(self):
+        out = io.StringIO()
+        config = self._config(out)
+        config['output'].buffer_output()
+        cancelled = []
+        start = time.time()
+        self.assertRaises(CommandTimeout, run_command, config, 'sleep',
+                          ['10'], cmd='sleep', timeout=0.2,
+                          on_cancel=lambda: cancelled.append(True))
+        config['output'].release_output()
+        self.assertEqual(cancelled, [True])
+        self.assertTrue(time.time() - start < 5)
+
+
+    def test_deadline(self):
+        out = io.StringIO()
+        config = self._config(out)
+        config['output'].buffer_output()
+        start = time.time()
+        with command_deadline(0.5):
+            self.assertEqual(run_command(config, 'true', [], cmd='true'), 0)
+            try:
+                run_command(config, 'sleep', ['10'], cmd='sleep')
+            except CommandTimeout as error:
+                self.assertEqual(error.timeout, 0.5)
+            else:
+                self.fail('sleep was not stopped')
+            # Once the deadline passed nothing is started any more
+            self.assertRaises(CommandTimeout, run_command, config, 'true',
+                              [], cmd='true')
+            with command_deadline(None):
+                self.assertEqual(run_command(config, 'true', [],
+                                             cmd='true'), 0)
+        self.assertEqual(run_command(config, 'true', [], cmd='true'), 0)
+        config['output'].release_output()
+        self.assertTrue(time.time() - start < 5)
+
+
+class Retry(unittest.TestCase):
+
+    def test_transient(self):
+        for error in (IOError(errno.ECONNRESET, 'reset'),
+                      socket.timeout('timed out'),
+                      URLError(OSError(errno.ECONNREFUSED, 'refused')),
+                      HTTPError('http://x', 503, 'busy', {}, None)):
+            self.assertTrue(is_transient_error(error), repr(error))
+        for error in (IOError(errno.ENOENT, 'missing'), ValueError('bad'),
+                      HTTPError('http://x', 404, 'missing', {}, None),
+                      URLError('unknown url type: x'),
+                      CommandTimeout('git', 10)):
+            self.assertFalse(is_transient_error(error), repr(error))
+
+
+    def test_retry_call(self):
+        config = BareConfig(output=Message(out=io.StringIO(),
+                                           err=io.StringIO()))
+        config.set_option('retries', 2)
+        config.set_option('retry_delay', 0)
+        calls = []
+
+        def flaky():
+            calls.append(True)
+            if len(calls) < 3:
+                raise IOError(errno.ECONNRESET, 'reset')
+            return 'done'
+        self.assertEqual(retry_call(config, flaky, what='test'), 'done')
+        self.assertEqual(len(calls), 3)
+
+        # Permanent errors are not retried
+        del calls[:]
+        def broken():
+            calls.append(True)
+            raise ValueError('bad')
+        self.assertRaises(ValueError, retry_call, config, broken)
+        self.assertEqual(len(calls), 1)
+
+        # Neither are results once the attempts are used up
+        del calls[:]
+        def failing():
+            calls.append(True)
+            return 128
+        self.assertEqual(retry_call(config, failing,
+                                    failed=lambda code: code == 128), 128)
+        self.assertEqual(len(calls), 3)
+
+        for attempt in range(10):
+            pause = retry_delay(2, attempt)
+            limit = min(60, 2 * 2 ** attempt)
+            self.assertTrue(limit / 2.0 <= pause <= limit)
+
+
+    def test_svn(self):
+        # A stand-in for svn failing "svn up" with the given message
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        command = os.path.join(tmpdir, 'svn')
+        calls = os.path.join(tmpdir, 'calls')
+        with fileopen(command, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'if [ "$1" = up ]; then\n'
+                    '    echo up >> %s\n'
+                    '    cat %s >&2\n'
+                    '    exit 1\n'
+                    'fi\n' % (calls, os.path.join(tmpdir, 'message')))
+        os.chmod(command, 0o755)
+
+        with tempfile.TemporaryFile('w+') as stderr:
+            config = BareConfig(output=Message(out=io.StringIO(),
+                                               err=io.StringIO()),
+                                stderr=stderr)
+            config.set_option('quiet', True)
+            config.set_option('svn_command', command)
+            config.set_option('retries', 2)
+            config.set_option('retry_delay', 0)
+            overlay = Overlay(config, ovl_dict={
+                'name': 'svn-test',
+                'source': [('https://example.org/svn', 'svn', None)],
+                'owner': [{'email': 'foo@example.org'}],
+                'description': ['Test']})
+
+            for message, attempts in (
+                    ("svn: E670002: Unable to connect to a repository at "
+                     "URL 'https://example.org/svn'", 3),
+                    ('svn: E155004: Working copy is locked', 1)):
+                with fileopen(os.path.join(tmpdir, 'message'), 'w') as f:
+                    f.write(message + '\n')
+                if os.path.exists(calls):
+                    os.unlink(calls)
+                self.assertEqual(overlay.sync(tmpdir), 1)
+                with fileopen(calls) as f:
+                    self.assertEqual(len(f.readlines()), attempts, message)
+                self.assertEqual(overlay.sources[0].sync_errors, [message])
+
+        shutil.rmtree(tmpdir)
+
+
+class Daemon(unittest.TestCase):
+
+    def _write_installed(self, installed, names):
+        with fileopen(installed, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<repositories version="1.0">\n')
+            for name in names:
+                f.write('''  <repo quality="experimental" status="unofficial">
+    <name>%s</name>
+    <description>Test</description>
+    <owner><email>foo@example.org</email></owner>
+    <source type="git">https://example.org/%s.git</source>
+  </repo>
+''' % (name, name))
+            f.write('</repositories>\n')
+
+
+    def _start(self, config):
+        daemon = LaymanDaemon(config)
+        server = threading.Thread(target=daemon.serve_forever)
+        server.start()
+        self.addCleanup(server.join)
+        self.addCleanup(daemon.shutdown)
+        for i in range(100):
+            if os.path.exists(daemon.path):
+                break
+            time.sleep(0.05)
+        return daemon
+
+
+    def test(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        installed = os.path.join(tmpdir, 'installed.xml')
+        self._write_installed(installed, ['first'])
+
+        def make_config(out, **options):
+            my_opts = {
+                       'installed': installed,
+                       'storage': tmpdir,
+                       'cache': os.path.join(tmpdir, 'cache'),
+                       'daemon_socket': os.path.join(tmpdir, 'layman.sock'),
+                       'nocheck': 'yes',
+                       'output': Message(out=out, err=out),
+                       'quietness': 0,
+                      }
+            my_opts.update(options)
+            return OptionConfig(my_opts)
+
+        daemon = self._start(make_config(io.StringIO()))
+
+        out = io.StringIO()
+        client = connect(make_config(out))
+        self.assertTrue(isinstance(client, DaemonClient))
+        self.assertEqual(client.get_installed(), ['first'])
+        info = client.get_info_list(local=True)
+        self.assertEqual(len(info), 1)
+        self.assertTrue(b'first' in info[0][0])
+        self.assertRaises(DaemonError, client.call, 'shutdown')
+
+        # Changes made by other processes are picked up
+        self._write_installed(installed, ['first', 'second'])
+        future = time.time() + 10
+        os.utime(installed, (future, future))
+        self.assertEqual(sorted(client.get_installed()), ['first', 'second'])
+
+        # The daemon only serves callers of the same config and storage
+        other = os.path.join(tmpdir, 'other')
+        self.assertEqual(connect(make_config(out, storage=other)), None)
+        self.assertEqual(connect(make_config(out, use_daemon=False)), None)
+        client.close()
+
+        daemon.shutdown()
+        for i in range(100):
+            if not os.path.exists(daemon.path):
+                break
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists(daemon.path))
+        shutil.rmtree(tmpdir)
+
+
+    def test_options(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        installed = os.path.join(tmpdir, 'installed.xml')
+        self._write_installed(installed, [])
+        tarball = os.path.join(tmpdir, 'layman-test.tar.bz2')
+        shutil.copyfile(os.path.join(HERE, 'testfiles', 'layman-test.tar.bz2'),
+                        tarball)
+        remote = os.path.join(tmpdir, 'remote.xml')
+        with fileopen(remote, 'w') as f:
+            f.write('''<?xml version="1.0" encoding="UTF-8"?>
+<repositories version="1.0">
+  <repo quality="experimental" status="unofficial">
+    <name>tar-test</name>
+    <description>Test</description>
+    <owner><email>foo@example.org</email></owner>
+    <source type="tar">file://%s</source>
+  </repo>
+</repositories>''' % urllib.pathname2url(tarball))
+        with fileopen(os.path.join(tmpdir, 'repos.conf'), 'w') as f:
+            f.write('')
+
+        def make_config(out, **options):
+            my_opts = {
+                       'installed': installed,
+                       'storage': tmpdir,
+                       'cache': os.path.join(tmpdir, 'cache'),
+                       'overlays': ['file://' + remote],
+                       'conf_type': 'repos.conf',
+                       'repos_conf': os.path.join(tmpdir, 'repos.conf'),
+                       'check_official': False,
+                       'daemon_socket': os.path.join(tmpdir, 'layman.sock'),
+                       'nocheck': 'yes',
+                       'output': Message(out=out, err=out),
+                       'quietness': 0,
+                      }
+            my_opts.update(options)
+            return OptionConfig(my_opts)
+
+        daemon = self._start(make_config(io.StringIO()))
+
+        # Callers using other lists work on their own
+        other = ['file://' + os.path.join(tmpdir, 'other.xml')]
+        self.assertEqual(connect(make_config(io.StringIO(), overlays=other)),
+                         None)
+
+        # The caller's -p is used for its request only
+        out = io.StringIO()
+        client = connect(make_config(out, priority='20', quietness=4))
+        self.assertTrue(isinstance(client, DaemonClient))
+        self.assertTrue(client.fetch_remote_list())
+        self.assertTrue(client.add_repos('tar-test'))
+        self.assertTrue('Running Tar' in out.getvalue())
+        db = DbBase(make_config(io.StringIO()), [installed])
+        self.assertEqual(db.overlays['tar-test'].priority, 20)
+        self.assertEqual(daemon.config['priority'], None)
+        self.assertEqual(daemon.config['stats'].records, [])
+        client.close()
+
+        shutil.rmtree(tmpdir)
+
+
+    def test_concurrent(self):
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        installed = os.path.join(tmpdir, 'installed.xml')
+        self._write_installed(installed, [])
+        config = OptionConfig({'installed': installed, 'storage': tmpdir,
+                               'cache': os.path.join(tmpdir, 'cache'),
+                               'output': Message(out=io.StringIO(),
+                                                 err=io.StringIO()),
+                               'quietness': 0})
+        daemon = LaymanDaemon(config)
+
+        class Api(object):
+            def reload(self):
+                pass
+            def get_installed(self):
+                return config['priority']
+        daemon.api = Api()
+
+        # Another request has the same -p applied while this one waits,
+        # it still has to get its own.
+        responses = []
+        line = json.dumps({'method': 'get_installed',
+                           'options': {'priority': '20'}}).encode('utf-8')
+        with daemon._lock:
+            saved = daemon._apply_options({'priority': '20'}, None)
+            waiting = threading.Thread(
+                target=lambda: responses.append(daemon.handle(line)))
+            waiting.start()
+            time.sleep(0.2)
+            daemon._restore_options(saved)
+        waiting.join()
+        self.assertEqual(responses[0]['result'], '20')
+        self.assertEqual(config['priority'], None)
+        shutil.rmtree(tmpdir)
+
+
+    def test_stream(self):
+        wfile = io.BytesIO()
+        stream = _OutputStream(wfile)
+        stream.write(' * one\n * tw')
+        self.assertEqual(wfile.getvalue(), b'{"output": " * one\\n"}\n')
+        stream.write('o\n')
+        stream.write(' * three')
+        stream.flush()
+        lines = wfile.getvalue().decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['output'] for line in lines],
+                         [' * one\n', ' * two\n', ' * three'])
+
+
+# git_command defaults to /usr/bin/git
+@unittest.skipUnless(os.path.exists('/usr/bin/git'), 'git is not installed')
+class GitSync(unittest.TestCase):
+
+    def _git(self, cwd, *args):
+        subprocess.check_call(['git', '-c', 'user.name=layman',
+                               '-c', 'user.email=layman@localhost'] +
+                              list(args), cwd=cwd, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+
+
+    def _commit(self, upstream, text):
+        with fileopen(os.path.join(upstream, 'README'), 'w') as f:
+            f.write(text)
+        self._git(upstream, 'add', 'README')
+        self._git(upstream, 'commit', '-q', '-m', text)
+
+
+    def _setup(self, source):
+        '''
+        Creates an upstream repo with one commit and an installed db
+        holding an overlay of it, the source being given as a template.
+        '''
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        upstream = os.path.join(tmpdir, 'upstream')
+        storage = os.path.join(tmpdir, 'storage')
+        os.makedirs(upstream)
+        os.makedirs(storage)
+        self._git(upstream, 'init', '-q')
+        self._commit(upstream, 'first')
+
+        installed = os.path.join(tmpdir, 'installed.xml')
+        with fileopen(installed, 'w') as f:
+            f.write('''<?xml version="1.0" encoding="UTF-8"?>
+<repositories version="1.0">
+  <repo quality="experimental" status="unofficial">
+    <name>git-test-overlay</name>
+    <description>Test</description>
+    <owner><email>foo@example.org</email></owner>
+    <source type="git">%s</source>
+  </repo>
+</repositories>''' % (source % {'upstream': upstream}))
+
+        my_opts = {
+                   'installed': installed,
+                   'storage': storage,
+                   'nocheck': 'yes',
+                   'quiet': True,
+                   'quietness': 0,
+                   'git_postsync': '',
+                  }
+        return tmpdir, upstream, storage, OptionConfig(my_opts)
+
+
+    def test_unchanged(self):
+        tmpdir, upstream, storage, config = self._setup('%(upstream)s')
+        self._git(storage, 'clone', '-q', upstream, 'git-test-overlay')
+        db = DB(config)
+
+        # Nothing recorded yet, then nothing new upstream.
+        self.assertTrue(db.sync('git-test-overlay'))
+        self.assertFalse(db.sync('git-test-overlay'))
+
+        self._commit(upstream, 'second')
+        self.assertTrue(db.sync('git-test-overlay'))
+        with fileopen(os.path.join(storage, 'git-test-overlay',
+                                   'README')) as f:
+            self.assertEqual(f.read(), 'second')
+        self.assertFalse(db.sync('git-test-overlay'))
+
+        config.set_option('check_upstream', False)
+        self.assertTrue(db.sync('git-test-overlay'))
+
+        shutil.rmtree(tmpdir)
+
+
+    def test_transient(self):
+        tmpdir, upstream, storage, config = self._setup('%(upstream)s')
+        self._git(storage, 'clone', '-q', upstream, 'git-test-overlay')
+        config.set_option('retries', 2)
+        config.set_option('retry_delay', 0)
+        overlay = DB(config).select('git-test-overlay')
+        source = overlay.sources[0]
+        attempts = []
+        sync = source.sync
+        source.sync = lambda base: attempts.append(True) or sync(base)
+
+        # A missing repo is not a network failure
+        shutil.rmtree(upstream)
+        self.assertEqual(overlay.sync(storage), 1)
+        self.assertEqual(len(attempts), 1)
+        self.assertTrue('does not appear to be a git repository' in
+                        '\n'.join(source.sync_errors))
+
+        source.sync_errors = ["fatal: unable to access 'https://x/': "
+                              "Could not resolve host: x"]
+        self.assertTrue(source.is_transient(1))
+        self.assertFalse(source.is_transient(2))
+
+        shutil.rmtree(tmpdir)
+
+
+    def test_stats(self):
+        tmpdir, upstream, storage, config = self._setup('%(upstream)s')
+        self._git(storage, 'clone', '-q', upstream, 'git-test-overlay')
+        stats_file = os.path.join(tmpdir, 'stats.jsonl')
+        config.set_option('stats_file', stats_file)
+        config.set_option('retries', 0)
+        db = DB(config)
+
+        self.assertTrue(db.sync('git-test-overlay'))
+        self.assertFalse(db.sync('git-test-overlay'))
+        shutil.rmtree(upstream)
+        self.assertRaises(Exception, db.sync, 'git-test-overlay')
+
+        with fileopen(stats_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records, config['stats'].records)
+        self.assertEqual([(r['action'], r['name'], r['type']) for r in records],
+                         [('sync', 'git-test-overlay', 'Git')] * 3)
+        self.assertEqual([(r['result'], r['skipped']) for r in records],
+                         [(0, False), (0, True), (1, False)])
+        self.assertTrue(all(r['seconds'] >= 0 for r in records))
+        self.assertEqual(records[0]['error'], None)
+        self.assertTrue('git-test-overlay' in records[2]['error'])
+
+        shutil.rmtree(tmpdir)
+
+
+    def test_shallow(self):
+        # --depth is ignored by clones of plain local paths
+        tmpdir, upstream, storage, config = self._setup('file://%(upstream)s')
+        self._commit(upstream, 'second')
+        config.set_option('git_clone_mode', 'blobless git-test-overlay=shallow')
+        config.set_option('check_upstream', False)
+        target = os.path.join(storage, 'git-test-overlay')
+
+        overlay = DB(config).select('git-test-overlay')
+        self.assertEqual(overlay.sources[0].clone_mode(), 'shallow')
+        self.assertEqual(overlay.add(storage), 0)
+
+        def depth():
+            return subprocess.check_output(['git', 'rev-list', '--count',
+                                            'HEAD'], cwd=target).strip()
+
+        self.assertEqual(depth(), b'1')
+        # "git pull" options would make the fetch fail
+        config.set_option('git_syncopts', '--ff-only --no-edit')
+        config.set_option('git_fetchopts', '--no-tags')
+        for text in ('third', 'fourth'):
+            self._commit(upstream, text)
+            self.assertEqual(overlay.sync(storage), 0)
+            self.assertEqual(depth(), b'1')
+            with fileopen(os.path.join(target, 'README')) as f:
+                self.assertEqual(f.read(), text)
+
+        shutil.rmtree(tmpdir)
+
+
+    def test_object_cache(self):
+        tmpdir, upstream, storage, config = self._setup('file://%(upstream)s')
+        cache = os.path.join(tmpdir, 'objects.git')
+        config.set_option('git_object_cache', cache)
+        config.set_option('check_upstream', False)
+        target = os.path.join(storage, 'git-test-overlay')
+
+        def objects(git_dir):
+            counts = subprocess.check_output(['git', '--git-dir', git_dir,
+                                              'count-objects', '-v'])
+            counts = dict(line.split(b': ') for line in counts.splitlines())
+            return int(counts[b'count']) + int(counts[b'in-pack'])
+
+        overlay = DB(config).select('git-test-overlay')
+        for text in ('second', 'third'):
+            self.assertEqual(overlay.add(storage), 0)
+            # Everything was borrowed from the cache
+            self.assertEqual(objects(os.path.join(target, '.git')), 0)
+            self.assertTrue(objects(cache) > 0)
+            self._commit(upstream, text)
+            self.assertEqual(overlay.sync(storage), 0)
+            self.assertEqual(objects(os.path.join(target, '.git')), 0)
+            with fileopen(os.path.join(target, 'README')) as f:
+                self.assertEqual(f.read(), text)
+            # The cache outlives the overlay
+            overlay.delete(storage)
+            self.assertTrue(objects(cache) > 0)
+
+        shutil.rmtree(tmpdir)
+
+
+class LazyDebug(unittest.TestCase):
+
+    def test_disabled(self):
+        out = io.StringIO()
+        output = Message(out=out, err=out)
+        output.set_debug_level(4)
+        called = []
+
+        def message():
+            called.append(True)
+            return 'expensive'
+
+        self.assertFalse(output.is_enabled(5))
+        output.debug(message, 5)
+        # Would fail if it got formatted
+        output.debug('%s %s', 5, 'too few')
+        self.assertEqual((called, out.getvalue()), ([], ''))
+
+
+    def test_enabled(self):
+        out = io.StringIO()
+        output = Message(out=out, err=out, col=False)
+        output.set_debug_level(5)
+        self.assertTrue(output.is_enabled(5))
+        output.debug('option %s: %s', 5, 'width', 80)
+        output.debug(lambda: 'computed', 4)
+        self.assertEqual(out.getvalue(),
+                         'DEBUG: option width: 80\nDEBUG: computed\n')
+
+
+    def test_call_sites(self):
+        # The messages passed lazily still format at the highest level.
+        tmpdir = tempfile.mkdtemp(prefix='laymantmp_')
+        out = io.StringIO()
+        output = Message(out=out, err=out, col=False)
+        output.set_debug_level(10)
+        url = 'file://' + HERE + '/testfiles/global-overlays.xml'
+        config = OptionConfig({'overlays': [url],
+                               'db_type': 'xml',
+                               'cache': os.path.join(tmpdir, 'cache'),
+                               'storage': tmpdir,
+                               'nocheck': 'yes',
+                               'use_daemon': 'no',
+                               'output': output})
+        try:
+            api = LaymanAPI(config, output=output)
+            self.assertTrue(api.fetch_remote_list())
+            self.assertEqual(api.get_available(), ['wrobel', 'wrobel-stable'])
+            self.assertEqual(command_output(config, 'echo', ['hi'],
+                                            cmd='echo'), 'hi\n')
+        finally:
+            shutil.rmtree(tmpdir)
+        text = out.getvalue()
+        self.assertTrue('DEBUG: RemoteDB._fetch_file() url = %s\n' % url
+                        in text)
+        self.assertTrue('DEBUG: LaymanAPI.fetch_remote_list(); cache updated '
+                        '= True\n' in text)
+        self.assertTrue([line for line in text.split('\n')
+                         if line.startswith('DEBUG: Utils.command_output(): ')
+                         and line.endswith('echo hi')])
+
+
+class ImportTime(unittest.TestCase):
+    # Modules that must not be loaded before an action needs them
+    HEAVY = ['layman.api', 'layman.daemon', 'layman.db', 'layman.remotedb',
+             'layman.mounter', 'gzip', 'lzma', 'sslfetch', 'pygpg',
+             'socketserver', 'urllib.request', 'xml.etree.ElementTree']
+
+    # What "layman -V" and "layman -h" import may take on a warm cache,
+    # only checked when LAYMAN_BENCHMARK is set since it depends on the
+    # load of the machine
+    BUDGET = 0.1
+
+    SCRIPT = '''
+import json, sys, time
+start = time.time()
+import layman.argsparser, layman.cli
+seconds = time.time() - start
+cli = sorted(sys.modules)
+import layman.api
+print(json.dumps({'seconds': seconds, 'cli': cli, 'api': sorted(sys.modules)}))
+'''
+
+    def _import(self):
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(HERE))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + [p for p in [env.get('PYTHONPATH')] if p])
+        result = subprocess.check_output([sys.executable, '-c', self.SCRIPT],
+                                         env=env)
+        return json.loads(result.decode('utf-8'))
+
+
+    def test_deferred_imports(self):
+        imported = self._import()
+        self.assertEqual([m for m in self.HEAVY if m in imported['cli']], [])
+        # The api loads the databases (and shutil loads the compression
+        # modules), but neither the download nor the gpg nor the xml
+        # modules
+        self.assertEqual([m for m in self.HEAVY[7:]
+                          if m in imported['api']], [])
+
+
+    @unittest.skipUnless(os.environ.get('LAYMAN_BENCHMARK'),
+                         'set LAYMAN_BENCHMARK to run the import benchmark')
+    def test_budget(self):
+        # The first run warms the cache
+        seconds = min(self._import()['seconds'] for i in range(3))
+        self.assertTrue(seconds < self.BUDGET,
+                        'Importing the cli took %.3f seconds' % seconds)
+
+
 if __name__ == '__main__':
     filterwarnings('ignore')
     unittest.main()
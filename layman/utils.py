@@ -32,12 +32,15 @@ __version__ = '$Id: utils.py 236 2006-09-05 20:39:37Z wrobel $'
 #-------------------------------------------------------------------------------
 
 import codecs
+import contextlib
 import copy
+import errno
 import locale
 import os
 import re
-import subprocess
 import sys
+import threading
+import time
 import types
 
 from  layman.output         import Message
@@ -47,6 +50,56 @@ if sys.hexversion >= 0x30200f0:
 else:
     STR = basestring
 
+# gzip and lzma are imported by open_compressed()/write_compressed(),
+# only if a compressed cache is read or written
+if sys.hexversion >= 0x30400f0:
+    from importlib.util import find_spec
+    XZ_SUPPORT = find_spec('lzma') is not None
+else:
+    import imp
+    try:
+        imp.find_module('lzma')
+        XZ_SUPPORT = True
+    except ImportError:
+        XZ_SUPPORT = False
+
+# The asyncio runner needs asyncio.run() and a child watcher that works
+# outside of the main thread
+ASYNC_RUNNER = sys.hexversion >= 0x30800f0
+
+# Seconds a command gets to exit after SIGTERM before it is killed
+KILL_GRACE = 5
+
+# Upper bound of the pause between two attempts, in seconds
+MAX_RETRY_DELAY = 60
+
+# Network failures that are worth another attempt
+_TRANSIENT_ERRNOS = set(getattr(errno, name) for name in
+    ('EAGAIN', 'ECONNABORTED', 'ECONNREFUSED', 'ECONNRESET', 'EHOSTUNREACH',
+     'ENETDOWN', 'ENETRESET', 'ENETUNREACH', 'EPIPE', 'ETIMEDOUT')
+    if hasattr(errno, name))
+_TRANSIENT_HTTP_CODES = (408, 429, 500, 502, 503, 504)
+
+# Values of the cache_compression option
+COMPRESSIONS = ('none', 'gzip', 'xz')
+_GZIP_MAGIC = b'\x1f\x8b'
+_XZ_MAGIC = b'\xfd7zXZ\x00'
+
+#===============================================================================
+#
+# Exceptions
+#
+#-------------------------------------------------------------------------------
+
+class CommandTimeout(Exception):
+    '''A command outlived its time limit and was killed.'''
+
+    def __init__(self, command, timeout):
+        super(CommandTimeout, self).__init__(
+            '%s timed out after %s seconds' % (command, timeout))
+        self.command = command
+        self.timeout = timeout
+
 #===============================================================================
 #
 # Helper functions
@@ -220,9 +273,16 @@ def resolve_command(command, output):
         return ('Command', None)
 
 
-def run_command(config, command, args, **kwargs):
+def prepare_command(config, command, args, kwargs):
+    '''
+    Resolves the command and builds its environment.
+
+    @param kwargs: the keyword arguments given to run_command().
+    @rtype tuple: (argv, cwd, env, command_repr) where env is None if the
+    surrounding environment is used unchanged.
+    '''
     output = config['output']
-    output.debug("Utils.run_command(): " + command, 6)
+    output.debug("Utils.run_command(): %s", 6, command)
 
     file_to_run = resolve_command(command, output.error)[1]
     args = [file_to_run] + args
@@ -245,31 +305,219 @@ def run_command(config, command, args, **kwargs):
     if cwd is not None:
         command_repr = '( cd %s  && %s )' % (cwd, command_repr)
 
+    return (args, cwd, env, command_repr)
+
+
+_deadlines = threading.local()
+
+
+@contextlib.contextmanager
+def command_deadline(seconds):
+    '''
+    Limits the wall clock time of all commands the calling thread runs
+    within the block, e.g. of all commands syncing one overlay.
+
+    @param seconds: the time limit, 0 or None lifts the limit of any
+    enclosing block.
+    '''
+    previous = getattr(_deadlines, 'deadline', None)
+    if seconds:
+        _deadlines.deadline = (time.time() + seconds, seconds)
+    else:
+        _deadlines.deadline = None
+    try:
+        yield
+    finally:
+        _deadlines.deadline = previous
+
+
+def command_timeout(name, kwargs):
+    '''
+    Returns the time limit of the next command: the timeout keyword
+    argument or else what is left of the calling thread's deadline.
+
+    @param name: the name of the command used in the error.
+    @rtype tuple: (seconds left or None, the limit to report).
+    @raise CommandTimeout: if the deadline has already passed.
+    '''
+    timeout = kwargs.get('timeout', None)
+    if timeout is not None:
+        return (timeout, timeout)
+    deadline = getattr(_deadlines, 'deadline', None)
+    if deadline is None:
+        return (None, None)
+    left = deadline[0] - time.time()
+    if left <= 0:
+        raise CommandTimeout(name, deadline[1])
+    return (left, deadline[1])
+
+
+def stop_process(proc, grace=KILL_GRACE):
+    '''
+    Asks a process to terminate and kills it if it is still running
+    after grace seconds.
+    '''
+    try:
+        proc.terminate()
+    except OSError:
+        return
+    end = time.time() + grace
+    while proc.poll() is None and time.time() < end:
+        time.sleep(0.05)
+    if proc.poll() is None:
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+
+def _start_watchdog(proc, timeout):
+    '''
+    Stops the process once it ran for timeout seconds.
+
+    @rtype threading.Timer or None without a timeout. Its fired list is
+    not empty once the process was stopped.
+    '''
+    if timeout is None:
+        return None
+    fired = []
+
+    def stop():
+        fired.append(True)
+        stop_process(proc)
+
+    watchdog = threading.Timer(timeout, stop)
+    watchdog.daemon = True
+    watchdog.fired = fired
+    watchdog.start()
+    return watchdog
+
+
+def run_cancel_hook(on_cancel, output):
+    '''Runs the on_cancel callable of a command that got killed.'''
+    if on_cancel is None:
+        return
+    # The cleanup must not inherit the deadline that has just passed
+    with command_deadline(None):
+        try:
+            on_cancel()
+        except Exception as err:
+            output.error('Cleaning up the cancelled command failed: %s'
+                         % str(err))
+
+
+class StderrCopy(object):
+    '''
+    Keeps what a command writes to stderr while passing it on to where
+    it would have gone, see the errors argument of run_command().
+    '''
+
+    def __init__(self, target=None):
+        self.target = target
+        self.chunks = []
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+        if self.target is not None:
+            self.target.write(self._decoder.decode(chunk))
+            self.target.flush()
+
+    def lines(self):
+        return b''.join(self.chunks).decode('utf-8', 'replace').splitlines()
+
+
+def run_command(config, command, args, **kwargs):
+    '''
+    Runs a command, attached to the terminal unless layman is quiet or
+    the calling thread buffers its output.
+
+    Commands taking longer than their timeout, or than what is left of
+    the calling thread's command_deadline(), get SIGTERM and after
+    KILL_GRACE seconds SIGKILL.
+
+    @param kwargs: cwd, env (updates to the surrounding environment),
+    cmd (the name used in messages), timeout (seconds), on_cancel
+    (callable run if the command gets killed) and errors (list the
+    lines the command writes to stderr are appended to, they are shown
+    as usual all the same).
+    @rtype int: the exit code of the command.
+    @raise CommandTimeout: if the command was killed by the timeout.
+    '''
+    if ASYNC_RUNNER:
+        from layman.runner import run_command as _run_command
+        return _run_command(config, command, args, **kwargs)
+
+    import subprocess
+    output = config['output']
     cmd = kwargs.get('cmd', '')
+    timeout, limit = command_timeout(cmd or command, kwargs)
+    args, cwd, env, command_repr = prepare_command(config, command, args,
+                                                   kwargs)
+
     output.info('Running %s... # %s' % (cmd, command_repr), 2)
 
+    # When running as one of several parallel jobs the output is collected
+    # in the calling thread's buffer to keep it from interleaving.
+    buffered = output.is_buffered()
+
     if config['quiet']:
 
         input_source = subprocess.PIPE
         output_target = open('/dev/null', 'w')
+        error_target = config['stderr']
+        if buffered:
+            error_target = subprocess.PIPE
+    elif buffered:
+        # Parallel jobs can not share the terminal
+        input_source = subprocess.PIPE
+        output_target = subprocess.PIPE
+        error_target = subprocess.STDOUT
     else:
         # Re-use parent file descriptors
         input_source = None
         output_target = None
+        error_target = config['stderr']
+
+    errors = kwargs.get('errors', None)
+    error_copy = None
+    if errors is not None:
+        if error_target is subprocess.STDOUT:
+            error_target = subprocess.PIPE
+        elif error_target is not subprocess.PIPE:
+            error_copy = StderrCopy(error_target)
+            error_target = subprocess.PIPE
 
     proc = subprocess.Popen(args,
         stdin=input_source,
         stdout=output_target,
-        stderr=config['stderr'],
+        stderr=error_target,
         cwd=cwd,
         env=env)
-
-    if config['quiet']:
-        # Make child non-interactive
-        proc.stdin.close()
+    watchdog = _start_watchdog(proc, timeout)
 
     try:
-        result = proc.wait()
+        if buffered:
+            # communicate() makes the child non-interactive
+            captured = proc.communicate()
+            for text in captured:
+                if text:
+                    output.std_out.write(text.decode('utf-8', 'replace'))
+            if errors is not None and captured[1]:
+                errors.extend(captured[1].decode('utf-8', 'replace')
+                              .splitlines())
+            result = proc.returncode
+        else:
+            if config['quiet']:
+                # Make child non-interactive
+                proc.stdin.close()
+            if error_copy is not None:
+                for chunk in iter(lambda: os.read(proc.stderr.fileno(),
+                                                  4096), b''):
+                    error_copy.write(chunk)
+                proc.stderr.close()
+                errors.extend(error_copy.lines())
+            result = proc.wait()
     except Exception as err:
         output.error(
             'Unknown exception running command: %s' % command_repr)
@@ -279,12 +527,146 @@ def run_command(config, command, args, **kwargs):
     if config['quiet']:
         output_target.close()
 
+    if watchdog is not None:
+        watchdog.cancel()
+        if watchdog.fired:
+            output.error('Command timed out after %s seconds: %s'
+                         % (limit, command_repr))
+            run_cancel_hook(kwargs.get('on_cancel', None), output)
+            raise CommandTimeout(cmd or command, limit)
+
     if result:
         output.info('Failure result returned from %s' % cmd , 2)
 
     return result
 
 
+def command_output(config, command, args, **kwargs):
+    '''
+    Runs a command non-interactively and returns what it printed.
+
+    @param kwargs: cwd (optional), cmd, the name used in messages, and
+    timeout (optional, see run_command()).
+    @rtype str or None if the command failed.
+    @raise CommandTimeout: if the command was killed by the timeout.
+    '''
+    import subprocess
+    output = config['output']
+    timeout, limit = command_timeout(kwargs.get('cmd', '') or command,
+                                     kwargs)
+    file_to_run = resolve_command(command, output.error)[1]
+    if not file_to_run:
+        return None
+    args = [file_to_run] + args
+    cmd = kwargs.get('cmd', '')
+    output.debug('Utils.command_output(): %s', 6, ' '.join(args))
+
+    # Parsable, untranslated output
+    env = copy.copy(os.environ)
+    env['LC_ALL'] = 'C'
+    try:
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen(args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=devnull,
+                cwd=kwargs.get('cwd', None),
+                env=env)
+            watchdog = _start_watchdog(proc, timeout)
+            text = proc.communicate()[0]
+    except (IOError, OSError) as err:
+        output.debug('Utils.command_output(): running %s failed: %s', 4,
+                     cmd, err)
+        return None
+    if watchdog is not None:
+        watchdog.cancel()
+        if watchdog.fired:
+            raise CommandTimeout(cmd or command, limit)
+    if proc.returncode:
+        output.debug('Utils.command_output(): %s returned %d', 4,
+                     cmd, proc.returncode)
+        return None
+    return text.decode('utf-8', 'replace')
+
+
+def is_transient_error(error):
+    '''
+    Tells whether an exception is a network failure that may go away by
+    itself: a timeout, a refused or reset connection, a temporary DNS
+    failure or an http(s) server error.
+
+    @rtype bool
+    '''
+    if isinstance(error, CommandTimeout):
+        # Another attempt would most likely hang just as long
+        return False
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        # urllib's HTTPError
+        return code in _TRANSIENT_HTTP_CODES
+    reason = getattr(error, 'reason', None)
+    if isinstance(reason, Exception):
+        # urllib's URLError wraps the socket error
+        return is_transient_error(reason)
+    import socket
+    if isinstance(error, socket.timeout):
+        return True
+    if isinstance(error, socket.gaierror):
+        return error.errno == getattr(socket, 'EAI_AGAIN', None)
+    if isinstance(error, (IOError, OSError)):
+        return error.errno in _TRANSIENT_ERRNOS
+    return False
+
+
+def retry_delay(delay, attempt):
+    '''
+    Returns the pause before the next attempt: the delay doubled with
+    every failed attempt, at most MAX_RETRY_DELAY, of which a random
+    half is left out so parallel jobs do not retry in lockstep.
+
+    @param attempt: number of failed attempts so far minus one.
+    @rtype float: seconds
+    '''
+    import random
+    pause = min(MAX_RETRY_DELAY, delay * 2 ** attempt)
+    return pause / 2.0 + random.uniform(0, pause / 2.0)
+
+
+def retry_call(config, func, failed=None, what=''):
+    '''
+    Calls func and calls it again, after a growing pause, while it fails
+    transiently, up to config['retries'] more times.
+
+    @param func: callable taking no arguments.
+    @param failed: callable telling whether a result returned by func is
+    a transient failure. Exceptions are retried if is_transient_error()
+    says so.
+    @param what: what func does, used in the messages.
+    @rtype what func returned the last time; the exception of the last
+    attempt is raised again.
+    '''
+    output = config['output']
+    retries = get_int_option(config, 'retries', 2)
+    delay = get_int_option(config, 'retry_delay', 2)
+    attempt = 0
+    while True:
+        try:
+            result = func()
+        except Exception as error:
+            if attempt >= retries or not is_transient_error(error):
+                raise
+            reason = str(error)
+        else:
+            if attempt >= retries or failed is None or not failed(result):
+                return result
+            reason = 'transient failure'
+        pause = retry_delay(delay, attempt)
+        attempt += 1
+        output.warn('%s failed (%s), attempt %d of %d in %.1f seconds...'
+                    % (what, reason, attempt + 1, retries + 1, pause), 2)
+        time.sleep(pause)
+
+
 def verify_overlay_src(current_src, remote_srcs):
     '''
     Verifies that the src-url of the overlay in
@@ -302,6 +684,101 @@ def verify_overlay_src(current_src, remote_srcs):
         return remote_srcs, False
     return current_src, True
 
+
+def get_int_option(config, key, default):
+    '''
+    Returns the value of a numeric config option.
+
+    @param config: layman config object.
+    @param key: config option to look up.
+    @param default: value to use when the option is not a valid number.
+    @rtype int: the option value, never negative.
+    '''
+    try:
+        return max(0, int(config[key]))
+    except (TypeError, ValueError):
+        config['output'].warn('Invalid %s value "%s", using %d instead'
+                              % (key, config[key], default), 2)
+        return default
+
+
+def get_host(src):
+    '''
+    Returns the host name of an overlay source url.
+
+    Handles regular urls (https://, git://, rsync://, svn+ssh://...) as
+    well as scp-like git urls (git@github.com:user/repo.git).
+
+    @param src: source url of an overlay.
+    @rtype str: the lower case host name or '' for local sources.
+    '''
+    if '://' in src:
+        if sys.hexversion >= 0x30200f0:
+            from urllib.parse import urlparse
+        else:
+            from urlparse import urlparse
+        try:
+            host = urlparse(src).netloc
+        except ValueError:
+            # a malformed url, it fails when it is used
+            return ''
+    elif re.match(r'^[^/]+:', src):
+        host = src.split(':', 1)[0]
+    else:
+        return ''
+    # Strip user credentials and the port
+    host = host.rsplit('@', 1)[-1]
+    if host.startswith('['):
+        host = host[1:].split(']', 1)[0]
+    else:
+        host = host.split(':', 1)[0]
+    return host.lower()
+
+
+def open_compressed(path):
+    '''
+    Opens a file for reading bytes. gzip and xz compressed files are
+    recognized by their magic number and decompressed on the fly.
+
+    @rtype file like object
+    '''
+    document = open(path, 'rb')
+    magic = document.read(len(_XZ_MAGIC))
+    document.seek(0)
+    if magic.startswith(_GZIP_MAGIC):
+        document.close()
+        import gzip
+        return gzip.GzipFile(path, 'rb')
+    if magic.startswith(_XZ_MAGIC):
+        document.close()
+        if not XZ_SUPPORT:
+            raise IOError('Cannot read the xz compressed "%s", the lzma '
+                          'module is not available' % path)
+        import lzma
+        return lzma.LZMAFile(path, 'rb')
+    return document
+
+
+def write_compressed(path, data, compression='none'):
+    '''
+    Writes text or bytes to a file, compressed as asked.
+
+    @param compression: one of COMPRESSIONS.
+    '''
+    if not isinstance(data, bytes):
+        data = data.encode('UTF-8')
+    if compression == 'gzip':
+        import gzip
+        document = gzip.GzipFile(path, 'wb')
+    elif compression == 'xz':
+        import lzma
+        document = lzma.LZMAFile(path, 'wb')
+    else:
+        document = open(path, 'wb')
+    with document:
+        document.write(data)
+
+
 def delete_empty_directory(mdir, output=None):
     # test for a usable output parameter,
     # and make it usable if not
@@ -7,6 +7,7 @@ import logging
 import layman.overlays.overlay as Overlay
 from layman.api import LaymanAPI
 from layman.config import BareConfig, OptionConfig
+from layman.daemon import connect
 from layman.maker import Interactive
 from layman.output import Message
 from layman.utils import reload_config
@@ -22,6 +23,96 @@ from portage.sync.syncbase import NewBase
 
 import sys
 
+# The layman state shared by all repos synced in one portage session,
+# by storage directory. See _get_session().
+_sessions = {}
+
+
+class _Session(object):
+    '''
+    One LaymanAPI instance, and whether its remote lists were fetched
+    yet, shared by the PyLayman instances of repos kept in the same
+    storage directory.
+    '''
+
+    def __init__(self, config, api):
+        self.config = config
+        self.api = api
+        self.pid = os.getpid()
+        self.fetched = False
+
+
+    def fetch_remote_list(self):
+        '''
+        Fetches the remote lists once per session.
+
+        @rtype list of the available overlays.
+        '''
+        if not self.fetched:
+            # Only tried once, a failed fetch leaves the cached lists
+            self.fetched = True
+            self.api.fetch_remote_list()
+        return self.api.get_available()
+
+
+def reset_sessions():
+    '''
+    Drops the shared LaymanAPI instances, so the next repo starts over
+    with the config, databases and remote lists on disk.
+    '''
+    _sessions.clear()
+
+
+def _get_session(settings, storage):
+    '''
+    Returns the session for the storage directory, creating it (and its
+    LaymanAPI instance) on first use.
+
+    @params settings: portage.config class object
+    @params storage: layman storage directory
+    @rtype _Session
+    '''
+    key = (storage, settings.get('EROOT'))
+    session = _sessions.get(key)
+    # A session inherited by a forked process would share the
+    # parent's sockets and cached state.
+    if session is not None and session.pid == os.getpid():
+        return session
+
+    config = BareConfig()
+    configdir = {'configdir': config.get_option('configdir')}
+
+    message = Message(out=sys.stdout, err=sys.stderr)
+    options = {
+        'config': config.get_option('config') % (configdir),
+        'quiet': settings.get('PORTAGE_QUIET'),
+        'quietness': config.get_option('quietness'),
+        'overlay_defs': config.get_option('overlay_defs') % (configdir),
+        'output': message,
+        'nocolor': settings.get('NOCOLOR'),
+        'root': settings.get('EROOT'),
+        'storage': storage,
+        'verbose': settings.get('PORTAGE_VERBOSE'),
+        'width': settings.get('COLUMNWIDTH'),
+
+    }
+    config = OptionConfig(options=options, root=options['root'])
+
+    # Reloads config to read custom overlay
+    # xml files.
+    reload_config(config)
+
+    # Prefer a running layman-daemon, it has the databases loaded
+    layman_api = connect(config) or LaymanAPI(config,
+                           report_errors=True,
+                           output=config['output']
+                           )
+
+    session = _Session(config, layman_api)
+    _sessions[key] = session
+    return session
+
+
 def create_overlay_package(config=None, repo=None, logger=None, xterm_titles=None):
     '''
     Creates a layman overlay object
@@ -78,9 +169,8 @@ class PyLayman(NewBase):
     def __init__(self):
         NewBase.__init__(self, 'layman', 'app-portage/layman')
 
-        self._layman = None
+        self._session = None
         self.storage = ''
-        self.current_storage = ''
 
 
     def _get_layman_api(self):
@@ -89,47 +179,13 @@ class PyLayman(NewBase):
 
         @rtype layman.api.LaymanAPI instance
         '''
-        # Make it so that we aren't initializing the
-        # LaymanAPI instance if it already exists and
-        # if the current storage location hasn't been
-        # changed for the new repository.
+        # All repos of the same storage location share one
+        # LaymanAPI instance for the whole sync session.
         self.storage = self.repo.location.replace(self.repo.name, '')
-
-        if self._layman and self.storage in self.current_storage:
-            return self._layman
-
-        config = BareConfig()
-        configdir = {'configdir': config.get_option('configdir')}
-
-        self.message = Message(out=sys.stdout, err=sys.stderr)
-        self.current_storage = self.storage
-        options = {
-            'config': config.get_option('config') % (configdir),
-            'quiet': self.settings.get('PORTAGE_QUIET'),
-            'quietness': config.get_option('quietness'),
-            'overlay_defs': config.get_option('overlay_defs') % (configdir),
-            'output': self.message,
-            'nocolor': self.settings.get('NOCOLOR'),
-            'root': self.settings.get('EROOT'),
-            'storage': self.current_storage,
-            'verbose': self.settings.get('PORTAGE_VERBOSE'),
-            'width': self.settings.get('COLUMNWIDTH'),
-
-        }
-        self.config = OptionConfig(options=options, root=options['root'])
-
-        # Reloads config to read custom overlay
-        # xml files.
-        reload_config(self.config)
-
-        layman_api = LaymanAPI(self.config,
-                               report_errors=True,
-                               output=self.config['output']
-                               )
-
-        self._layman = layman_api
-
-        return layman_api
+        self._session = _get_session(self.settings, self.storage)
+        self.config = self._session.config
+        self.message = self.config['output']
+        return self._session.api
 
 
     def _eval_exitcode(self, exitcode):
@@ -149,9 +205,9 @@ class PyLayman(NewBase):
     def new(self, **kwargs):
         '''Do the initial download and install of the repository'''
         layman_inst = self._get_layman_api()
-        # Update the remote list before adding anything.
-        layman_inst.fetch_remote_list()
-        available_overlays = layman_inst.get_available(dbreload=True)
+        # Update the remote list before adding anything, once per
+        # session. It reloads the remote db if the lists changed.
+        available_overlays = self._session.fetch_remote_list()
 
         msg = '>>> Starting to add new layman overlay %(repo)s'\
             % ({'repo': self.repo.name})
@@ -174,6 +230,8 @@ class PyLayman(NewBase):
                 self.logger(self.xterm_titles, msg)
                 writemsg_level(msg + '\n', level=logging.ERROR, noiselevel=-1)
                 return (1, False)
+            # Pick up the new definition in reposconf.xml
+            layman_inst.get_available(dbreload=True)
 
         results = layman_inst.add_repos(self.repo.name)
         exitcode = self._eval_exitcode(results)
@@ -206,6 +264,16 @@ class PyLayman(NewBase):
         results = layman_inst.sync(self.repo.name)
         exitcode = self._eval_exitcode(results)
 
+        if (exitcode != os.EX_OK and os.path.isdir(self.repo.location)
+                and layman_inst.is_installed(self.repo.name)):
+            # layman already retried transient failures, re-adding an
+            # intact repo would only start over with a fresh clone.
+            msg = "!!! layman sync error in %(repo)s"\
+                % ({'repo': self.repo.name})
+            self.logger(self.xterm_titles, msg)
+            writemsg_level(msg + "\n", level=logging.ERROR, noiselevel=-1)
+            return (exitcode, False)
+
         if exitcode != os.EX_OK:
             exitcode = self.new()[0]
             if exitcode != os.EX_OK:
@@ -13,6 +13,10 @@ bad = create_color_func("BAD")
 warn = create_color_func("WARN")
 from portage.sync.syncbase import NewBase
 
+# The storage locations whose remote lists were already fetched by a
+# previous layman run of this sync session.
+_fetched = set()
+
 
 class Layman(NewBase):
     '''
@@ -105,6 +109,9 @@ class Layman(NewBase):
         self._get_optargs(args)
         args.append('--storage')
         args.append(location)
+        if location in _fetched:
+            # Fetched once per session is enough
+            args.append('--nofetch')
         args.append('-s')
         args.append(self.repo.name)
 
@@ -112,6 +119,7 @@ class Layman(NewBase):
         exitcode = portage.process.spawn_bash("%(command)s" % \
             ({'command': command}),
             **portage._native_kwargs(self.spawn_kwargs))
+        _fetched.add(location)
 
         if exitcode != os.EX_OK:
             exitcode = self.new()[0]
@@ -96,8 +96,9 @@ setup(
         'layman.db_modules.xml_db', 'layman.overlays',
         'layman.overlays.modules',
         ] + modules,
-    scripts       = ['bin/layman', 'bin/layman-overlay-maker',
-                       'bin/layman-mounter', 'bin/layman-updater'],
+    scripts       = ['bin/layman', 'bin/layman-daemon',
+                       'bin/layman-overlay-maker', 'bin/layman-mounter',
+                       'bin/layman-updater'],
     cmdclass = {
         'setup_plugins': setup_plugins,
         },